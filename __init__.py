@@ -1,14 +1,30 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Optional
+import functools
+import re
+from typing import Any, Dict, List, Optional
 
 from aqt import gui_hooks, mw
 from aqt.qt import QAction, Qt
 from aqt.utils import tooltip
 
-from .service import compute_tag_ratios
-from .store import load_cache, save_cache
+from .decks import invalidate_deck_names
+from .diagnostics import Trace, format_entry
+from .search_cache import invalidate_search_cache
+from .engine import UpdateEngine, UpdateHandle
+from .scheduler import AutoUpdateScheduler
+from .service import panel_spec
+from .history import append as append_history, daily_series, series_key
+from .store import (
+    append_debug_log,
+    append_diagnostics,
+    cache_version,
+    history_path,
+    load_cache,
+    save_cache,
+)
 from .ui.dialog import TagRatioDialog
+from .ui.bands import bands_for_cfg
 from .ui.render import build_panel_html
 from .ui.config_dialog import ConfigDialog
 
@@ -50,6 +66,19 @@ def _anki_quote(s: str) -> str:
     return '"' + str(s).replace('"', r'\"') + '"'
 
 
+# 「deck:名前」の後ろに続く別の検索語（-xxx / field:xxx）。"Parent::Child" の :: は除く
+_EXTRA_TERM_RE = re.compile(r"^(-\S|[\w-]+:(?!:))")
+
+
+def _has_extra_terms(rest: str) -> bool:
+    if rest.startswith('"'):
+        # 閉じクォートの後ろに何か続いていれば別の条件
+        close = re.match(r'"(?:[^"\\]|\\.)*"', rest)
+        return close is None or bool(rest[close.end():].strip())
+    # deck:My Deck のような名前は救済したいので、2語目以降が検索語に見えるときだけ
+    return any(_EXTRA_TERM_RE.match(tok) for tok in rest.split()[1:])
+
+
 def _normalize_search_scope(scope: str) -> str:
     """
     目的:
@@ -86,6 +115,10 @@ def _normalize_search_scope(scope: str) -> str:
     if rest == "*":
         return "deck:*"
 
+    # deck: の後ろに他の条件（-is:suspended, tag:x, or deck:y 等）が続く行は触らない
+    if _has_extra_terms(rest):
+        return s
+
     # rest が "..." で囲まれているかを軽く判定
     name: str
     if len(rest) >= 2 and rest[0] == '"' and rest[-1] == '"':
@@ -103,13 +136,16 @@ def _normalize_search_scope(scope: str) -> str:
     return f'(deck:{_anki_quote(name)} or deck:{_anki_quote(name + "::*")})'
 
 
+@functools.lru_cache(maxsize=64)
 def _normalize_search_scopes_multiline(scope_text: str) -> str:
     """
+    文字列だけで決まるので結果を覚える（更新のたび・パネルごとに解析し直さない）。
+
     複数行入力を想定：
       - 1行 = 1つのスコープ
       - 空行は無視
       - 各行に _normalize_search_scope を適用
-      - 最後に OR で結合
+      - 最後に OR で結合（そのまま残した複合条件の行は括弧で囲む）
     """
     raw = (scope_text or "").strip()
     if not raw:
@@ -127,6 +163,8 @@ def _normalize_search_scopes_multiline(scope_text: str) -> str:
     if len(parts) == 1:
         return parts[0]
 
+    # そのまま残した行（deck:X -is:suspended 等）は括弧で囲んでから OR でつなぐ
+    parts = [f"({p})" if p in lines and " " in p else p for p in parts]
     return "(" + " or ".join(parts) + ")"
 
 
@@ -190,7 +228,7 @@ def _open_dialog() -> None:
         except Exception:
             _DLG = None
 
-    _DLG = TagRatioDialog(parent=mw)
+    _DLG = TagRatioDialog(parent=mw, request_update=_update_now, load_result=_load_panel_cache)
     _DLG.setAttribute(Qt.WidgetAttribute.WA_DeleteOnClose, True)
     _DLG.destroyed.connect(lambda *_: _on_dialog_destroyed())
     _DLG.show()
@@ -198,50 +236,226 @@ def _open_dialog() -> None:
     _DLG.activateWindow()
 
 
-def _update_now() -> None:
+# panels の各要素で上書きできるキー（それ以外は top-level の値を使う）
+_PANEL_KEYS = (
+    "search_scope",
+    "tags",
+    "tag_mode",
+    "tag_match",
+    "tag_breakdown",
+    "count_mode",
+    "min_cards",
+    "deck_tree",
+    "max_rows",
+    "sort_by",
+    "pct_bands",
+)
+
+
+def _panels(cfg: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    panels が空なら従来の1パネル（名前 ""）。
+    あれば各要素を top-level の config に重ねたもの。名前の重複は後ろを捨てる。
+    """
+    raw = cfg.get("panels")
+    if not isinstance(raw, list) or not raw:
+        return [dict(cfg, name="")]
+
+    out: List[Dict[str, Any]] = []
+    seen = set()
+    for i, p in enumerate(raw):
+        if not isinstance(p, dict):
+            continue
+        name = str(p.get("name") or f"Panel {i + 1}").strip()
+        if name in seen:
+            continue
+        seen.add(name)
+        merged = dict(cfg)
+        merged.update({k: v for k, v in p.items() if k in _PANEL_KEYS})
+        merged["name"] = name
+        out.append(merged)
+    return out or [dict(cfg, name="")]
+
+
+def _spec_for(p: Dict[str, Any]) -> Dict[str, Any]:
+    raw_scope = str(p.get("search_scope", "deck:*"))
+    return panel_spec(
+        search_scope=_normalize_search_scopes_multiline(raw_scope),
+        tags=list(p.get("tags", [])),
+        tag_mode=str(p.get("tag_mode", "OR")).upper(),
+        min_cards=int(p.get("min_cards", 0)),
+        tag_breakdown=bool(p.get("tag_breakdown", False)),
+        deck_tree=bool(p.get("deck_tree", False)),
+        tag_match=str(p.get("tag_match", "exact")),
+        count_mode=str(p.get("count_mode", "cards")),
+        name=p["name"],
+    )
+
+
+# 更新中に出す標本からの推定結果（パネル名 → 結果）。正確な結果が出たら消す
+_ESTIMATES: Dict[str, Dict[str, Any]] = {}
+
+
+def _panel_result(p: Dict[str, Any]) -> Dict[str, Any]:
+    # 推定が出ていればそれ、なければ今のプロファイル・今の条件の cache
+    est = _ESTIMATES.get(p["name"])
+    if est is not None:
+        return est
+    return load_cache(_spec_for(p))
+
+
+def _load_panel_cache(name: str = "") -> Dict[str, Any]:
+    """パネル name の表示する結果（ダイアログ用）。"""
+    panels = _panels(_cfg())
+    p = next((p for p in panels if p["name"] == name), panels[0])
+    return _panel_result(p)
+
+
+def _update_params() -> Optional[Dict[str, Any]]:
     cfg = _cfg()
+    if mw.col is None:
+        tooltip("Tag Ratio: collection not ready")
+        return None
+
     try:
-        col = mw.col
-        if col is None:
-            tooltip("Tag Ratio: collection not ready")
-            return
+        estimate_min = max(0, int(cfg.get("progressive_min_cards", 100_000)))
+    except Exception:
+        estimate_min = 100_000
+    # 全パネルを1回のスキャンで数える
+    return dict(panels=[_spec_for(p) for p in _panels(cfg)], estimate_min_cards=estimate_min)
 
-        raw_scope = str(cfg.get("search_scope", "deck:*"))
-        scope = _normalize_search_scopes_multiline(raw_scope)
 
-        res = compute_tag_ratios(
-            col=col,
-            search_scope=scope,
-            tags=list(cfg.get("tags", [])),
-            tag_mode=str(cfg.get("tag_mode", "OR")).upper(),
-            min_cards=int(cfg.get("min_cards", 0)),
-            max_rows=int(cfg.get("max_rows", 30)),
-        )
+def _on_update_estimate(results: List[Dict[str, Any]]) -> None:
+    # 大きな scope のフル集計中。標本からの推定を先に出す（[] なら取り消し）
+    _ESTIMATES.clear()
+    for res in results:
+        _ESTIMATES[str(res.get("panel", ""))] = res
+    _refresh_main()
+    if _DLG is not None:
+        try:
+            _DLG.reload_from_cache()
+        except Exception:
+            pass
 
-        if not res:
-            tooltip("Tag Ratio: no data")
-            return
 
-        save_cache(res)
-        tooltip("Tag Ratio: updated")
-        _refresh_main()
+def _record_diagnostics(trace: Trace) -> None:
+    # cache の "diag" はワーカー側まで。保存・再描画まで含めた計測はこちらに残す
+    cfg = _cfg()
+    entry = trace.finish()
+    try:
+        keep = max(1, int(cfg.get("diagnostics_keep", 20)))
+    except Exception:
+        keep = 20
+    append_diagnostics(entry, keep)
+    if bool(cfg.get("debug_log", False)):
+        append_debug_log(format_entry(entry))
+
 
-        if _DLG is not None:
-            try:
-                _DLG.reload_from_cache()
-            except Exception:
-                pass
+def _on_update_result(results: List[Dict[str, Any]], trace: Trace) -> None:
+    _ESTIMATES.clear()
+    if not results:
+        tooltip("Tag Ratio: no data")
+        return
+
+    cfg = _cfg()
+    try:
+        max_entries = max(1, int(cfg.get("cache_max_entries", 32)))
+        max_bytes = max(1, int(cfg.get("cache_max_mb", 50))) * 1024 * 1024
+    except Exception:
+        max_entries, max_bytes = 32, 50 * 1024 * 1024
+
+    trace.mark("save_cache")
+    for res in results:
+        # キーはプロファイル + 結果の条件（パネル名ではない）
+        save_cache(res, max_entries, max_bytes)
+    trace.rows("save_cache", sum(len(res.get("rows") or []) for res in results))
+    tooltip("Tag Ratio: updated")
+    trace.mark("refresh")
+    _refresh_main()
+    try:
+        _record_diagnostics(trace)
+    except Exception:
+        pass
 
+    if _DLG is not None:
+        try:
+            _DLG.reload_from_cache()
+        except Exception:
+            pass
+
+
+def _on_update_error(e: Exception) -> None:
+    tooltip(f"Tag Ratio: update failed ({type(e).__name__})")
+    # 必要なら showInfo(str(e)) にしてもOK
+
+
+def _record_history(res: Dict[str, Any]) -> None:
+    """
+    ワーカースレッドで呼ばれる（QueryOp の中）。
+    履歴に追記し、show_trend なら1日1点の系列を res["trend"] に入れておく
+    （パネル描画のたびに履歴を読まないように、cache と一緒に保存される）。
+    """
+    cfg = _cfg()
+    if not res or not bool(cfg.get("history_enabled", True)):
+        return
+    path = history_path()
+    append_history(path, res)
+
+    if not bool(cfg.get("show_trend", False)):
+        return
+    try:
+        days = max(1, int(cfg.get("trend_days", 30)))
+    except Exception:
+        days = 30
+    series = daily_series(path, series_key(res), days, now=int(res.get("updated_at") or 0) or None)
+    res["trend"] = {
+        "days": days,
+        "series": {str(did): pts for did, pts in series.items()},
+    }
+
+
+_ENGINE = UpdateEngine(
+    build_params=_update_params,
+    on_result=_on_update_result,
+    on_error=_on_update_error,
+    after_compute=_record_history,
+    on_estimate=_on_update_estimate,
+)
+
+
+def _update_now() -> Optional[UpdateHandle]:
+    # 実際の計算はワーカー側。同じ条件で実行中ならその handle が返る
+    try:
+        return _ENGINE.request()
     except Exception as e:
-        tooltip(f"Tag Ratio: update failed ({type(e).__name__})")
-        # 必要なら showInfo(str(e)) にしてもOK
+        _on_update_error(e)
+        return None
+
+
+# 自動更新はここを通す（debounce・最短間隔・暇なときだけ・col.mod が変わったときだけ）
+_SCHEDULER = AutoUpdateScheduler(
+    run=_update_now,
+    get_cfg=_cfg,
+    busy=lambda: _ENGINE.running,
+)
+
 
 def _on_reviewer_will_close(reviewer) -> None:
     cfg = _cfg()
     if not bool(cfg.get("auto_update_on_reviewer_close", False)):
         return
-    # Reviewer closeはUIスレッドなので、同期_update_nowでOK
-    _update_now()
+    # すぐには動かさない。続けて復習に戻ったら1回にまとまる
+    _SCHEDULER.trigger("reviewer_close")
+
+
+def _on_profile_did_open() -> None:
+    _SCHEDULER.start()
+    if bool(_cfg().get("auto_update_on_profile_open", False)):
+        _SCHEDULER.trigger("profile_open")
+
+
+def _on_profile_will_close() -> None:
+    _SCHEDULER.stop()
 
 
 
@@ -254,8 +468,12 @@ def _on_webview_will_set_content(web_content, context) -> None:
     if not _is_main_context(context):
         return
 
-    cache = load_cache()
-    html = build_panel_html(cache, cfg)
+    html = ""
+    for i, p in enumerate(_panels(cfg)):
+        # 今のプロファイル・今の条件の cache だけを出す（切り替えてもすぐ出る）
+        cache = _panel_result(p)
+        # 2つ目以降のパネルは id を分ける（開閉スクリプトが混ざらないように）
+        html += build_panel_html(cache, p, version=cache_version(), panel_id=str(i) if i else "")
 
     try:
         web_content.body += html
@@ -263,6 +481,16 @@ def _on_webview_will_set_content(web_content, context) -> None:
         pass
 
 
+# --- デッキ名キャッシュの無効化（追加・改名・削除）---
+
+def _on_operation_did_execute(changes, handler) -> None:
+    try:
+        if getattr(changes, "deck", False):
+            invalidate_deck_names()
+    except Exception:
+        pass
+
+
 # --- pycmd handler（Update/Open dialog）---
 
 def _on_webview_did_receive_js_message(handled, message, context):
@@ -280,7 +508,7 @@ def _on_webview_did_receive_js_message(handled, message, context):
 
 def _setup_menu() -> None:
     a = QAction("Tag Ratio: Update now", mw)
-    a.triggered.connect(_update_now)  # type: ignore[attr-defined]
+    a.triggered.connect(lambda *_: _update_now())  # type: ignore[attr-defined]
     mw.form.menuTools.addAction(a)
 
     b = QAction("Tag Ratio: Open dialog", mw)
@@ -291,18 +519,34 @@ def _setup_menu() -> None:
 def init() -> None:
     _setup_menu()
 
+    # 色帯テーブルは起動時に1回だけ作っておく（以降は config 変更時のみ）
+    try:
+        bands_for_cfg(_cfg())
+    except Exception:
+        pass
+
     # Add-ons → Config でカスタムGUIを開く
     try:
-        mw.addonManager.setConfigAction(_addon_id(), lambda: ConfigDialog(parent=mw).exec())
+        mw.addonManager.setConfigAction(_addon_id(), lambda: ConfigDialog(parent=mw, normalize_scope=_normalize_search_scopes_multiline).exec())
     except Exception:
         try:
-            mw.addonManager.setConfigAction(__name__.split(".")[0], lambda: ConfigDialog(parent=mw).exec())
+            mw.addonManager.setConfigAction(__name__.split(".")[0], lambda: ConfigDialog(parent=mw, normalize_scope=_normalize_search_scopes_multiline).exec())
         except Exception:
             pass
 
     gui_hooks.webview_will_set_content.append(_on_webview_will_set_content)
     gui_hooks.webview_did_receive_js_message.append(_on_webview_did_receive_js_message)
 
+    try:
+        if hasattr(gui_hooks, "operation_did_execute"):
+            gui_hooks.operation_did_execute.append(_on_operation_did_execute)
+        gui_hooks.profile_did_open.append(invalidate_deck_names)
+        gui_hooks.profile_did_open.append(invalidate_search_cache)
+        gui_hooks.profile_did_open.append(_on_profile_did_open)
+        gui_hooks.profile_will_close.append(_on_profile_will_close)
+    except Exception:
+        pass
+
     # NEW: Auto update after study (Reviewer close)
     try:
         if hasattr(gui_hooks, "reviewer_will_close"):
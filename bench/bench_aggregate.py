@@ -0,0 +1,63 @@
+"""
+chunked（400件 IN (...) ×2クエリ）と aggregate（JSON 引数 + 1 GROUP BY）の比較。
+
+    python bench/bench_aggregate.py --cards 400000 --decks 500
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import load_addon_module, make_collection  # noqa: E402
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--cards", type=int, default=100_000)
+    ap.add_argument("--decks", type=int, default=200)
+    ap.add_argument("--tags", type=int, default=3)
+    ap.add_argument("--density", type=float, default=0.3)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument(
+        "--latency-us",
+        type=float,
+        default=0.0,
+        help="db 呼び出し1回あたりの擬似往復コスト（マイクロ秒）",
+    )
+    args = ap.parse_args()
+
+    service = load_addon_module("service")
+    col = make_collection(
+        cards=args.cards,
+        decks=args.decks,
+        tag_count=args.tags,
+        tag_density=args.density,
+        latency=args.latency_us / 1_000_000,
+    )
+    tags = [f"tag_{i}" for i in range(args.tags)]
+
+    results = {}
+    for strategy in ("chunked", "aggregate"):
+        best = float("inf")
+        for _ in range(args.repeat):
+            col.db.calls = 0
+            t0 = time.perf_counter()
+            res = service.compute_tag_ratios(
+                col, "deck:*", tags, "OR", strategy=strategy
+            )
+            best = min(best, time.perf_counter() - t0)
+        results[strategy] = res
+        print(f"{strategy:>10}: {best * 1000:9.1f} ms (best of {args.repeat}), {col.db.calls} db calls")
+
+    same = results["chunked"]["rows"] == results["aggregate"]["rows"]
+    print(f"results identical: {same}")
+    if not same:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
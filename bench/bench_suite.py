@@ -0,0 +1,252 @@
+"""
+合成コレクションで更新の各段階を測り、しきい値を超えたら失敗にする。
+
+    python bench/bench_suite.py --sizes 10000,100000,500000 --decks 500
+    python bench/bench_suite.py --sizes 2000000 --tags 8 --density 0.2 --json out.json
+
+段階ごとに、時間（perf_counter、best of --repeat）とピークメモリ（tracemalloc、
+Python ヒープのみ。SQLite 内部の確保は含まない）を出す。時間とメモリは別の実行で測る
+（tracemalloc を有効にすると時間が伸びるため）。
+
+しきい値は bench/thresholds.json（--thresholds で差し替え）:
+    {"段階名": {"ms_per_100k": 時間, "mb_per_100k": メモリ, "min_ms": 下限, "min_mb": 下限}}
+上限 = max(min, per_100k * カード数 / 100k)。1つでも超えたら REGRESSION を出して終了コード 1。
+cache の encode → decode で結果が元に戻らないときも同じく失敗にする。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import load_addon_module, make_collection  # noqa: E402
+
+_DEFAULT_THRESHOLDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "thresholds.json")
+
+# (段階名, 準備, 計測対象)。準備の戻り値が計測対象の引数になる（準備は測らない）
+Phase = tuple[str, Callable[[], Any], Callable[[Any], Any]]
+
+
+def _measure(setup: Callable[[], Any], run: Callable[[Any], Any], repeat: int) -> tuple[float, float]:
+    best = float("inf")
+    for _ in range(max(1, repeat)):
+        arg = setup()
+        t0 = time.perf_counter()
+        run(arg)
+        best = min(best, time.perf_counter() - t0)
+
+    arg = setup()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return best * 1000.0, max(0, peak) / (1024 * 1024)
+
+
+def _load_qt_model() -> Optional[Any]:
+    # ダイアログの表モデルは Qt（aqt.qt）が入っているときだけ測る
+    try:
+        import aqt.qt  # noqa: F401
+    except Exception:
+        return None
+    try:
+        return load_addon_module("ui.table_model")
+    except Exception:
+        return None
+
+
+def _phases(col, args: argparse.Namespace) -> list[Phase]:
+    service = load_addon_module("service")
+    render = load_addon_module("ui.render")
+    cache_format = load_addon_module("cache_format")
+    tag_index = load_addon_module("tag_index")
+    table_model = _load_qt_model()
+
+    tags = [f"tag_{i}" for i in range(args.tags)]
+    opts = dict(tag_breakdown=args.breakdown, deck_tree=args.deck_tree)
+    cfg = {"max_rows": 30, "sort_by": args.sort_by}
+    holder: dict[str, Any] = {}
+
+    def full(_: Any) -> None:
+        holder["res"] = service.compute_tag_ratios(col, "deck:*", tags, "OR", **opts)
+
+    def incremental(state: Any) -> None:
+        holder["res"], holder["state"] = service.compute_tag_ratios_incremental(
+            col, "deck:*", tags, "OR", state=state, **opts
+        )
+
+    def touch_cards() -> Any:
+        # 復習の代わり: 5% のデッキで 10% のカードの mod を進める
+        col.db.execute(
+            "UPDATE cards SET mod = (SELECT MAX(mod) FROM cards) + 1 WHERE did <= ? AND id % 10 = 0",
+            max(1, args.decks // 20),
+        )
+        col.db.execute("UPDATE col SET mod = mod + 1")
+        return holder["state"]
+
+    phases: list[Phase] = [
+        ("tag_index", lambda: tag_index.TagIndex(), lambda idx: idx.refresh(col)),
+        ("compute_full", lambda: None, full),
+        ("incremental_cold", lambda: None, incremental),
+        ("incremental_noop", lambda: holder["state"], incremental),
+        ("incremental_dirty", touch_cards, incremental),
+        ("encode_cache", lambda: holder["res"], lambda res: holder.__setitem__("blob", cache_format.encode_result(res))),
+        ("decode_cache", lambda: holder["blob"], cache_format.decode_result),
+        ("render_panel", lambda: holder["res"], lambda res: render._build_panel_html(res, cfg)),
+        (
+            "estimate_preview",
+            lambda: None,
+            lambda _: service.estimate_tag_ratios(col, "deck:*", tags, "OR", **opts),
+        ),
+    ]
+    if table_model is not None:
+        phases.append(
+            ("dialog_model", lambda: table_model.RatioTableModel(), lambda m: m.set_result(holder["res"]))
+        )
+    return phases
+
+
+def _check_cache_roundtrip(col, args: argparse.Namespace) -> list[str]:
+    """
+    encode_result → decode_result で結果が元に戻るか（計測はしない）。
+    親子の行（parent=None → -1）、tag_nums、note_*、長さの違う trend（NaN 埋め）、
+    列にならない行の項目（_row_extra）を全部含む結果で比べる。
+    """
+    service = load_addon_module("service")
+    cache_format = load_addon_module("cache_format")
+    tags = [f"tag_{i}" for i in range(args.tags)]
+    res = service.compute_tag_ratios(
+        col, "deck:*", tags, "OR", tag_breakdown=True, deck_tree=True, count_mode="both"
+    )
+    rows = res["rows"]
+    days = 7
+    series: dict[str, list[Optional[float]]] = {}
+    for i, r in enumerate(rows):
+        if i % 5 == 0:
+            continue  # 系列の無い行
+        pts: list[Optional[float]] = [round(r["pct"] - k * 0.3, 1) for k in range(days + 1)]
+        if i % 3 == 0:
+            pts[1] = None  # その日に無かった
+        if i % 4 == 0:
+            pts = pts[: days // 2]  # 短い系列（デコード後は None で埋まる）
+        series[str(r["did"])] = pts
+        if i % 7 == 0:
+            r["ci_lo"], r["ci_hi"] = 1.5, 98.5
+    res["trend"] = {"days": days, "series": series}
+
+    points = max(len(v) for v in series.values())
+    expected = dict(res)
+    expected["trend"] = {
+        "days": days,
+        "series": {k: list(v) + [None] * (points - len(v)) for k, v in series.items()},
+    }
+    got = cache_format.decode_result(cache_format.encode_result(res))
+
+    problems: list[str] = []
+    if got is None:
+        return ["decode_result returned None"]
+    for k in sorted(set(expected) | set(got)):
+        if k == "rows":
+            continue
+        if expected.get(k) != got.get(k):
+            problems.append(f"field {k!r} differs")
+    if len(got.get("rows") or []) != len(rows):
+        problems.append(f"row count {len(got.get('rows') or [])} != {len(rows)}")
+    else:
+        for a, b in zip(rows, got["rows"]):
+            if a != b:
+                problems.append(f"row did={a.get('did')} differs: {a} != {b}")
+                break
+    if not any(r.get("parent") is not None for r in rows) or not any("ci_lo" in r for r in rows):
+        problems.append("check result has no tree rows or no extra row fields")
+    return problems
+
+
+def _limit(th: dict[str, Any], key: str, cards: int) -> Optional[float]:
+    per = th.get(f"{key}_per_100k")
+    if per is None:
+        return None
+    return max(float(th.get(f"min_{key}", 0.0)), float(per) * cards / 100_000)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", default="10000,100000", help="カード数（カンマ区切り、10k〜2M）")
+    ap.add_argument("--decks", type=int, default=200)
+    ap.add_argument("--tags", type=int, default=3)
+    ap.add_argument("--density", type=float, default=0.3)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--breakdown", action="store_true", help="tag_breakdown=True で測る")
+    ap.add_argument("--deck-tree", action="store_true", help="deck_tree=True で測る")
+    ap.add_argument("--sort-by", default="pct")
+    ap.add_argument("--thresholds", default=_DEFAULT_THRESHOLDS)
+    ap.add_argument("--no-check", action="store_true", help="しきい値を見ない")
+    ap.add_argument("--json", help="結果を JSON で書き出す")
+    args = ap.parse_args()
+
+    thresholds: dict[str, Any] = {}
+    if not args.no_check:
+        with open(args.thresholds, "r", encoding="utf-8") as f:
+            thresholds = json.load(f)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    report: list[dict[str, Any]] = []
+    failures: list[str] = []
+
+    print(f"{'cards':>9} {'phase':<18} {'ms':>10} {'peak MB':>9} {'limit ms':>9} {'limit MB':>9}")
+    for cards in sizes:
+        t0 = time.perf_counter()
+        col = make_collection(
+            cards=cards, decks=args.decks, tag_count=args.tags, tag_density=args.density
+        )
+        print(f"{cards:>9} {'(generate)':<18} {(time.perf_counter() - t0) * 1000:>10.1f}")
+
+        for name, setup, run in _phases(col, args):
+            ms, mb = _measure(setup, run, args.repeat)
+            th = thresholds.get(name) or {}
+            lim_ms = _limit(th, "ms", cards)
+            lim_mb = _limit(th, "mb", cards)
+            status = []
+            if lim_ms is not None and ms > lim_ms:
+                status.append(f"time {ms:.1f} ms > {lim_ms:.1f} ms")
+            if lim_mb is not None and mb > lim_mb:
+                status.append(f"memory {mb:.1f} MB > {lim_mb:.1f} MB")
+            if status:
+                failures.append(f"{cards} cards / {name}: " + ", ".join(status))
+
+            print(
+                f"{cards:>9} {name:<18} {ms:>10.1f} {mb:>9.1f} "
+                f"{'' if lim_ms is None else f'{lim_ms:.0f}':>9} "
+                f"{'' if lim_mb is None else f'{lim_mb:.0f}':>9}"
+                f"{'  <-- REGRESSION' if status else ''}"
+            )
+            report.append({"cards": cards, "phase": name, "ms": ms, "peak_mb": mb})
+
+        # cache の往復（行の並び・値・trend まで同じに戻ること）
+        for problem in _check_cache_roundtrip(col, args):
+            failures.append(f"{cards} cards / cache round trip: {problem}")
+            print(f"{cards:>9} {'cache_roundtrip':<18} MISMATCH: {problem}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if failures:
+        print("\nREGRESSION: thresholds exceeded or cache round trip failed", file=sys.stderr)
+        for line in failures:
+            print(f"  {line}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+履歴（history.py）の差分記録と間引きが値を壊さないかを確かめる。
+
+    python bench/check_history.py --updates 400 --decks 40
+
+数か月分の更新（1日に数回、デッキの増減あり）を時刻つきで流し込み、
+そのたびに _compact で間引かれた後の値を、自前で持っている正解と比べる:
+  - values_at(最新) が直前に書いた値と同じ
+  - 残っているスナップショットの時刻での values_at が、その時刻の正解と同じ
+    （間引きで差分を次へ送るときの取りこぼし・上書きの向きの誤りを見つける）
+  - 変化のない更新は何も書かない
+食い違いがあれば MISMATCH を出して終了コード 1。
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import load_addon_module  # noqa: E402
+
+_DAY = 86400
+
+
+def _result(values: dict[int, tuple[int, int]], ts: int) -> dict:
+    rows = [{"did": did, "num": n, "den": d} for did, (n, d) in sorted(values.items())]
+    return {"search_scope": "deck:*", "tags": ["t"], "tag_mode": "OR", "updated_at": ts, "rows": rows}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", type=int, default=400)
+    ap.add_argument("--decks", type=int, default=40)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    history = load_addon_module("history")
+    rnd = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(), "history.sqlite3")
+
+    values: dict[int, tuple[int, int]] = {
+        did: (rnd.randint(0, 50), 50 + rnd.randint(0, 50)) for did in range(1, args.decks + 1)
+    }
+    truth: dict[int, dict[int, tuple[int, int]]] = {}  # 書いた時刻 -> その時点の値
+    ts = 1_700_000_000
+    failures = 0
+    key = history.series_key(_result(values, ts))
+
+    for i in range(args.updates):
+        # 1日に 0〜4 回の更新。ときどき数日あく
+        ts += rnd.choice((3600, 5 * 3600, 9 * 3600, _DAY, 3 * _DAY))
+        for did in rnd.sample(sorted(values), k=min(len(values), rnd.randint(0, 5))):
+            n, d = values[did]
+            values[did] = (min(d, n + rnd.randint(0, 3)), d + rnd.randint(0, 1))
+        if rnd.random() < 0.05 and len(values) > 1:
+            del values[rnd.choice(sorted(values))]  # デッキの削除（den = 0 の差分）
+        if rnd.random() < 0.05:
+            values[max(values, default=0) + 1] = (0, rnd.randint(1, 30))  # 新しいデッキ
+
+        wrote = history.append(path, _result(values, ts), ts=ts)
+        changed = not truth or truth[max(truth)] != values
+        if wrote != changed:
+            failures += 1
+            print(f"MISMATCH update {i}: wrote={wrote} but changed={changed}")
+        if wrote:
+            truth[ts] = dict(values)
+
+        got = history.values_at(path, key, ts)
+        if got != values:
+            failures += 1
+            print(f"MISMATCH update {i}: latest values differ ({len(got)} vs {len(values)} decks)")
+
+    # 間引き後に残ったスナップショットの時刻では、その時刻の正解が復元できること
+    conn = sqlite3.connect(path)
+    try:
+        kept = [int(t) for (t,) in conn.execute("SELECT ts FROM snapshots WHERE key = ? ORDER BY ts", (key,))]
+        deltas = int(conn.execute("SELECT COUNT(*) FROM deltas").fetchone()[0])
+    finally:
+        conn.close()
+    for t in kept:
+        if history.values_at(path, key, t) != truth[t]:
+            failures += 1
+            print(f"MISMATCH snapshot at {t}: replay differs from the values written then")
+
+    print(f"{args.updates} updates, {len(truth)} written, {len(kept)} snapshots kept, {deltas} deltas")
+    if failures:
+        sys.exit(1)
+    print("history replay: OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+差分更新（compute_panels_incremental）がフル再計算と同じ結果になるかを確かめる。
+
+    python bench/check_incremental.py --cards 10000 --decks 100 --steps 12
+
+合成コレクションに「復習 / タグの付け外し / カードの移動 / 削除 / 追加 / デッキの改名」を
+無作為に加え、そのたびに差分更新とフル再計算（state なし）を比べる。
+数え方（cards / notes / both）・deck_tree・tag_breakdown の組み合わせごとに回し、
+1つでも食い違ったら MISMATCH を出して終了コード 1。
+"""
+from __future__ import annotations
+
+import argparse
+import itertools
+import os
+import random
+import sys
+from typing import Any
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import load_addon_module, make_collection  # noqa: E402
+
+
+def _bump(col, table: str, where: str, *args: Any) -> None:
+    # mod は秒単位の watermark と同じ扱い（前回の最大値以上）にする
+    col.db.execute(f"UPDATE {table} SET mod = (SELECT MAX(mod) FROM {table}) + 1 WHERE {where}", *args)
+
+
+def _review(col, rnd: random.Random, decks: int) -> str:
+    did = rnd.randint(1, decks)
+    _bump(col, "cards", "did = ? AND id % 7 = ?", did, rnd.randint(0, 6))
+    return f"review deck {did}"
+
+
+def _retag(col, rnd: random.Random, tags: list[str]) -> str:
+    nids = col.db.list("SELECT id FROM notes ORDER BY random() LIMIT 40")
+    for nid in nids:
+        picked = [t for t in tags if rnd.random() < 0.5]
+        col.db.execute(
+            "UPDATE notes SET tags = ?, mod = (SELECT MAX(mod) FROM notes) + 1 WHERE id = ?",
+            (" " + " ".join(picked) + " ") if picked else "",
+            nid,
+        )
+    return f"retag {len(nids)} notes"
+
+
+def _move(col, rnd: random.Random, decks: int) -> str:
+    src, dst = rnd.randint(1, decks), rnd.randint(1, decks)
+    col.db.execute(
+        "UPDATE cards SET did = ?, mod = (SELECT MAX(mod) FROM cards) + 1 WHERE did = ? AND id % 5 = 0",
+        dst,
+        src,
+    )
+    return f"move deck {src} -> {dst}"
+
+
+def _delete(col, rnd: random.Random, decks: int) -> str:
+    # 削除は mod が残らない（デッキの総数だけが変わる）
+    did = rnd.randint(1, decks)
+    col.db.execute("DELETE FROM cards WHERE did = ? AND id % 3 = 0", did)
+    return f"delete from deck {did}"
+
+
+def _add(col, rnd: random.Random, decks: int) -> str:
+    did = rnd.randint(1, decks)
+    nid = int(col.db.scalar("SELECT MAX(id) FROM notes") or 0) + 1
+    cid = int(col.db.scalar("SELECT MAX(id) FROM cards") or 0) + 1
+    nmod = int(col.db.scalar("SELECT MAX(mod) FROM notes") or 0) + 1
+    cmod = int(col.db.scalar("SELECT MAX(mod) FROM cards") or 0) + 1
+    col.db.execute("INSERT INTO notes VALUES (?, ?, ?)", nid, nmod, " tag_0 ")
+    for i in range(3):
+        col.db.execute("INSERT INTO cards VALUES (?, ?, ?, ?)", cid + i, nid, did, cmod)
+    return f"add note to deck {did}"
+
+
+def _rename(col, rnd: random.Random, decks: int) -> str:
+    did = rnd.randint(1, decks)
+    parent = rnd.randint(0, max(0, decks // 10 - 1))
+    col.db.execute("UPDATE decks SET name = ? WHERE id = ?", f"Deck {parent:03d}::Moved {did}", did)
+    return f"rename deck {did}"
+
+
+def _same(a: dict[str, Any], b: dict[str, Any]) -> bool:
+    keys = ("rows", "totals")
+    return all(a.get(k) == b.get(k) for k in keys)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--cards", type=int, default=10_000)
+    ap.add_argument("--decks", type=int, default=100)
+    ap.add_argument("--tags", type=int, default=3)
+    ap.add_argument("--steps", type=int, default=12)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    service = load_addon_module("service")
+    diagnostics = load_addon_module("diagnostics")
+    tags = [f"tag_{i}" for i in range(args.tags)]
+
+    failures = 0
+    modes_seen: set[str] = set()
+    for count_mode, deck_tree, breakdown in itertools.product(
+        service.COUNT_MODES, (False, True), (False, True)
+    ):
+        rnd = random.Random(args.seed)
+        col = make_collection(cards=args.cards, decks=args.decks, tag_count=args.tags, seed=args.seed)
+        specs = [
+            service.panel_spec(
+                "deck:*", tags, "OR", tag_breakdown=breakdown, deck_tree=deck_tree, count_mode=count_mode
+            ),
+            # 2つ目のパネル（別のタグ・AND）も同じスキャンで数える
+            service.panel_spec("deck:*", tags[:2], "AND", count_mode=count_mode, name="and"),
+        ]
+        _, state = service.compute_panels_incremental(col, specs, None)
+        actions = [
+            lambda: _review(col, rnd, args.decks),
+            lambda: _retag(col, rnd, tags),
+            lambda: _move(col, rnd, args.decks),
+            lambda: _delete(col, rnd, args.decks),
+            lambda: _add(col, rnd, args.decks),
+            lambda: _rename(col, rnd, args.decks),
+        ]
+        label = f"count_mode={count_mode} deck_tree={deck_tree} breakdown={breakdown}"
+        for step in range(args.steps):
+            what = rnd.choice(actions)()
+            col.db.execute("UPDATE col SET mod = mod + 1")
+
+            trace = diagnostics.Trace()
+            inc, state = service.compute_panels_incremental(col, specs, state, trace=trace)
+            full, _ = service.compute_panels_incremental(col, specs, None)
+            modes_seen.add(str(trace.info.get("mode")))
+            for a, b in zip(inc, full):
+                if not _same(a, b):
+                    failures += 1
+                    print(f"MISMATCH {label} step {step} ({what}, mode={trace.info.get('mode')}) panel={a.get('panel')!r}")
+
+            # 変更なしの更新も同じ結果のまま
+            again, state = service.compute_panels_incremental(col, specs, state)
+            if not all(_same(a, b) for a, b in zip(again, full)):
+                failures += 1
+                print(f"MISMATCH {label} step {step} (unchanged after {what})")
+        print(f"{label}: {args.steps} steps checked")
+
+    print(f"modes exercised: {', '.join(sorted(modes_seen))}")
+    if "incremental" not in modes_seen:
+        print("MISMATCH: no step took the incremental path")
+        failures += 1
+    if failures:
+        sys.exit(1)
+    print("incremental == full: OK")
+
+
+if __name__ == "__main__":
+    main()
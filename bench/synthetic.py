@@ -0,0 +1,180 @@
+"""
+Anki なしで service.py を測るための合成コレクション。
+
+- SQLite に Anki と同じ形の cards / notes テーブルを作る（使う列だけ）
+- col.db / col.decks / col.find_cards の最小限を実装する
+- アドオン本体の __init__.py（aqt 依存）は読まずに、モジュール単体を import する
+"""
+from __future__ import annotations
+
+import importlib
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+import types
+from collections import namedtuple
+from typing import Any, Iterable, Sequence
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_PKG = "tag_ratio_panel"
+
+DeckNameId = namedtuple("DeckNameId", ["name", "id"])
+
+
+def load_addon_module(name: str):
+    """__init__.py を実行せずに tag_ratio_panel.<name> を import する。"""
+    if _PKG not in sys.modules:
+        pkg = types.ModuleType(_PKG)
+        pkg.__path__ = [ROOT]  # type: ignore[attr-defined]
+        sys.modules[_PKG] = pkg
+    return importlib.import_module(f"{_PKG}.{name}")
+
+
+class SqliteDB:
+    """
+    Anki の DBProxy 互換（all / list / scalar / first / execute / executemany）。
+
+    Anki では1回の db 呼び出しごとに Rust backend との往復が入る。
+    calls で往復回数を数え、latency（秒）を指定すると1回ごとにその分だけ待つ。
+    """
+
+    def __init__(self, conn: sqlite3.Connection, latency: float = 0.0) -> None:
+        self.conn = conn
+        self.latency = latency
+        self.calls = 0
+
+    def _run(self, sql: str, args: Sequence[Any]) -> sqlite3.Cursor:
+        self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self.conn.execute(sql, args)
+
+    def all(self, sql: str, *args: Any) -> list[list[Any]]:
+        return [list(r) for r in self._run(sql, args)]
+
+    def list(self, sql: str, *args: Any) -> list[Any]:
+        return [r[0] for r in self._run(sql, args)]
+
+    def first(self, sql: str, *args: Any) -> list[Any] | None:
+        r = self._run(sql, args).fetchone()
+        return list(r) if r is not None else None
+
+    def scalar(self, sql: str, *args: Any) -> Any:
+        r = self._run(sql, args).fetchone()
+        return r[0] if r is not None else None
+
+    def execute(self, sql: str, *args: Any) -> list[list[Any]]:
+        return [list(r) for r in self._run(sql, args)]
+
+    def executemany(self, sql: str, args: Iterable[Sequence[Any]]) -> None:
+        self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.conn.executemany(sql, args)
+
+
+class SqliteDecks:
+    def __init__(self, db: SqliteDB) -> None:
+        self.db = db
+
+    def name(self, did: int) -> str:
+        n = self.db.scalar("SELECT name FROM decks WHERE id = ?", int(did))
+        if n is None:
+            raise KeyError(did)
+        return str(n)
+
+    def get(self, did: int) -> dict[str, Any]:
+        return {"id": int(did), "name": self.name(did)}
+
+    def all_names_and_ids(self, **_kw: Any) -> list[DeckNameId]:
+        return [DeckNameId(str(n), int(i)) for i, n in self.db.all("SELECT id, name FROM decks")]
+
+
+_DID_RE = re.compile(r"\bdid:([\d,]+)")
+
+
+class SqliteCol:
+    """
+    find_cards は検索構文を解釈しない（= 常に全カード）。
+    例外として did:1,2,3 だけは絞り込みとして扱う。
+    """
+
+    def __init__(self, conn: sqlite3.Connection, latency: float = 0.0) -> None:
+        self.db = SqliteDB(conn, latency=latency)
+        self.decks = SqliteDecks(self.db)
+
+    def find_cards(self, query: str) -> list[int]:
+        m = _DID_RE.search(query or "")
+        if m:
+            dids = [int(x) for x in m.group(1).split(",") if x]
+            qmarks = ",".join("?" for _ in dids)
+            return self.db.list(f"SELECT id FROM cards WHERE did IN ({qmarks}) ORDER BY id", *dids)
+        return self.db.list("SELECT id FROM cards ORDER BY id")
+
+
+def make_collection(
+    cards: int = 100_000,
+    decks: int = 200,
+    tag_count: int = 5,
+    tag_density: float = 0.3,
+    cards_per_note: int = 2,
+    seed: int = 1,
+    path: str = ":memory:",
+    latency: float = 0.0,
+) -> SqliteCol:
+    """
+    cards 枚のカードを decks 個のデッキに散らす。
+    各ノートは tag_count 個のタグ候補それぞれを確率 tag_density で持つ。
+    """
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        """
+        CREATE TABLE col (id INTEGER PRIMARY KEY, mod INTEGER NOT NULL, scm INTEGER NOT NULL);
+        INSERT INTO col VALUES (1, 0, 0);
+        CREATE TABLE decks (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+        CREATE TABLE notes (id INTEGER PRIMARY KEY, mod INTEGER NOT NULL, tags TEXT NOT NULL);
+        CREATE TABLE cards (
+            id INTEGER PRIMARY KEY,
+            nid INTEGER NOT NULL,
+            did INTEGER NOT NULL,
+            mod INTEGER NOT NULL
+        );
+        CREATE INDEX ix_cards_nid ON cards (nid);
+        CREATE INDEX ix_cards_did ON cards (did);
+        """
+    )
+
+    # カードは "Deck NNN::Sub MM"（id 1..decks）にだけ入る。親デッキは id decks+1 以降
+    deck_rows = [(i + 1, f"Deck {i // 10:03d}::Sub {i % 10:02d}") for i in range(max(1, decks))]
+    parents = sorted({name.split("::")[0] for _, name in deck_rows})
+    conn.executemany("INSERT INTO decks VALUES (?, ?)", deck_rows)
+    conn.executemany(
+        "INSERT INTO decks VALUES (?, ?)",
+        [(len(deck_rows) + i + 1, name) for i, name in enumerate(parents)],
+    )
+
+    tag_names = [f"tag_{i}" for i in range(tag_count)]
+    note_rows = []
+    card_rows = []
+    cid = 1
+    nid = 1
+    while cid <= cards:
+        tags = [t for t in tag_names if rnd.random() < tag_density]
+        # mod は id と同じ（古い順）。差分更新の watermark が実際と同じように効く
+        note_rows.append((nid, nid, (" " + " ".join(tags) + " ") if tags else ""))
+        did = rnd.randint(1, len(deck_rows))
+        for _ in range(max(1, cards_per_note)):
+            if cid > cards:
+                break
+            card_rows.append((cid, nid, did, cid))
+            cid += 1
+        nid += 1
+
+    conn.executemany("INSERT INTO notes VALUES (?, ?, ?)", note_rows)
+    conn.executemany("INSERT INTO cards VALUES (?, ?, ?, ?)", card_rows)
+    conn.commit()
+    return SqliteCol(conn, latency=latency)
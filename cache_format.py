@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import json
+import math
+import struct
+import sys
+from array import array
+from typing import Any, Optional
+
+# 集計結果（compute_* の戻り値）のバイナリ表現。
+#
+#   MAGIC(4) | version(u16) | meta の長さ(u32) | meta(JSON, UTF-8) | 列ブロック...
+#
+# 行（rows）は列ごとの配列にする。did / num / den は int64、デッキ名は
+# "\0" 区切りの名前表（行と同じ並び）。pct / note_pct は num / den から作り直すので持たない。
+# trend の系列は行と同じ並びの float32（値なしは NaN）。
+# rows / trend 以外（totals / tags / updated_at など）は meta にそのまま入れる。
+# 数値はすべてリトルエンディアン。形式を変えたら FORMAT_VERSION を上げる。
+
+MAGIC = b"TRC\x00"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<4sHI")
+
+# 行の整数フィールド（無い行は 0、parent の None は -1）
+_INT_FIELDS = ("or_num", "and_num", "note_num", "note_den", "parent", "depth", "has_children")
+_NONE = -1
+
+
+def _pack(arr: array) -> bytes:
+    if sys.byteorder == "big":
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _unpack(typecode: str, buf: memoryview, pos: int, n: int) -> tuple[array, int]:
+    arr = array(typecode)
+    end = pos + n * arr.itemsize
+    if end > len(buf):
+        raise ValueError("truncated cache")
+    arr.frombytes(buf[pos:end])
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr, end
+
+
+def encode_result(res: dict[str, Any]) -> bytes:
+    rows = list(res.get("rows") or [])
+    n = len(rows)
+
+    # 各フィールドは全行に揃っているもの（compute 側でそう作っている）だけ列にする
+    int_fields = [f for f in _INT_FIELDS if n and all(f in r for r in rows)]
+    tag_width = len(rows[0].get("tag_nums") or []) if n and "tag_nums" in rows[0] else 0
+    known = {"did", "deck", "num", "den", "pct", "note_pct", "tag_nums", *int_fields}
+    extra = [{k: v for k, v in r.items() if k not in known} for r in rows]
+
+    meta = {k: v for k, v in res.items() if k not in ("rows", "trend")}
+    meta["_n"] = n
+    meta["_int_fields"] = int_fields
+    meta["_tag_width"] = tag_width if n and all("tag_nums" in r for r in rows) else -1
+    if any(extra):
+        meta["_row_extra"] = extra
+
+    trend = res.get("trend") or {}
+    series = trend.get("series") or {}
+    points = 0
+    if series:
+        points = max(len(v) for v in series.values())
+        meta["_trend_days"] = trend.get("days")
+        meta["_trend_points"] = points
+
+    names = "\0".join(str(r.get("deck", "")) for r in rows).encode("utf-8")
+    meta["_names_len"] = len(names)
+
+    blob = json.dumps(meta, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    parts = [_HEADER.pack(MAGIC, FORMAT_VERSION, len(blob)), blob, names]
+
+    parts.append(_pack(array("q", (int(r.get("did", 0)) for r in rows))))
+    parts.append(_pack(array("q", (int(r.get("num", 0)) for r in rows))))
+    parts.append(_pack(array("q", (int(r.get("den", 0)) for r in rows))))
+    for f in int_fields:
+        if f == "parent":
+            vals = (_NONE if r.get(f) is None else int(r[f]) for r in rows)
+        else:
+            vals = (int(r.get(f) or 0) for r in rows)
+        parts.append(_pack(array("q", vals)))
+    if meta["_tag_width"] > 0:
+        flat = array("q")
+        for r in rows:
+            flat.extend(int(x) for x in r.get("tag_nums") or [])
+        parts.append(_pack(flat))
+    if points:
+        # 行と同じ並びの float32。値が無い点と系列の無い行は NaN
+        flat_f = array("f")
+        nan = float("nan")
+        for r in rows:
+            pts = series.get(str(r.get("did"))) or []
+            pts = list(pts) + [None] * (points - len(pts))
+            flat_f.extend(nan if v is None else float(v) for v in pts)
+        parts.append(_pack(flat_f))
+
+    return b"".join(parts)
+
+
+def _pct(n: int, d: int) -> float:
+    return float(n / d * 100.0) if d else 0.0
+
+
+def decode_result(data: bytes) -> Optional[dict[str, Any]]:
+    """形式が違う・版が新しすぎる・壊れているときは None。"""
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, meta_len = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version > FORMAT_VERSION:
+        return None
+
+    try:
+        buf = memoryview(data)
+        pos = _HEADER.size
+        meta = json.loads(bytes(buf[pos : pos + meta_len]).decode("utf-8"))
+        pos += meta_len
+
+        n = int(meta.pop("_n"))
+        int_fields = list(meta.pop("_int_fields"))
+        tag_width = int(meta.pop("_tag_width"))
+        extra = meta.pop("_row_extra", None)
+        trend_days = meta.pop("_trend_days", None)
+        points = int(meta.pop("_trend_points", 0))
+        names_len = int(meta.pop("_names_len"))
+
+        names = bytes(buf[pos : pos + names_len]).decode("utf-8").split("\0") if n else []
+        pos += names_len
+        if len(names) != n:
+            return None
+
+        dids, pos = _unpack("q", buf, pos, n)
+        nums, pos = _unpack("q", buf, pos, n)
+        dens, pos = _unpack("q", buf, pos, n)
+        cols = {}
+        for f in int_fields:
+            cols[f], pos = _unpack("q", buf, pos, n)
+        tag_flat = None
+        if tag_width >= 0:
+            tag_flat, pos = _unpack("q", buf, pos, n * tag_width)
+        trend_flat = None
+        if points:
+            trend_flat, pos = _unpack("f", buf, pos, n * points)
+    except Exception:
+        return None
+
+    # 列ごとにまとめて行 dict へ流し込む（行ごとの分岐を減らす）
+    rows = [
+        {"did": did, "deck": name, "num": num, "den": den, "pct": _pct(num, den)}
+        for did, name, num, den in zip(dids, names, nums, dens)
+    ]
+    for f, col in cols.items():
+        if f == "parent":
+            for row, v in zip(rows, col):
+                row[f] = None if v == _NONE else v
+        elif f == "has_children":
+            for row, v in zip(rows, col):
+                row[f] = bool(v)
+        else:
+            for row, v in zip(rows, col):
+                row[f] = v
+    if "note_den" in cols:
+        for row in rows:
+            row["note_pct"] = _pct(row.get("note_num", 0), row["note_den"])
+    if tag_flat is not None:
+        tl = tag_flat.tolist()
+        for i, row in enumerate(rows):
+            row["tag_nums"] = tl[i * tag_width : (i + 1) * tag_width]
+    if extra:
+        for row, e in zip(rows, extra):
+            row.update(e)
+
+    res = dict(meta)
+    res["rows"] = rows
+    if trend_flat is not None:
+        series = {}
+        for i in range(n):
+            pts = trend_flat[i * points : (i + 1) * points]
+            if all(math.isnan(v) for v in pts):
+                continue
+            series[str(dids[i])] = [None if math.isnan(v) else round(v, 1) for v in pts]
+        res["trend"] = {"days": trend_days, "series": series}
+    return res
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import threading
+from typing import Any, Optional
+
+from .diagnostics import unwrap
+
+
+def _deck_pairs(col) -> list[tuple[int, str]]:
+    out: list[tuple[int, str]] = []
+    for d in col.decks.all_names_and_ids():
+        out.append((int(d.id), str(d.name)))
+    return out
+
+
+def deck_sort_key(name: str) -> tuple[str, ...]:
+    # "A::B" を ("a", "b") に。親の直後に子が並ぶ（Anki の Deck Browser と同じ順）
+    return tuple(p.casefold() for p in str(name).split("::"))
+
+
+class DeckTree:
+    """
+    col.decks の名前（"::" 区切り）から作る親子関係。
+    rollup は深い順に1回ずつ親へ足し込むだけなので O(decks)。
+    """
+
+    def __init__(self, pairs: list[tuple[int, str]]) -> None:
+        self.names: dict[int, str] = {}
+        self.parent: dict[int, Optional[int]] = {}
+        self.depth: dict[int, int] = {}
+
+        by_name: dict[str, int] = {}
+        for did, name in pairs:
+            self.names[did] = name
+            by_name[name] = did
+
+        for did, name in self.names.items():
+            pname = name.rsplit("::", 1)[0] if "::" in name else None
+            self.parent[did] = by_name.get(pname) if pname is not None else None
+            self.depth[did] = name.count("::")
+
+        # 深い順（子 → 親）
+        self.bottom_up: list[int] = sorted(self.names, key=lambda d: -self.depth[d])
+
+    def rollup(self, counts: dict[int, list[int]]) -> dict[int, list[int]]:
+        """
+        own（そのデッキ直属）のカウント列 → サブツリー合計のカウント列。
+        ツリーにない did（削除済み等）は自分だけの値で残す。
+        """
+        out: dict[int, list[int]] = {did: list(vec) for did, vec in counts.items()}
+        for did in self.bottom_up:
+            vec = out.get(did)
+            if vec is None:
+                continue
+            pid = self.parent.get(did)
+            if pid is None:
+                continue
+            pvec = out.get(pid)
+            if pvec is None:
+                out[pid] = list(vec)
+            else:
+                for i, v in enumerate(vec):
+                    pvec[i] += v
+        return out
+
+    def children_map(self, dids: Any) -> dict[int, list[int]]:
+        present = set(dids)
+        out: dict[int, list[int]] = {}
+        for did in present:
+            pid = self.parent.get(did)
+            if pid is not None and pid in present:
+                out.setdefault(pid, []).append(did)
+        return out
+
+
+class DeckNameCache:
+    """
+    did -> デッキ名 を all_names_and_ids() 1回でまとめて引き、使い回す。
+    - デッキの追加/改名（operation_did_execute の changes.deck）で invalidate
+    - コレクションが変わったら（プロファイル切替）取り直す
+    - 知らない did が来たら1回だけ取り直す（フック外で追加されたデッキ用）
+    DeckTree も同じ名前表から作って一緒に持つ。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._col_id: Optional[int] = None
+        self._names: Optional[dict[int, str]] = None
+        self._tree: Optional[DeckTree] = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._names = None
+            self._tree = None
+
+    def _load(self, col) -> dict[int, str]:
+        with self._lock:
+            if self._names is not None and self._col_id == id(unwrap(col)):
+                return self._names
+        pairs = _deck_pairs(col)
+        with self._lock:
+            self._col_id = id(unwrap(col))
+            self._names = dict(pairs)
+            self._tree = None
+            return self._names
+
+    def names(self, col) -> dict[int, str]:
+        return self._load(col)
+
+    def name(self, col, did: int) -> Optional[str]:
+        names = self._load(col)
+        if did in names:
+            return names[did]
+        self.invalidate()
+        return self._load(col).get(did)
+
+    def tree(self, col) -> DeckTree:
+        names = self._load(col)
+        with self._lock:
+            if self._tree is None:
+                self._tree = DeckTree(list(names.items()))
+            return self._tree
+
+
+_DECK_NAMES = DeckNameCache()
+
+
+def deck_names(col) -> dict[int, str]:
+    return _DECK_NAMES.names(col)
+
+
+def deck_name(col, did: int) -> Optional[str]:
+    return _DECK_NAMES.name(col, did)
+
+
+def deck_tree(col) -> DeckTree:
+    return _DECK_NAMES.tree(col)
+
+
+def invalidate_deck_names() -> None:
+    _DECK_NAMES.invalidate()
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Callable, Optional
+
+# 1回の更新の段階ごとの時間・行数・SQL 往復回数。
+#
+#   trace = Trace()
+#   col = trace.wrap(col)        # col.db の呼び出しと find_cards を数える
+#   trace("search", 0.0)         # Progress と同じ形。段階名が変わったら前の段階を閉じる
+#   trace.rows("search", len(cids))
+#   entry = trace.finish()       # JSON にできる dict（cache / 履歴 / ログ用）
+#
+# 同じ段階名に何度入っても合算する（パネルごとの build など）。
+# 計測は perf_counter だけ。段階の切れ目以外では何もしないので集計の速さは変わらない。
+
+
+def unwrap(col):
+    """Trace.wrap した col から元のコレクションを取る（id(col) で覚えるキャッシュ用）。"""
+    return getattr(col, "__wrapped__", col)
+
+
+class _TracedDB:
+    def __init__(self, db, trace: "Trace") -> None:
+        self._db = db
+        self._trace = trace
+
+    def all(self, *args: Any, **kwargs: Any) -> Any:
+        self._trace.sql += 1
+        return self._db.all(*args, **kwargs)
+
+    def list(self, *args: Any, **kwargs: Any) -> Any:
+        self._trace.sql += 1
+        return self._db.list(*args, **kwargs)
+
+    def first(self, *args: Any, **kwargs: Any) -> Any:
+        self._trace.sql += 1
+        return self._db.first(*args, **kwargs)
+
+    def scalar(self, *args: Any, **kwargs: Any) -> Any:
+        self._trace.sql += 1
+        return self._db.scalar(*args, **kwargs)
+
+    def execute(self, *args: Any, **kwargs: Any) -> Any:
+        self._trace.sql += 1
+        return self._db.execute(*args, **kwargs)
+
+    def executemany(self, *args: Any, **kwargs: Any) -> Any:
+        self._trace.sql += 1
+        return self._db.executemany(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._db, name)
+
+
+class _TracedCollection:
+    def __init__(self, col, trace: "Trace") -> None:
+        self.__wrapped__ = col
+        self.db = _TracedDB(col.db, trace)
+        self._trace = trace
+
+    def find_cards(self, *args: Any, **kwargs: Any) -> Any:
+        self._trace.searches += 1
+        return self.__wrapped__.find_cards(*args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.__wrapped__, name)
+
+
+class Trace:
+    """
+    段階ごとの計測。ワーカー（集計）→ UI スレッド（保存・再描画）の順に1本のスレッドずつ使う。
+    sql / searches は wrap した col を通った呼び出しの数（find_cards の memo に当たった分は数えない）。
+    """
+
+    def __init__(self) -> None:
+        self._t0 = time.perf_counter()
+        self._phases: dict[str, dict[str, Any]] = {}
+        self._cur: Optional[str] = None
+        self._cur_t = 0.0
+        self._cur_sql = 0
+        self.sql = 0
+        self.searches = 0
+        self.info: dict[str, Any] = {}
+
+    def wrap(self, col):
+        if isinstance(col, _TracedCollection):
+            return col
+        return _TracedCollection(col, self)
+
+    def __call__(self, phase: str, fraction: float = 0.0) -> None:
+        if phase != self._cur:
+            self.mark(phase)
+
+    def chain(self, progress: Optional[Callable[[str, float], None]]) -> Callable[[str, float], None]:
+        """progress の前に段階を記録する progress を返す。"""
+
+        def report(phase: str, fraction: float) -> None:
+            self(phase, fraction)
+            if progress is not None:
+                progress(phase, fraction)
+
+        return report
+
+    def _entry(self, phase: str) -> dict[str, Any]:
+        p = self._phases.get(phase)
+        if p is None:
+            p = self._phases[phase] = {"ms": 0.0, "rows": 0, "sql": 0}
+        return p
+
+    def mark(self, phase: str) -> None:
+        self.close()
+        self._entry(phase)
+        self._cur = phase
+        self._cur_t = time.perf_counter()
+        self._cur_sql = self.sql
+
+    def close(self) -> None:
+        """今の段階を閉じる（次の mark までの時間はどの段階にも入らない）。"""
+        if self._cur is None:
+            return
+        p = self._entry(self._cur)
+        p["ms"] += (time.perf_counter() - self._cur_t) * 1000.0
+        p["sql"] += self.sql - self._cur_sql
+        self._cur = None
+
+    def rows(self, phase: str, n: int) -> None:
+        self._entry(phase)["rows"] += int(n)
+
+    def summary(self) -> dict[str, Any]:
+        # 開いている段階は含めない（close してから呼ぶ）
+        out: dict[str, Any] = {
+            "at": int(time.time()),
+            "total_ms": round((time.perf_counter() - self._t0) * 1000.0, 1),
+            "sql": self.sql,
+            "searches": self.searches,
+            "phases": [
+                {"name": name, "ms": round(p["ms"], 1), "rows": p["rows"], "sql": p["sql"]}
+                for name, p in self._phases.items()
+            ],
+        }
+        out.update(self.info)
+        return out
+
+    def finish(self) -> dict[str, Any]:
+        self.close()
+        return self.summary()
+
+
+def format_entry(entry: dict[str, Any]) -> list[str]:
+    """ダイアログ / ログ用の行。1行目が概要、以降が段階ごと。"""
+    try:
+        at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(int(entry.get("at", 0))))
+    except Exception:
+        at = "?"
+    head = (
+        f"{at}  total {float(entry.get('total_ms', 0.0)):.0f} ms, "
+        f"{int(entry.get('sql', 0))} SQL, {int(entry.get('searches', 0))} searches"
+    )
+    extra = []
+    if entry.get("mode"):
+        extra.append(str(entry["mode"]))
+    if entry.get("strategy"):
+        extra.append(str(entry["strategy"]))
+    if entry.get("panels"):
+        extra.append(f"{int(entry['panels'])} panel(s)")
+    if extra:
+        head += "  [" + ", ".join(extra) + "]"
+
+    lines = [head]
+    for p in entry.get("phases") or []:
+        lines.append(
+            f"  {str(p.get('name', '')):<12} {float(p.get('ms', 0.0)):>9.1f} ms"
+            f" {int(p.get('rows', 0)):>9} rows {int(p.get('sql', 0)):>5} SQL"
+        )
+    return lines
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from aqt import mw
+from aqt.operations import QueryOp
+
+from .diagnostics import Trace
+from .service import UpdateCancelled, compute_panels_incremental
+from .store import load_state, save_state
+
+# 段階ごとの全体に対する範囲（progress の fraction をこの中に割り付ける）
+_PHASES = {
+    "check": (0.0, 0.05),
+    "tags": (0.05, 0.15),
+    "search": (0.15, 0.3),
+    "estimate": (0.3, 0.35),
+    "count": (0.35, 0.88),
+    "names": (0.88, 0.9),
+    "build": (0.9, 1.0),
+}
+
+# UI スレッドへ進み具合を送る間隔（段階が変わったときは必ず送る）
+_PROGRESS_INTERVAL = 0.1
+
+
+def _params_key(params: Dict[str, Any]) -> str:
+    try:
+        return json.dumps(params, sort_keys=True, default=str)
+    except Exception:
+        return repr(params)
+
+
+class UpdateHandle:
+    """
+    1回の更新要求の受け取り票。request() が返す。
+      - state: "pending"（順番待ち）/ "running" / "done" / "failed" / "cancelled"
+      - phase / fraction: 進み具合（UI スレッドで更新される）
+      - cancel(): 次の段階の切れ目で止める（途中の結果・state は保存しない）
+      - trace: 段階ごとの計測（diagnostics.Trace）。実行が始まったら入る
+    コールバックはすべて UI スレッドで呼ばれる。
+    """
+
+    def __init__(self, key: str, params: Dict[str, Any]) -> None:
+        self.key = key
+        self.params = params
+        self.state = "pending"
+        self.phase = ""
+        self.fraction = 0.0
+        self.results: Optional[List[Dict[str, Any]]] = None
+        self.error: Optional[Exception] = None
+        self.trace: Optional[Trace] = None
+        # 推定結果を一度でも渡したか（正確な結果が出ずに終わったら取り消す）
+        self.estimated = False
+        self._cancel = threading.Event()
+        self._done_cbs: List[Callable[["UpdateHandle"], None]] = []
+        self._progress_cbs: List[Callable[["UpdateHandle"], None]] = []
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self) -> None:
+        self._cancel.set()
+
+    def add_done_callback(self, cb: Callable[["UpdateHandle"], None]) -> None:
+        if self.done:
+            cb(self)
+        else:
+            self._done_cbs.append(cb)
+
+    def add_progress_callback(self, cb: Callable[["UpdateHandle"], None]) -> None:
+        self._progress_cbs.append(cb)
+
+    def _set_progress(self, phase: str, fraction: float) -> None:
+        if self.done:
+            return
+        self.phase = phase
+        self.fraction = fraction
+        for cb in list(self._progress_cbs):
+            try:
+                cb(self)
+            except Exception:
+                pass
+
+    def _finish(self, state: str) -> None:
+        self.state = state
+        if state == "done":
+            self.fraction = 1.0
+        cbs, self._done_cbs = self._done_cbs, []
+        self._progress_cbs = []
+        for cb in cbs:
+            try:
+                cb(self)
+            except Exception:
+                pass
+
+
+class UpdateEngine:
+    """
+    全パネルの集計（compute_panels_incremental）を QueryOp（コレクション操作）として
+    ワーカーで1回だけ実行する。差分 state の読み書きもワーカー側で行う。
+
+    - request() は UpdateHandle を返す（メニュー / pycmd / Reviewer close / ダイアログ共通）
+    - 同じ条件の更新が実行中なら、新しいジョブを作らずその handle を返す
+    - 条件が違えば、終了後に1回だけ実行する handle を返す（順番待ちは最新の条件1本だけ）
+    - 結果（パネルごとの dict のリスト）と Trace は UI スレッドの on_result に渡す
+      （保存・再描画とその計測は呼び出し側の責務）。その後で handle の done コールバック。
+    - ワーカー側の計測（集計・state 保存・after_compute）は各結果の "diag" に入れる
+    - on_estimate があれば、大きな scope のフル集計の前に標本からの推定結果を UI スレッドへ渡す
+      （params["estimate_min_cards"] 枚以上のとき）。正確な結果が出ないまま終わったら
+      （失敗・キャンセル）on_estimate([]) で取り消す
+    """
+
+    def __init__(
+        self,
+        build_params: Callable[[], Optional[Dict[str, Any]]],
+        on_result: Callable[[List[Dict[str, Any]], Trace], None],
+        on_error: Callable[[Exception], None],
+        after_compute: Optional[Callable[[Dict[str, Any]], None]] = None,
+        on_estimate: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+    ) -> None:
+        self._build_params = build_params
+        self._on_result = on_result
+        self._on_error = on_error
+        # ワーカー側で結果を受け取る追加処理（履歴の追記など）。失敗しても更新は止めない
+        self._after_compute = after_compute
+        self._on_estimate = on_estimate
+        self._current: Optional[UpdateHandle] = None
+        self._next: Optional[UpdateHandle] = None
+
+    @property
+    def running(self) -> bool:
+        return self._current is not None and not self._current.done
+
+    def request(self) -> Optional[UpdateHandle]:
+        params = self._build_params()
+        if params is None:
+            return None
+        key = _params_key(params)
+
+        if self.running:
+            cur = self._current
+            if cur is not None and cur.key == key and not cur.cancel_requested:
+                # 同じ条件で実行中 → 相乗り
+                return cur
+            if self._next is None or self._next.cancel_requested:
+                self._next = UpdateHandle(key, params)
+            else:
+                # 順番待ちは1本だけ。条件は最新のものに差し替える
+                self._next.key = key
+                self._next.params = params
+            return self._next
+
+        handle = UpdateHandle(key, params)
+        self._start(handle)
+        return handle
+
+    def _start(self, handle: UpdateHandle) -> None:
+        self._current = handle
+        handle.state = "running"
+        params = handle.params
+        trace = handle.trace = Trace()
+        last = {"phase": "", "t": 0.0}
+
+        def progress(phase: str, fraction: float) -> None:
+            # ワーカースレッド。キャンセルはここで効く
+            if handle.cancel_requested:
+                raise UpdateCancelled()
+            lo, hi = _PHASES.get(phase, (0.0, 1.0))
+            total = lo + (hi - lo) * max(0.0, min(1.0, fraction))
+            now = time.monotonic()
+            if phase == last["phase"] and now - last["t"] < _PROGRESS_INTERVAL:
+                return
+            last["phase"] = phase
+            last["t"] = now
+            mw.taskman.run_on_main(lambda: handle._set_progress(phase, total))
+
+        def estimate(results: List[Dict[str, Any]]) -> None:
+            # ワーカースレッド。表示は UI スレッドで（その時点で終わっていたら捨てる）
+            if handle.cancel_requested:
+                raise UpdateCancelled()
+            mw.taskman.run_on_main(lambda: self._estimate(handle, results))
+
+        # 0 なら推定は出さない
+        estimate_min = int(params.get("estimate_min_cards") or 0)
+
+        def op(col) -> List[Dict[str, Any]]:
+            results, state = compute_panels_incremental(
+                col=col,
+                panels=params["panels"],
+                state=load_state(),
+                progress=progress,
+                trace=trace,
+                on_estimate=estimate if self._on_estimate is not None and estimate_min > 0 else None,
+                estimate_min_cards=estimate_min,
+            )
+            trace.mark("state")
+            save_state(state)
+            if self._after_compute is not None:
+                trace.mark("history")
+                for res in results:
+                    try:
+                        self._after_compute(res)
+                    except Exception:
+                        pass
+            trace.close()
+            diag = trace.summary()
+            for res in results:
+                res["diag"] = diag
+            return results
+
+        QueryOp(
+            parent=mw,
+            op=op,
+            success=lambda results: self._success(handle, results),
+        ).failure(lambda err: self._failure(handle, err)).run_in_background()
+
+    def _finish(self) -> None:
+        nxt, self._next = self._next, None
+        if nxt is None:
+            return
+        if nxt.cancel_requested:
+            nxt._finish("cancelled")
+            return
+        self._start(nxt)
+
+    def _estimate(self, handle: UpdateHandle, results: List[Dict[str, Any]]) -> None:
+        if handle.done or self._on_estimate is None:
+            return
+        handle.estimated = True
+        try:
+            self._on_estimate(results)
+        except Exception:
+            pass
+
+    def _success(self, handle: UpdateHandle, results: List[Dict[str, Any]]) -> None:
+        handle.results = results
+        try:
+            self._on_result(results, handle.trace or Trace())
+        finally:
+            handle._finish("done")
+            self._finish()
+
+    def _failure(self, handle: UpdateHandle, err: Exception) -> None:
+        handle.error = err
+        try:
+            if handle.estimated and self._on_estimate is not None:
+                self._on_estimate([])
+            if not isinstance(err, UpdateCancelled):
+                self._on_error(err)
+        finally:
+            handle._finish("cancelled" if isinstance(err, UpdateCancelled) else "failed")
+            self._finish()
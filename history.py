@@ -0,0 +1,273 @@
+from __future__ import annotations
+
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+# 間引きの既定値
+#   - 直近 KEEP_ALL_DAYS 日: 更新ごとのスナップショットを全部残す
+#   - DAILY_DAYS 日まで: 1日1件（その日の最後）
+#   - それより古い: 1週1件（その週の最後）
+KEEP_ALL_DAYS = 7
+DAILY_DAYS = 90
+
+_DAY = 86400
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    ts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_snapshots_key_ts ON snapshots (key, ts);
+-- 前のスナップショットから変わったデッキだけ。den = 0 は「消えた」
+CREATE TABLE IF NOT EXISTS deltas (
+    snap INTEGER NOT NULL,
+    did INTEGER NOT NULL,
+    num INTEGER NOT NULL,
+    den INTEGER NOT NULL,
+    PRIMARY KEY (snap, did)
+) WITHOUT ROWID;
+-- 差分を作るための最新値（系列ごと）
+CREATE TABLE IF NOT EXISTS latest (
+    key TEXT NOT NULL,
+    did INTEGER NOT NULL,
+    num INTEGER NOT NULL,
+    den INTEGER NOT NULL,
+    PRIMARY KEY (key, did)
+) WITHOUT ROWID;
+"""
+
+_LOCK = threading.Lock()
+
+
+def series_key(res: dict[str, Any]) -> str:
+    """
+    集計条件（scope / タグ / 数え方 / 親デッキの行 / min_cards）ごとに別の系列にする。
+    条件を変えたら新しい系列になり、古い系列と混ざらない。
+    deck_tree と min_cards は行の集合を変えるので、パネルで違えば別の系列にする
+    （同じ系列に交互に書くと、親の行が毎回「消えた」「戻った」になる）。
+    """
+    ident: list[Any] = [
+        res.get("search_scope"),
+        list(res.get("tags") or []),
+        res.get("tag_mode"),
+        res.get("tag_match", "exact"),
+        res.get("count_mode", "cards"),
+    ]
+    # 既定値（親の行なし・min_cards 0）のときは前の版と同じキー（今までの履歴を使い続ける）
+    deck_tree = bool(res.get("deck_tree", False))
+    try:
+        min_cards = max(0, int(res.get("min_cards") or 0))
+    except Exception:
+        min_cards = 0
+    if deck_tree or min_cards:
+        ident += [deck_tree, min_cards]
+    raw = json.dumps(ident, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=5)
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _values(res: dict[str, Any]) -> dict[int, tuple[int, int]]:
+    out: dict[int, tuple[int, int]] = {}
+    for r in res.get("rows") or []:
+        try:
+            out[int(r["did"])] = (int(r.get("num", 0)), int(r.get("den", 0)))
+        except Exception:
+            continue
+    return out
+
+
+def append(path: str, res: dict[str, Any], ts: Optional[int] = None) -> bool:
+    """
+    結果を1スナップショットとして追記する（変わったデッキの行だけ）。
+    何も変わっていなければ何も書かない。戻り値は書いたかどうか。
+    """
+    key = series_key(res)
+    ts = int(ts if ts is not None else res.get("updated_at") or time.time())
+    cur = _values(res)
+
+    with _LOCK:
+        conn = _connect(path)
+        try:
+            with conn:
+                prev = {
+                    int(did): (int(n), int(d))
+                    for did, n, d in conn.execute(
+                        "SELECT did, num, den FROM latest WHERE key = ?", (key,)
+                    )
+                }
+                delta = [(did, n, d) for did, (n, d) in cur.items() if prev.get(did) != (n, d)]
+                delta += [(did, 0, 0) for did in prev if did not in cur]
+                if not delta:
+                    return False
+
+                snap = conn.execute(
+                    "INSERT INTO snapshots (key, ts) VALUES (?, ?)", (key, ts)
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO deltas (snap, did, num, den) VALUES (?, ?, ?, ?)",
+                    [(snap, did, n, d) for did, n, d in delta],
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO latest (key, did, num, den) VALUES (?, ?, ?, ?)",
+                    [(key, did, n, d) for did, n, d in delta if d],
+                )
+                conn.executemany(
+                    "DELETE FROM latest WHERE key = ? AND did = ?",
+                    [(key, did) for did, _n, d in delta if not d],
+                )
+                _compact(conn, key, ts)
+            return True
+        finally:
+            conn.close()
+
+
+def _bucket(ts: int, now: int) -> Optional[tuple[str, int]]:
+    """間引き用のバケット。None なら全件残す範囲。"""
+    age = now - ts
+    if age < KEEP_ALL_DAYS * _DAY:
+        return None
+    d = datetime.date.fromtimestamp(ts)
+    if age < DAILY_DAYS * _DAY:
+        return ("d", d.toordinal())
+    iso = d.isocalendar()
+    return ("w", iso[0] * 100 + iso[1])
+
+
+def _compact(conn: sqlite3.Connection, key: str, now: int) -> None:
+    """
+    バケットごとに最後のスナップショットだけ残す。
+    消すスナップショットの差分は次のスナップショットへ送る
+    （次が同じデッキの値を持っていればそちらが新しいので捨てる）。
+    """
+    snaps = conn.execute(
+        "SELECT id, ts FROM snapshots WHERE key = ? ORDER BY ts, id", (key,)
+    ).fetchall()
+
+    drop: list[tuple[int, int]] = []  # (消す id, 送り先 id)
+    for i in range(len(snaps) - 1):
+        sid, ts = snaps[i]
+        nid, nts = snaps[i + 1]
+        b = _bucket(ts, now)
+        if b is not None and b == _bucket(nts, now):
+            drop.append((sid, nid))
+
+    # 古い順に畳むので、連続して消えるものも最後に残る1件へ集まる
+    for sid, nid in drop:
+        conn.execute("UPDATE OR IGNORE deltas SET snap = ? WHERE snap = ?", (nid, sid))
+        conn.execute("DELETE FROM deltas WHERE snap = ?", (sid,))
+        conn.execute("DELETE FROM snapshots WHERE id = ?", (sid,))
+
+
+def values_at(path: str, key: str, ts: int) -> dict[int, tuple[int, int]]:
+    """時刻 ts 時点の did -> (num, den)。差分を古い順に重ねて復元する。"""
+    out: dict[int, tuple[int, int]] = {}
+    with _LOCK:
+        conn = _connect(path)
+        try:
+            for did, n, d in conn.execute(
+                """
+                SELECT d.did, d.num, d.den
+                FROM deltas d
+                JOIN snapshots s ON s.id = d.snap
+                WHERE s.key = ? AND s.ts <= ?
+                ORDER BY s.ts, s.id
+                """,
+                (key, int(ts)),
+            ):
+                if d:
+                    out[int(did)] = (int(n), int(d))
+                else:
+                    out.pop(int(did), None)
+        finally:
+            conn.close()
+    return out
+
+
+def change_since(
+    path: str, key: str, days: float, now: Optional[int] = None
+) -> dict[int, dict[str, Any]]:
+    """
+    直近 days 日の変化。did -> {num0, den0, pct0, num1, den1, pct1, delta_pct}
+    （0 が days 日前、1 が最新。days 日前に無かったデッキは num0 = den0 = 0）
+    """
+    now = int(now if now is not None else time.time())
+    old = values_at(path, key, now - int(days * _DAY))
+    new = values_at(path, key, now)
+
+    out: dict[int, dict[str, Any]] = {}
+    for did in set(old) | set(new):
+        n0, d0 = old.get(did, (0, 0))
+        n1, d1 = new.get(did, (0, 0))
+        p0 = (n0 / d0 * 100.0) if d0 else 0.0
+        p1 = (n1 / d1 * 100.0) if d1 else 0.0
+        out[did] = {
+            "num0": n0,
+            "den0": d0,
+            "pct0": p0,
+            "num1": n1,
+            "den1": d1,
+            "pct1": p1,
+            "delta_pct": p1 - p0,
+        }
+    return out
+
+
+def daily_series(
+    path: str, key: str, days: int, now: Optional[int] = None
+) -> dict[int, list[Optional[float]]]:
+    """
+    did -> 直近 days 日の1日1点の割合（%、古い順に days + 1 点）。
+    その時点で無かったデッキは None。最新時点にあるデッキだけ返す。
+    差分を1回だけ古い順に流し、日の境目ごとに値を拾う（O(差分 + days * デッキ数)）。
+    """
+    now = int(now if now is not None else time.time())
+    days = max(1, int(days))
+    marks = [now - (days - i) * _DAY for i in range(days + 1)]
+
+    cur: dict[int, tuple[int, int]] = {}
+    samples: list[dict[int, tuple[int, int]]] = []
+
+    with _LOCK:
+        conn = _connect(path)
+        try:
+            rows = conn.execute(
+                """
+                SELECT s.ts, d.did, d.num, d.den
+                FROM deltas d
+                JOIN snapshots s ON s.id = d.snap
+                WHERE s.key = ? AND s.ts <= ?
+                ORDER BY s.ts, s.id
+                """,
+                (key, now),
+            )
+            for ts, did, n, d in rows:
+                while len(samples) < len(marks) and ts > marks[len(samples)]:
+                    samples.append(dict(cur))
+                if d:
+                    cur[int(did)] = (int(n), int(d))
+                else:
+                    cur.pop(int(did), None)
+        finally:
+            conn.close()
+    while len(samples) < len(marks):
+        samples.append(dict(cur))
+
+    out: dict[int, list[Optional[float]]] = {}
+    for did in cur:
+        pts: list[Optional[float]] = []
+        for snap in samples:
+            v = snap.get(did)
+            pts.append(round(v[0] / v[1] * 100.0, 1) if v else None)
+        out[did] = pts
+    return out
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from aqt import mw
+from aqt.qt import QTimer
+
+# config に無いときの既定値
+_DEBOUNCE_SECONDS = 5
+_MIN_INTERVAL_SECONDS = 120
+
+# メイン画面が暇でなかったときに見直す間隔
+_IDLE_RETRY_MS = 3000
+
+# 「N 分ごと」の判定をする間隔
+_TICK_MS = 60_000
+
+# 暇とみなす画面（復習中・起動中・プロファイル選択中は待つ）
+_IDLE_STATES = ("deckBrowser", "overview")
+
+
+def _int_cfg(cfg: Dict[str, Any], key: str, default: int) -> int:
+    try:
+        return max(0, int(cfg.get(key, default)))
+    except Exception:
+        return default
+
+
+class AutoUpdateScheduler:
+    """
+    自動更新のきっかけ（Reviewer close / N 分ごと / プロファイルを開いたとき）をまとめて1回の更新にする。
+
+      - trigger(): 最後のきっかけから auto_update_debounce_seconds 秒たってから動く（連打は1回）
+      - 前回の自動更新から auto_update_min_interval_seconds 秒たっていなければ、その時刻まで延ばす
+      - 動く時点でメイン画面が暇（Deck Browser / Overview、モーダルなし、更新中でない）でなければ待つ
+      - col.mod と config が前回の自動更新のときと同じなら何もしない（学習せずに出入りしただけ等）
+
+    実際の更新は run（UpdateEngine.request）。手動の更新（メニュー / パネル / ダイアログ）はここを通らない。
+    タイマーはすべて UI スレッドの QTimer。
+    """
+
+    def __init__(
+        self,
+        run: Callable[[], Any],
+        get_cfg: Callable[[], Dict[str, Any]],
+        busy: Callable[[], bool],
+    ) -> None:
+        self._run = run
+        self._get_cfg = get_cfg
+        self._busy = busy
+        self._timer: Optional[QTimer] = None
+        self._tick: Optional[QTimer] = None
+        self._reasons: Set[str] = set()
+        self._last_run = 0.0
+        self._last_check = time.monotonic()
+        self._last_sig: Optional[Tuple[int, str]] = None
+
+    def start(self) -> None:
+        if self._timer is None:
+            self._timer = QTimer(mw)
+            self._timer.setSingleShot(True)
+            self._timer.timeout.connect(self._on_timer)  # type: ignore[attr-defined]
+        if self._tick is None:
+            self._tick = QTimer(mw)
+            self._tick.timeout.connect(self._on_tick)  # type: ignore[attr-defined]
+        self._last_check = time.monotonic()
+        self._tick.start(_TICK_MS)
+
+    def stop(self) -> None:
+        # プロファイルを閉じるとき。待っていたきっかけは捨てる（別プロファイルに持ち越さない）
+        self._reasons.clear()
+        self._last_sig = None
+        for t in (self._timer, self._tick):
+            if t is not None:
+                t.stop()
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._reasons)
+
+    def trigger(self, reason: str) -> None:
+        if self._timer is None:
+            self.start()
+        cfg = self._get_cfg()
+        self._reasons.add(reason)
+        self._schedule(_int_cfg(cfg, "auto_update_debounce_seconds", _DEBOUNCE_SECONDS) * 1000)
+
+    def _schedule(self, ms: float) -> None:
+        # 動いているタイマーは張り直す（= debounce）
+        if self._timer is not None:
+            self._timer.start(max(0, int(ms)))
+
+    def _signature(self, cfg: Dict[str, Any]) -> Optional[Tuple[int, str]]:
+        try:
+            col_mod = int(mw.col.mod)
+        except Exception:
+            return None
+        return (col_mod, json.dumps(cfg, sort_keys=True, default=str))
+
+    def _idle(self) -> bool:
+        if mw.col is None or self._busy():
+            return False
+        if getattr(mw, "state", "") not in _IDLE_STATES:
+            return False
+        try:
+            if mw.app.activeModalWidget() is not None:
+                return False
+        except Exception:
+            pass
+        return True
+
+    def _on_timer(self) -> None:
+        if not self._reasons:
+            return
+        cfg = self._get_cfg()
+        now = time.monotonic()
+
+        min_interval = _int_cfg(cfg, "auto_update_min_interval_seconds", _MIN_INTERVAL_SECONDS)
+        if self._last_run and now - self._last_run < min_interval:
+            self._schedule((min_interval - (now - self._last_run)) * 1000)
+            return
+        if not self._idle():
+            self._schedule(_IDLE_RETRY_MS)
+            return
+
+        self._reasons.clear()
+        self._last_check = now
+        sig = self._signature(cfg)
+        if sig is None or sig == self._last_sig:
+            return
+        self._last_sig = sig
+        self._last_run = now
+        self._run()
+
+    def _on_tick(self) -> None:
+        minutes = _int_cfg(self._get_cfg(), "auto_update_interval_minutes", 0)
+        if minutes <= 0 or self._reasons:
+            return
+        if time.monotonic() - self._last_check >= minutes * 60:
+            self.trigger("interval")
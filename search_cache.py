@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Optional
+
+from .diagnostics import unwrap
+
+# 覚えておく検索の数（パネル数 + ダイアログ分くらいあれば足りる）
+_MAX_ENTRIES = 16
+
+# 時間経過だけで結果が変わる検索語。col.mod が同じでも結果が変わるので覚えない
+_TIME_DEPENDENT_MARKERS = (
+    "is:due",
+    "is:learn",
+    "is:buried",
+    "prop:",
+    "rated:",
+    "added:",
+    "edited:",
+    "introduced:",
+    "resched:",
+)
+
+
+def is_time_dependent(query: str) -> bool:
+    lowered = (query or "").lower()
+    return any(m in lowered for m in _TIME_DEPENDENT_MARKERS)
+
+
+class FindCardsCache:
+    """
+    (検索文字列, col.mod, col.scm) -> find_cards の結果（array('q')、int64 で 8 byte/枚）。
+    コレクションが何も変わっていなければ同じ検索を Rust 側に投げ直さない。
+    繰り返しの更新・ダイアログからの更新・同じ scope の複数パネルで使い回す。
+    LRU で _MAX_ENTRIES 件まで。col.mod が進んだ古いエントリは使われないまま押し出される。
+    """
+
+    def __init__(self, max_entries: int = _MAX_ENTRIES) -> None:
+        self._lock = threading.Lock()
+        self._max = max_entries
+        self._entries: "OrderedDict[tuple, array]" = OrderedDict()
+        self._col_id: Optional[int] = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def find_cards(self, col, query: str) -> array:
+        """返り値は共有オブジェクトなので呼び出し側で書き換えないこと。"""
+        if is_time_dependent(query):
+            return array("q", col.find_cards(query))
+
+        col_mod, scm = col.db.first("SELECT mod, scm FROM col") or (0, 0)
+        key = (query, int(col_mod or 0), int(scm or 0))
+
+        with self._lock:
+            if self._col_id != id(unwrap(col)):
+                # プロファイル切替など。別コレクションの結果は捨てる
+                self._entries.clear()
+                self._col_id = id(unwrap(col))
+            hit = self._entries.get(key)
+            if hit is not None:
+                self._entries.move_to_end(key)
+                return hit
+
+        cids = array("q", col.find_cards(query))
+
+        with self._lock:
+            self._entries[key] = cids
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max:
+                self._entries.popitem(last=False)
+        return cids
+
+
+_FIND_CARDS = FindCardsCache()
+
+
+def find_cards(col, query: str) -> array:
+    return _FIND_CARDS.find_cards(col, query)
+
+
+def invalidate_search_cache() -> None:
+    _FIND_CARDS.invalidate()
@@ -1,17 +1,481 @@
 from __future__ import annotations
 
+import hashlib
+import heapq
+import json
+import math
+import random
 import time
-from collections import Counter
-from typing import Any
+from typing import Any, Callable, Sequence
 
+from .decks import deck_name, deck_names, deck_sort_key, deck_tree
+from .diagnostics import Trace
+from .search_cache import find_cards, is_time_dependent
+from .tag_index import tag_index
 
-def _chunks(ids: list[int], n: int = 400) -> list[list[int]]:
+
+def _chunks(ids: Sequence[int], n: int = 400) -> list[Sequence[int]]:
     return [ids[i : i + n] for i in range(0, len(ids), n)]
 
 
-def _like_escape(s: str) -> str:
-    # SQLite LIKE の % _ \ をエスケープ
-    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+# did -> 列ごとのカウント（列の並びは _columns の順）
+Counts = dict[int, list[int]]
+
+# 列の定義: (列名, 判定, ビット, 単位)
+#   判定は note のタグマスク m（tags[i] を持てば bit i）に対して
+#     "all"  : 常に数える（分母）
+#     "any"  : m & bits != 0
+#     "every": m & bits == bits
+#     "none" : 数えない（タグ指定なしの分子）
+#   単位は "card"（カード枚数）か "note"（デッキ内で nid を重複排除した数）
+Column = tuple[str, str, int, str]
+
+COUNT_MODES = ("cards", "notes", "both")
+
+# 進み具合の通知: progress(段階名, 0.0〜1.0)。
+# 呼ばれた側が UpdateCancelled を投げると、そこで集計をやめる（state も保存されない）
+Progress = Callable[[str, float], None]
+
+
+class UpdateCancelled(Exception):
+    pass
+
+
+def _report(progress: Progress | None, phase: str, fraction: float) -> None:
+    if progress is not None:
+        progress(phase, fraction)
+
+
+def _rows(trace: Trace | None, phase: str, n: int) -> None:
+    if trace is not None:
+        trace.rows(phase, n)
+
+
+# SQLite の INTEGER（64bit 符号付き）に収まるタグ数 / パネル数
+_MAX_MASK_TAGS = 62
+_MAX_PANELS = 62
+
+
+def _columns(
+    tags: list[str], tag_mode: str, breakdown: bool, count_mode: str = "cards"
+) -> list[Column]:
+    """
+    1回のスキャンで数える列。
+      den / num は常に。breakdown 時は or / and / タグごと（t0, t1, ...）も。
+      count_mode="notes" ならそれらをノート単位で、"both" ならカード単位に
+      ノート単位の nden / nnum を足す。
+    """
+    unit = "note" if count_mode == "notes" else "card"
+    full = (1 << len(tags)) - 1
+    num_kind = "none" if not tags else ("any" if tag_mode == "OR" else "every")
+
+    cols: list[Column] = [("den", "all", 0, unit), ("num", num_kind, full, unit)]
+
+    if breakdown and tags:
+        cols.append(("or", "any", full, unit))
+        cols.append(("and", "every", full, unit))
+        for i in range(len(tags)):
+            cols.append((f"t{i}", "any", 1 << i, unit))
+
+    if count_mode == "both":
+        cols.append(("nden", "all", 0, "note"))
+        cols.append(("nnum", num_kind, full, "note"))
+    return cols
+
+
+def _select_list(
+    columns: list[Column],
+    mask_sql: str,
+    nid_sql: str,
+    pmask_sql: str = "",
+    pbits: list[int] | None = None,
+) -> str:
+    """
+    pbits（複数パネル時）: 列 i はカードの所属パネルマスク（pmask_sql）に
+    pbits[i] が立っているときだけ数える。
+    """
+    exprs = []
+    for i, (_name, kind, bits, unit) in enumerate(columns):
+        if kind == "all":
+            cond = "1"
+        elif kind == "any":
+            cond = f"({mask_sql} & {bits}) != 0"
+        elif kind == "every":
+            cond = f"({mask_sql} & {bits}) = {bits}"
+        else:
+            exprs.append("0")
+            continue
+        if pbits is not None:
+            pcond = f"({pmask_sql} & {pbits[i]}) != 0"
+            cond = pcond if cond == "1" else f"{pcond} AND {cond}"
+
+        if unit == "note":
+            # 同じデッキ内の兄弟カード（cloze 等）は1ノートとして数える
+            if cond == "1":
+                exprs.append(f"COUNT(DISTINCT {nid_sql})")
+            else:
+                exprs.append(f"COUNT(DISTINCT CASE WHEN {cond} THEN {nid_sql} END)")
+        elif cond == "1":
+            exprs.append("COUNT(*)")
+        else:
+            exprs.append(f"SUM({cond})")
+    return ", ".join(exprs)
+
+
+def _hit(kind: str, bits: int, m: int) -> bool:
+    if kind == "all":
+        return True
+    if kind == "any":
+        return (m & bits) != 0
+    if kind == "every":
+        return (m & bits) == bits
+    return False
+
+
+def _add_rows(counts: Counts, rows: list[list[Any]], width: int) -> None:
+    for r in rows:
+        did = int(r[0])
+        vec = counts.get(did)
+        if vec is None:
+            vec = counts[did] = [0] * width
+        for i in range(width):
+            v = r[i + 1]
+            if v:
+                vec[i] += int(v)
+
+
+def _count_chunked(
+    col,
+    cids: list[int],
+    columns: list[Column],
+    masks: dict[int, int],
+    pmasks: dict[int, int] | None = None,
+    pbits: list[int] | None = None,
+    progress: Progress | None = None,
+) -> Counts:
+    """
+    400件ずつ IN (...) で (did, nid) を引き、タグ判定は Python 側でマスクを見る。
+    json_each が使えない環境・タグが多すぎてマスクが SQLite に載らないとき用。
+    ノート単位の列は (did, 列) ごとの nid 集合で重複排除する。
+    pmasks / pbits は複数パネル用（_select_list と同じ意味）。
+    """
+    counts: Counts = {}
+    seen: dict[tuple[int, int], set[int]] = {}
+    width = len(columns)
+
+    chunks = _chunks(cids)
+    for ci, chunk in enumerate(chunks):
+        _report(progress, "count", ci / len(chunks))
+        qmarks = ",".join("?" for _ in chunk)
+        for cid, did, nid in col.db.all(
+            f"SELECT id, did, nid FROM cards WHERE id IN ({qmarks})",
+            *chunk,
+        ):
+            did = int(did)
+            nid = int(nid)
+            m = masks.get(nid, 0)
+            pm = pmasks.get(int(cid), 0) if pmasks is not None else 0
+            vec = counts.get(did)
+            if vec is None:
+                vec = counts[did] = [0] * width
+            for i, (_name, kind, bits, unit) in enumerate(columns):
+                if pbits is not None and not (pm & pbits[i]):
+                    continue
+                if not _hit(kind, bits, m):
+                    continue
+                if unit == "note":
+                    s = seen.get((did, i))
+                    if s is None:
+                        s = seen[(did, i)] = set()
+                    if nid in s:
+                        continue
+                    s.add(nid)
+                vec[i] += 1
+
+    return counts
+
+
+def _count_aggregate(
+    col,
+    cids: list[int],
+    columns: list[Column],
+    masks: dict[int, int],
+    pmasks: dict[int, int] | None = None,
+    pbits: list[int] | None = None,
+) -> Counts:
+    """
+    scope の card id（と所属パネルのマスク）とタグ付きノートのマスクを JSON の引数で渡し、
+    全列を did ごとに1本の GROUP BY で数える（notes.tags の文字列は見ない）。
+    SELECT だけにする: Anki の DBProxy は SELECT 以外の文を「変更」とみなし、
+    undo と学習キューを捨てる（temp table への INSERT でも）。
+    """
+    counts: Counts = {}
+    select = _select_list(columns, "COALESCE(t.mask, 0)", "c.nid", "s.pmask", pbits)
+
+    # {card id: pmask} / {nid: mask}。dict なので重複した card id は1つになる
+    if pmasks is not None:
+        scope = {int(cid): int(pmasks.get(cid, 0)) for cid in cids}
+    else:
+        scope = {int(cid): 1 for cid in cids}
+    sep = (",", ":")
+    rows = col.db.all(
+        f"""SELECT c.did, {select}
+        FROM (SELECT CAST(key AS INTEGER) AS id, value AS pmask FROM json_each(?)) s
+        JOIN cards c ON c.id = s.id
+        LEFT JOIN (SELECT CAST(key AS INTEGER) AS nid, value AS mask FROM json_each(?)) t
+          ON t.nid = c.nid
+        GROUP BY c.did""",
+        json.dumps(scope, separators=sep),
+        json.dumps(masks, separators=sep),
+    )
+    _add_rows(counts, rows, len(columns))
+    return counts
+
+
+def _normalize_tags(tags: list[str], tag_mode: str) -> tuple[list[str], str]:
+    tags = [t.strip() for t in tags if t and t.strip()]
+    tag_mode = (tag_mode or "OR").upper()
+    if tag_mode not in ("OR", "AND"):
+        tag_mode = "OR"
+    return tags, tag_mode
+
+
+def _normalize_tag_match(tag_match: str) -> str:
+    tag_match = (tag_match or "exact").lower()
+    return tag_match if tag_match in ("exact", "hierarchical") else "exact"
+
+
+def _count(
+    col,
+    cids: list[int],
+    tags: list[str],
+    columns: list[Column],
+    strategy: str,
+    tag_match: str = "exact",
+) -> Counts:
+    if not cids:
+        return {}
+
+    # タグ条件はタグ索引（tag -> note id 集合）から作ったマスクで判定する
+    hierarchical = tag_match == "hierarchical"
+    masks = tag_index(col).masks(tags, hierarchical=hierarchical) if tags else {}
+    return _count_masks(col, cids, columns, masks, len(tags), strategy)
+
+
+def _count_masks(
+    col,
+    cids: list[int],
+    columns: list[Column],
+    masks: dict[int, int],
+    n_bits: int,
+    strategy: str,
+    pmasks: dict[int, int] | None = None,
+    pbits: list[int] | None = None,
+    progress: Progress | None = None,
+    trace: Trace | None = None,
+) -> Counts:
+    _report(progress, "count", 0.0)
+    info = trace.info if trace is not None else {}
+    if strategy == "chunked" or n_bits > _MAX_MASK_TAGS:
+        info["strategy"] = "chunked"
+        return _count_chunked(col, cids, columns, masks, pmasks, pbits, progress)
+    info["strategy"] = "aggregate"
+    if strategy == "aggregate":
+        return _count_aggregate(col, cids, columns, masks, pmasks, pbits)
+    try:
+        return _count_aggregate(col, cids, columns, masks, pmasks, pbits)
+    except UpdateCancelled:
+        raise
+    except Exception:
+        info["strategy"] = "chunked (fallback)"
+        return _count_chunked(col, cids, columns, masks, pmasks, pbits, progress)
+
+
+def _pct(n: int, d: int) -> float:
+    return float(n / d * 100.0) if d else 0.0
+
+
+def _deck_name(col, did: int) -> str:
+    # 通常は名前表（1回の all_names_and_ids）から。表にないときだけ個別に引く
+    try:
+        name = deck_name(col, did)
+        if name is not None:
+            return name
+    except Exception:
+        pass
+    try:
+        return col.decks.name(did)
+    except Exception:
+        return str(did)
+
+
+def _build_result(
+    col,
+    search_scope: str,
+    tags: list[str],
+    tag_mode: str,
+    counts: Counts,
+    names: list[str],
+    min_cards: int,
+    deck_tree_mode: bool = False,
+) -> dict[str, Any]:
+    """
+    rows は全件（名前順）。パネルの上位 k 件は select_rows で選ぶ。
+    deck_tree_mode=True なら、親デッキにサブツリー合計の行を足す（直属カードがなくても出る）。
+    各行に depth / parent / has_children が付く。
+    """
+    breakdown = "or" in names
+    both = "nden" in names
+    idx = {n: i for i, n in enumerate(names)}
+    tag_idx = [idx[f"t{i}"] for i in range(len(tags))] if breakdown else []
+
+    tree = deck_tree(col) if deck_tree_mode else None
+    view = tree.rollup(counts) if tree is not None else counts
+    try:
+        names_by_did = deck_names(col)
+    except Exception:
+        names_by_did = {}
+
+    rows = []
+    for did, vec in view.items():
+        dcnt = int(vec[idx["den"]])
+        if not dcnt or dcnt < min_cards:
+            continue
+        ncnt = int(vec[idx["num"]])
+
+        deck_label = names_by_did.get(did)
+        if deck_label is None:
+            deck_label = _deck_name(col, did)
+
+        row: dict[str, Any] = {
+            "did": did,
+            "deck": deck_label,
+            "num": ncnt,
+            "den": dcnt,
+            "pct": _pct(ncnt, dcnt),
+        }
+        if breakdown:
+            row["or_num"] = int(vec[idx["or"]])
+            row["and_num"] = int(vec[idx["and"]])
+            row["tag_nums"] = [int(vec[i]) for i in tag_idx]
+        if both:
+            nd, nn = int(vec[idx["nden"]]), int(vec[idx["nnum"]])
+            row["note_num"] = nn
+            row["note_den"] = nd
+            row["note_pct"] = _pct(nn, nd)
+        rows.append(row)
+
+    rows.sort(key=lambda r: (deck_sort_key(r.get("deck", "")), -int(r.get("den", 0))))
+
+    if tree is not None:
+        shown = {r["did"] for r in rows}
+        kids = tree.children_map(shown)
+        for r in rows:
+            pid = tree.parent.get(r["did"])
+            r["parent"] = pid if pid in shown else None
+            r["depth"] = tree.depth.get(r["did"], 0)
+            r["has_children"] = r["did"] in kids
+
+    # 合計は最上位の行だけ足す（親子を両方足すと二重計上になる）
+    totals = [0] * len(names)
+    for r in rows:
+        if r.get("parent") is not None:
+            continue
+        for i, v in enumerate(view[r["did"]]):
+            totals[i] += int(v)
+
+    total_den = totals[idx["den"]]
+    total_num = totals[idx["num"]]
+    out_totals: dict[str, Any] = {
+        "num": total_num,
+        "den": total_den,
+        "pct": _pct(total_num, total_den),
+    }
+    if breakdown:
+        out_totals["or_num"] = totals[idx["or"]]
+        out_totals["and_num"] = totals[idx["and"]]
+        out_totals["tag_nums"] = [totals[i] for i in tag_idx]
+    if both:
+        out_totals["note_num"] = totals[idx["nnum"]]
+        out_totals["note_den"] = totals[idx["nden"]]
+        out_totals["note_pct"] = _pct(totals[idx["nnum"]], totals[idx["nden"]])
+
+    return {
+        "updated_at": int(time.time()),
+        "search_scope": search_scope,
+        "tags": tags,
+        "tag_mode": tag_mode,
+        "tag_breakdown": breakdown,
+        "deck_tree": tree is not None,
+        "rows": rows,
+        "totals": out_totals,
+    }
+
+
+# ----------------------------
+# 表示用の行選択（上位 k 件）
+# ----------------------------
+
+SORT_MODES = ("name", "pct", "den", "gap")
+
+
+def _sort_key(sort_by: str):
+    """小さいほど「先に見せたい」になるキー。"""
+    if sort_by == "pct":
+        # カバー率が低い順（同率なら大きいデッキ優先）
+        return lambda r: (float(r.get("pct", 0.0)), -int(r.get("den", 0)), deck_sort_key(r.get("deck", "")))
+    if sort_by == "den":
+        # カード数が多い順
+        return lambda r: (-int(r.get("den", 0)), deck_sort_key(r.get("deck", "")))
+    if sort_by == "gap":
+        # 未タグ枚数（den - num）が多い順
+        return lambda r: (
+            -(int(r.get("den", 0)) - int(r.get("num", 0))),
+            deck_sort_key(r.get("deck", "")),
+        )
+    return lambda r: (deck_sort_key(r.get("deck", "")), -int(r.get("den", 0)))
+
+
+def _top(rows: list[dict[str, Any]], key, k: int) -> list[dict[str, Any]]:
+    if k <= 0 or k >= len(rows):
+        return sorted(rows, key=key)
+    # 全件ソートせずに上位 k 件だけ（O(n log k)）
+    return heapq.nsmallest(k, rows, key=key)
+
+
+def select_rows(
+    rows: list[dict[str, Any]], sort_by: str = "name", k: int = 0, tree: bool = False
+) -> list[dict[str, Any]]:
+    """
+    sort_by: "name" / "pct"（低い順）/ "den"（多い順）/ "gap"（den - num が多い順）
+    k <= 0 なら全件を並べ替えるだけ。
+
+    tree=True（deck_tree の結果）なら、最上位の行から k 件、各親の下の子も同じキーで
+    k 件ずつ選び、親 → 子の順に並べて返す。
+    """
+    key = _sort_key(sort_by if sort_by in SORT_MODES else "name")
+    if not tree:
+        return _top(list(rows), key, k)
+
+    by_did = {r.get("did"): r for r in rows}
+    kids: dict[Any, list[dict[str, Any]]] = {}
+    roots: list[dict[str, Any]] = []
+    for r in rows:
+        p = r.get("parent")
+        if p is not None and p in by_did:
+            kids.setdefault(p, []).append(r)
+        else:
+            roots.append(r)
+
+    out: list[dict[str, Any]] = []
+    stack = list(reversed(_top(roots, key, k)))
+    while stack:
+        r = stack.pop()
+        out.append(r)
+        ch = kids.get(r.get("did"))
+        if ch:
+            stack.extend(reversed(_top(ch, key, k)))
+    return out
 
 
 def compute_tag_ratios(
@@ -20,115 +484,641 @@ def compute_tag_ratios(
     tags: list[str],
     tag_mode: str = "OR",
     min_cards: int = 0,
-    max_rows: int = 30,
+    strategy: str = "auto",
+    tag_breakdown: bool = False,
+    deck_tree: bool = False,
+    tag_match: str = "exact",
+    count_mode: str = "cards",
+    trace: Trace | None = None,
+    on_estimate: Callable[[dict[str, Any]], None] | None = None,
+    estimate_min_cards: int = 100_000,
 ) -> dict[str, Any]:
     """
     母集団: col.find_cards(search_scope)
     分母: cards.id in scope を did ごとに count
     分子: scope かつ notes.tags が指定タグ条件を満たす cards を did ごとに count
-    """
-    tags = [t.strip() for t in tags if t and t.strip()]
-    tag_mode = (tag_mode or "OR").upper()
-    if tag_mode not in ("OR", "AND"):
-        tag_mode = "OR"
 
-    cids: list[int] = list(col.find_cards(search_scope))
-    updated_at = int(time.time())
+    strategy:
+      - "auto": JSON 引数 + 1クエリ集計。失敗したら chunked にフォールバック
+      - "aggregate": JSON 引数 + 1クエリ集計のみ
+      - "chunked": 旧方式（400件ずつ IN (...)）
 
-    if not cids:
-        return {
-            "updated_at": updated_at,
-            "search_scope": search_scope,
-            "tags": tags,
-            "tag_mode": tag_mode,
-            "rows": [],
-            "totals": {"num": 0, "den": 0, "pct": 0.0},
-        }
+    tag_breakdown=True なら同じスキャンでタグごとの数と OR / AND の数も返す
+    （rows[i]["tag_nums"] / ["or_num"] / ["and_num"]、並びは tags の順）。
 
-    den = Counter()  # did -> count
-    num = Counter()  # did -> count
+    deck_tree=True なら直属カードの集計を親デッキへ積み上げた行も返す（追加クエリなし）。
 
-    for chunk in _chunks(cids):
-        qmarks = ",".join("?" for _ in chunk)
+    rows は min_cards を満たす全デッキ。表示件数（max_rows）と並び順は select_rows で決める。
 
-        # 分母
-        for did, cnt in col.db.all(
-            f"SELECT did, COUNT(*) FROM cards WHERE id IN ({qmarks}) GROUP BY did",
-            *chunk,
-        ):
-            den[int(did)] += int(cnt)
-
-        # 分子（タグ条件なしなら 0 のまま）
-        if tags:
-            conds = []
-            params: list[Any] = []
-            for t in tags:
-                # tags はスペース区切りなので「前後にスペース」を付けて完全一致で探す
-                conds.append("instr(' ' || n.tags || ' ', ' ' || ? || ' ') > 0")
-                params.append(t)
-
-            if tag_mode == "OR":
-                tag_where = "(" + " OR ".join(conds) + ")"
-            else:
-                tag_where = "(" + " AND ".join(conds) + ")"
-
-            for did, cnt in col.db.all(
-                f"""
-                SELECT c.did, COUNT(*)
-                FROM cards c
-                JOIN notes n ON n.id = c.nid
-                WHERE c.id IN ({qmarks})
-                  AND {tag_where}
-                GROUP BY c.did
-                """,
-                *chunk,
-                *params,
-            ):
-                num[int(did)] += int(cnt)
+    タグは Anki と同じく大文字小文字を区別しない。"*" はワイルドカード（"topic::*"）。
+    tag_match="hierarchical" なら "topic" は "topic::..." の子孫タグにも当たる（Anki の tag: と同じ）。
 
-    rows = []
-    total_den = 0
-    total_num = 0
+    count_mode:
+      - "cards": カード枚数（従来どおり）
+      - "notes": ノート数。デッキ内の兄弟カード（cloze 6枚など）は1つと数える
+      - "both": num/den はカード枚数、note_num/note_den にノート数（同じスキャンで数える）
+      ノート数は「デッキごとに」重複排除する。複数デッキにカードがあるノートは
+      デッキごとに1回ずつ数えるので、親デッキの積み上げ・合計では重複しうる。
 
-    for did, dcnt in den.items():
-        if dcnt < min_cards:
-            continue
-        ncnt = int(num.get(did, 0))
-        pct = (ncnt / dcnt * 100.0) if dcnt else 0.0
-
-        # deck name
-        try:
-            deck_name = col.decks.name(did)
-        except Exception:
-            try:
-                deck = col.decks.get(did)
-                deck_name = deck.get("name", str(did))
-            except Exception:
-                deck_name = str(did)
-
-        rows.append(
-            {
-                "did": did,
-                "deck": deck_name,
-                "num": ncnt,
-                "den": int(dcnt),
-                "pct": float(pct),
-            }
+    trace を渡すと search / count / build の時間・行数・SQL 往復回数を記録する。
+
+    on_estimate（プログレッシブ）: scope が estimate_min_cards 枚以上なら、フル集計の前に
+    標本からの推定結果（estimate_tag_ratios と同じ形）を標本の小さい順に渡す。戻り値は正確な値。
+    """
+    if on_estimate is not None:
+        spec = panel_spec(
+            search_scope, tags, tag_mode, min_cards, tag_breakdown, deck_tree, tag_match, count_mode
         )
 
-        total_den += int(dcnt)
-        total_num += int(ncnt)
+        def emit(results: list[dict[str, Any]]) -> None:
+            est = results[0]
+            est.pop("panel", None)
+            on_estimate(est)
+
+        results, _state = compute_panels_incremental(
+            col,
+            [spec],
+            None,
+            strategy,
+            trace=trace,
+            on_estimate=emit,
+            estimate_min_cards=estimate_min_cards,
+        )
+        res = results[0]
+        res.pop("panel", None)
+        return res
+
+    tags, tag_mode = _normalize_tags(tags, tag_mode)
+    tag_match = _normalize_tag_match(tag_match)
+    count_mode = count_mode if count_mode in COUNT_MODES else "cards"
+    columns = _columns(tags, tag_mode, tag_breakdown, count_mode)
+    if trace is not None:
+        col = trace.wrap(col)
+        trace.info["mode"] = "full"
+
+    _report(trace, "search", 0.0)
+    cids = find_cards(col, search_scope)
+    _rows(trace, "search", len(cids))
+    _report(trace, "count", 0.0)
+    counts = _count(col, cids, tags, columns, strategy, tag_match)
+    _rows(trace, "count", len(counts))
+
+    _report(trace, "build", 0.0)
+    names = [c[0] for c in columns]
+    res = _build_result(
+        col, search_scope, tags, tag_mode, counts, names, min_cards, deck_tree
+    )
+    _rows(trace, "build", len(res["rows"]))
+    if trace is not None:
+        trace.close()
+    res["tag_match"] = tag_match
+    res["count_mode"] = count_mode
+    res["min_cards"] = int(min_cards or 0)
+    return res
+
+
+# ----------------------------
+# 差分更新（collection / cards / notes の mod を watermark にする）
+# ----------------------------
+
+# dirty なデッキがこの割合を超えたら差分をやめてフル再計算
+_MAX_DIRTY_RATIO = 0.5
+
 
-    rows.sort(key=lambda r: (str(r.get("deck", "")).casefold(), -int(r.get("den", 0))))
-    rows = rows[: max_rows if max_rows > 0 else len(rows)]
+def _state_key(
+    search_scope: str, tags: list[str], tag_mode: str, tag_match: str, columns: list[Column]
+) -> list[Any]:
+    # 列の定義（単位まで）が同じときだけ state のカウント列を使い回せる
+    return [search_scope, list(tags), tag_mode, tag_match, [list(c) for c in columns]]
 
-    total_pct = (total_num / total_den * 100.0) if total_den else 0.0
 
+def _col_marks(col) -> tuple[int, int]:
+    # col.mod / col.scm だけ（1行なので「変更なし」の判定はこれだけで済ませる）
+    col_mod, scm = col.db.first("SELECT mod, scm FROM col") or (0, 0)
+    return int(col_mod or 0), int(scm or 0)
+
+
+def _decks_fingerprint(col) -> str:
+    # デッキの改名・移動は cards / notes の mod を変えずに deck:X の対象を変える
+    pairs = sorted((int(d.id), str(d.name)) for d in col.decks.all_names_and_ids())
+    raw = json.dumps(pairs, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _watermarks(col, col_mod: int, scm: int) -> dict[str, Any]:
+    """
+    カウント前に取る。カウント中に入った変更は次回の差分で拾われる。
+    cards.mod / notes.mod は秒単位なので、次回は >= で比較する（同秒の取りこぼし防止）。
+    cards / notes を全部なめるので、col.mod が変わったときだけ呼ぶ。
+    """
     return {
-        "updated_at": updated_at,
+        "col_mod": col_mod,
+        "scm": scm,
+        "decks": _decks_fingerprint(col),
+        "card_mod": int(col.db.scalar("SELECT MAX(mod) FROM cards") or 0),
+        "note_mod": int(col.db.scalar("SELECT MAX(mod) FROM notes") or 0),
+        "deck_totals": {
+            int(did): int(cnt)
+            for did, cnt in col.db.all("SELECT did, COUNT(*) FROM cards GROUP BY did")
+        },
+    }
+
+
+def _dirty_decks(col, prev_wm: dict[str, Any], deck_totals: dict[int, int]) -> set[int]:
+    """
+    前回から数が変わりうるデッキ:
+      - mod が進んだカードのデッキ（移動先・復習・サスペンド等）
+      - mod が進んだノートのカードのデッキ（タグ変更）
+      - デッキ内カード総数が変わったデッキ（移動元・削除）
+    """
+    dirty: set[int] = set()
+    for (did,) in col.db.all(
+        "SELECT DISTINCT did FROM cards WHERE mod >= ?", int(prev_wm.get("card_mod", 0))
+    ):
+        dirty.add(int(did))
+    for (did,) in col.db.all(
+        """
+        SELECT DISTINCT c.did
+        FROM notes n
+        JOIN cards c ON c.nid = n.id
+        WHERE n.mod >= ?
+        """,
+        int(prev_wm.get("note_mod", 0)),
+    ):
+        dirty.add(int(did))
+
+    prev_totals = {int(k): int(v) for k, v in (prev_wm.get("deck_totals") or {}).items()}
+    for did in set(prev_totals) | set(deck_totals):
+        if prev_totals.get(did, 0) != deck_totals.get(did, 0):
+            dirty.add(did)
+    return dirty
+
+
+def _counts_from_json(d: Any, width: int) -> Counts:
+    out: Counts = {}
+    if isinstance(d, dict):
+        for k, v in d.items():
+            if isinstance(v, list) and len(v) == width:
+                out[int(k)] = [int(x) for x in v]
+    return out
+
+
+def panel_spec(
+    search_scope: str,
+    tags: list[str],
+    tag_mode: str = "OR",
+    min_cards: int = 0,
+    tag_breakdown: bool = False,
+    deck_tree: bool = False,
+    tag_match: str = "exact",
+    count_mode: str = "cards",
+    name: str = "",
+) -> dict[str, Any]:
+    """パネル1つ分の集計条件（正規化済み）。compute_panels_incremental に渡す。"""
+    tags, tag_mode = _normalize_tags(list(tags or []), tag_mode)
+    count_mode = count_mode if count_mode in COUNT_MODES else "cards"
+    return {
+        "name": str(name or ""),
         "search_scope": search_scope,
         "tags": tags,
         "tag_mode": tag_mode,
-        "rows": rows,
-        "totals": {"num": total_num, "den": total_den, "pct": float(total_pct)},
+        "tag_match": _normalize_tag_match(tag_match),
+        "count_mode": count_mode,
+        "min_cards": int(min_cards or 0),
+        "deck_tree": bool(deck_tree),
+        # 結果の tag_breakdown と同じ値（タグが無ければ内訳は作らない）
+        "tag_breakdown": bool(tag_breakdown) and bool(tags),
+        "columns": _columns(tags, tag_mode, tag_breakdown, count_mode),
+    }
+
+
+def _panel_layout(
+    specs: list[dict[str, Any]],
+) -> tuple[list[str], list[str], list[Column], list[int], list[tuple[int, int]]]:
+    """
+    全パネルの列を1本のカウント列に並べる。
+      - タグパターンは全パネルで1つのマスクにまとめる（同じパターンは同じビット）
+        exact のパターンが先、hierarchical のパターンが後ろのビット
+      - 列 i は pbits[i]（そのパネルのビット）が立ったカードだけ数える
+      - slices[j] はパネル j の列の範囲
+    """
+    exact: list[str] = []
+    hier: list[str] = []
+    for sp in specs:
+        pats = hier if sp["tag_match"] == "hierarchical" else exact
+        for t in sp["tags"]:
+            if t.casefold() not in [p.casefold() for p in pats]:
+                pats.append(t)
+    bit_of: dict[tuple[str, bool], int] = {}
+    for i, t in enumerate(exact):
+        bit_of[(t.casefold(), False)] = i
+    for i, t in enumerate(hier):
+        bit_of[(t.casefold(), True)] = len(exact) + i
+
+    columns: list[Column] = []
+    pbits: list[int] = []
+    slices: list[tuple[int, int]] = []
+    for j, sp in enumerate(specs):
+        hierarchical = sp["tag_match"] == "hierarchical"
+        local = [1 << bit_of[(t.casefold(), hierarchical)] for t in sp["tags"]]
+        start = len(columns)
+        for name, kind, bits, unit in sp["columns"]:
+            gbits = 0
+            for i, b in enumerate(local):
+                if bits & (1 << i):
+                    gbits |= b
+            columns.append((name, kind, gbits, unit))
+            pbits.append(1 << j)
+        slices.append((start, len(columns)))
+    return exact, hier, columns, pbits, slices
+
+
+def _panel_masks(col, exact: list[str], hier: list[str]) -> dict[int, int]:
+    if not exact and not hier:
+        return {}
+    idx = tag_index(col)
+    out = idx.masks(exact, hierarchical=False) if exact else {}
+    if hier:
+        shift = len(exact)
+        for nid, m in idx.masks(hier, hierarchical=True).items():
+            out[nid] = out.get(nid, 0) | (m << shift)
+    return out
+
+
+def _panel_scopes(col, specs: list[dict[str, Any]], extra: str = "") -> dict[int, int]:
+    """card id -> 所属パネルのマスク。同じ scope の find_cards は1回だけ。"""
+    pmasks: dict[int, int] = {}
+    by_query: dict[str, int] = {}
+    for j, sp in enumerate(specs):
+        q = f"({sp['search_scope']}) {extra}" if extra else sp["search_scope"]
+        by_query[q] = by_query.get(q, 0) | (1 << j)
+    for q, bits in by_query.items():
+        for cid in col.find_cards(q) if extra else find_cards(col, q):
+            pmasks[cid] = pmasks.get(cid, 0) | bits
+    return pmasks
+
+
+def _count_panels(
+    col,
+    specs: list[dict[str, Any]],
+    strategy: str,
+    extra: str = "",
+    progress: Progress | None = None,
+    trace: Trace | None = None,
+    estimate: Callable[[Sequence[int], dict[int, int] | None, dict[int, int]], None] | None = None,
+) -> Counts:
+    """
+    全パネルを1回のスキャンで数える。戻りのカウント列は _panel_layout の並び。
+    estimate(card id, pmasks, タグマスク) は検索のあと、フル集計の前に呼ぶ（標本からの推定用）。
+    """
+    exact, hier, columns, pbits, _slices = _panel_layout(specs)
+    _report(progress, "tags", 0.0)
+    masks = _panel_masks(col, exact, hier)
+    _rows(trace, "tags", len(masks))
+    n_bits = len(exact) + len(hier)
+    _report(progress, "search", 0.0)
+
+    if len(specs) == 1:
+        # パネル1つならパネルマスクは要らない（従来と同じクエリ）
+        q = f"({specs[0]['search_scope']}) {extra}" if extra else specs[0]["search_scope"]
+        # 差分（did: 付き）の検索は一度きりなので覚えない
+        cids = col.find_cards(q) if extra else find_cards(col, q)
+        _rows(trace, "search", len(cids))
+        if not cids:
+            return {}
+        if estimate is not None:
+            estimate(cids, None, masks)
+        return _count_masks(
+            col, cids, columns, masks, n_bits, strategy, progress=progress, trace=trace
+        )
+
+    pmasks = _panel_scopes(col, specs, extra)
+    _rows(trace, "search", len(pmasks))
+    if not pmasks:
+        return {}
+    ids = list(pmasks)
+    if estimate is not None:
+        estimate(ids, pmasks, masks)
+    return _count_masks(
+        col, ids, columns, masks, n_bits, strategy, pmasks, pbits, progress, trace
+    )
+
+
+def _panel_results(
+    col,
+    specs: list[dict[str, Any]],
+    slices: list[tuple[int, int]],
+    counts: Counts,
+    min_scale: float = 1.0,
+) -> list[dict[str, Any]]:
+    """カウント列（_panel_layout の並び）をパネルごとの結果にする。"""
+    results: list[dict[str, Any]] = []
+    for sp, (a, b) in zip(specs, slices):
+        sub = {did: vec[a:b] for did, vec in counts.items()}
+        res = _build_result(
+            col,
+            sp["search_scope"],
+            sp["tags"],
+            sp["tag_mode"],
+            sub,
+            [c[0] for c in sp["columns"]],
+            int(math.ceil(sp["min_cards"] * min_scale)),
+            sp["deck_tree"],
+        )
+        res["tag_match"] = sp["tag_match"]
+        res["count_mode"] = sp["count_mode"]
+        res["min_cards"] = sp["min_cards"]
+        res["panel"] = sp["name"]
+        results.append(res)
+    return results
+
+
+# ----------------------------
+# 標本からの推定（大きな scope のプログレッシブ表示・設定画面のプレビュー）
+# ----------------------------
+
+# 推定に使う標本の大きさ。小さい順に出して、最後にフル集計の正確な値で置き換える
+ESTIMATE_STEPS = (2_000, 20_000)
+
+# 95% 信頼区間
+_Z = 1.96
+
+
+def wilson_interval(x: int, n: int, z: float = _Z) -> tuple[float, float]:
+    """x / n の Wilson スコア区間（%）。n が 0 なら (0, 100)。"""
+    if n <= 0:
+        return 0.0, 100.0
+    p = min(max(x / n, 0.0), 1.0)
+    z2 = z * z
+    denom = 1.0 + z2 / n
+    center = (p + z2 / (2 * n)) / denom
+    half = z * math.sqrt(p * (1 - p) / n + z2 / (4 * n * n)) / denom
+    return max(0.0, center - half) * 100.0, min(1.0, center + half) * 100.0
+
+
+def _estimate_steps(population: int, steps: Sequence[int] = ESTIMATE_STEPS) -> list[int]:
+    # 母集団の 1/4 を超える標本はフル集計とあまり変わらないので出さない
+    return [n for n in steps if 0 < n * 4 <= population]
+
+
+def _scale_estimate(res: dict[str, Any], population: int, sample: int) -> None:
+    """
+    標本の数（カード単位）を母集団の推定値（× population / sample）に置き換え、
+    各行と合計に ci_lo / ci_hi（pct の 95% 区間、標本の num / den から）を付ける。
+    pct は標本の比率のまま。
+    """
+    f = population / sample if sample else 0.0
+
+    def scale(d: dict[str, Any]) -> None:
+        d["ci_lo"], d["ci_hi"] = wilson_interval(int(d.get("num", 0)), int(d.get("den", 0)))
+        for k in ("num", "den", "or_num", "and_num"):
+            if k in d:
+                d[k] = int(round(int(d[k]) * f))
+        if "tag_nums" in d:
+            d["tag_nums"] = [int(round(int(v) * f)) for v in d["tag_nums"]]
+
+    for r in res["rows"]:
+        scale(r)
+    scale(res["totals"])
+    res["estimate"] = {"sample": sample, "population": population}
+
+
+def _estimate_panels(
+    col,
+    specs: list[dict[str, Any]],
+    cids: Sequence[int],
+    pmasks: dict[int, int] | None,
+    masks: dict[int, int],
+    size: int,
+    rng: random.Random,
+) -> list[dict[str, Any]]:
+    """
+    scope（複数パネルなら和集合）から size 枚を無作為に取り、その数から各パネルを推定する。
+    標本は少ないので chunked（IN (...)）で数える（タグ付きノート全部を JSON にしない）。
+    count_mode に関係なくカード枚数で推定する（結果の count_mode は "cards"）。
+    """
+    # ノートの数はカードの標本から拡大できない（兄弟カードが標本に揃わない）ので、推定はカード単位
+    specs = [
+        dict(
+            sp,
+            count_mode="cards",
+            columns=_columns(sp["tags"], sp["tag_mode"], sp["tag_breakdown"], "cards"),
+        )
+        for sp in specs
+    ]
+    _exact, _hier, columns, pbits, slices = _panel_layout(specs)
+    sample = rng.sample(cids, size)
+    if pmasks is None:
+        pops, sizes = [len(cids)], [len(sample)]
+        counts = _count_chunked(col, sample, columns, masks)
+    else:
+        pops = [0] * len(specs)
+        sizes = [0] * len(specs)
+        for j in range(len(specs)):
+            bit = 1 << j
+            pops[j] = sum(1 for m in pmasks.values() if m & bit)
+            sizes[j] = sum(1 for cid in sample if pmasks.get(cid, 0) & bit)
+        counts = _count_chunked(col, sample, columns, masks, pmasks, pbits)
+
+    results = []
+    for res, pop, n in zip(
+        _panel_results(col, specs, slices, counts, min_scale=size / max(1, len(cids))),
+        pops,
+        sizes,
+    ):
+        _scale_estimate(res, pop, n)
+        results.append(res)
+    return results
+
+
+def estimate_tag_ratios(
+    col,
+    search_scope: str,
+    tags: list[str],
+    tag_mode: str = "OR",
+    min_cards: int = 0,
+    sample_size: int = ESTIMATE_STEPS[0],
+    tag_breakdown: bool = False,
+    deck_tree: bool = False,
+    tag_match: str = "exact",
+    count_mode: str = "cards",
+    seed: int | None = None,
+) -> dict[str, Any]:
+    """
+    compute_tag_ratios の速い近似。scope から sample_size 枚だけ数えて推定する。
+    結果の形は compute_tag_ratios と同じで、数は推定値、各行に ci_lo / ci_hi（95% 区間の %）、
+    res["estimate"] = {"sample", "population"} が付く。
+    scope が sample_size 以下なら全部数える（estimate は付かない、正確な値）。
+    """
+    spec = panel_spec(
+        search_scope, tags, tag_mode, min_cards, tag_breakdown, deck_tree, tag_match, count_mode
+    )
+    exact, hier, columns, _pbits, slices = _panel_layout([spec])
+    cids = find_cards(col, spec["search_scope"])
+    masks = _panel_masks(col, exact, hier)
+
+    if len(cids) <= max(1, sample_size):
+        counts = _count_chunked(col, cids, columns, masks) if cids else {}
+        res = _panel_results(col, [spec], slices, counts)[0]
+    else:
+        res = _estimate_panels(col, [spec], cids, None, masks, sample_size, random.Random(seed))[0]
+    res.pop("panel", None)
+    return res
+
+
+def compute_panels_incremental(
+    col,
+    panels: list[dict[str, Any]],
+    state: dict[str, Any] | None = None,
+    strategy: str = "auto",
+    progress: Progress | None = None,
+    trace: Trace | None = None,
+    on_estimate: Callable[[list[dict[str, Any]]], None] | None = None,
+    estimate_min_cards: int = 100_000,
+) -> tuple[list[dict[str, Any]], dict[str, Any]]:
+    """
+    複数パネル（panel_spec のリスト）をまとめて差分更新する。戻り値は (結果のリスト, state)。
+    progress は段階の切れ目（と chunked の1塊ごと）に呼ぶ。UpdateCancelled で中断できる。
+    trace を渡すと段階ごとの時間・行数・SQL 往復回数を記録する（trace.info に mode なども）。
+
+    on_estimate: フル集計になり、scope が estimate_min_cards 枚以上のとき、
+    フル集計の前に ESTIMATE_STEPS の標本からの推定結果（パネルごとのリスト）を順に渡す。
+    戻り値（正確な値）はいつもと同じ。差分更新・変更なしのときは呼ばない（すぐ終わるので）。
+
+    全パネルの scope の和集合を1回だけ数える。カードごとに所属パネルのマスクを持たせ、
+    各パネルの列は自分のビットが立ったカードだけを数える（パネル数ぶん集計し直さない）。
+    差分の判定（watermark / dirty デッキ）はパネルに関係なくコレクション単位で1回。
+    """
+    specs = list(panels)[:_MAX_PANELS]
+    if trace is not None:
+        col = trace.wrap(col)
+        progress = trace.chain(progress)
+        trace.info["panels"] = len(specs)
+    _exact, _hier, columns, _pbits, slices = _panel_layout(specs)
+    width = len(columns)
+    key = [
+        _state_key(sp["search_scope"], sp["tags"], sp["tag_mode"], sp["tag_match"], sp["columns"])
+        for sp in specs
+    ]
+    _report(progress, "check", 0.0)
+    col_mod, scm = _col_marks(col)
+
+    prev = state if isinstance(state, dict) else {}
+    prev_wm = prev.get("wm") if isinstance(prev.get("wm"), dict) else None
+
+    full = (
+        prev_wm is None
+        or prev.get("key") != key
+        or int(prev_wm.get("scm", -1)) != scm
+        # 時間依存の scope は col.mod が同じでも結果が変わるので毎回フル再計算
+        or any(is_time_dependent(sp["search_scope"]) for sp in specs)
+    )
+
+    counts: Counts = {}
+    mode = "full"
+    if not full and int(prev_wm.get("col_mod", -1)) == col_mod:
+        # 何も変わっていない: watermark も取り直さない（cards / notes をなめない）
+        wm = prev_wm
+        counts = _counts_from_json(prev.get("counts"), width)
+        mode = "unchanged"
+    else:
+        wm = _watermarks(col, col_mod, scm)
+        # デッキの改名・移動があったら、どのデッキが deck:X に入るかが変わるのでフル
+        if prev_wm is not None and prev_wm.get("decks") != wm["decks"]:
+            full = True
+    if not full and mode != "unchanged":
+        dirty = _dirty_decks(col, prev_wm, wm["deck_totals"])
+        _rows(trace, "check", len(dirty))
+        if len(dirty) > max(1, len(wm["deck_totals"])) * _MAX_DIRTY_RATIO:
+            full = True
+        else:
+            mode = "incremental"
+            counts = _counts_from_json(prev.get("counts"), width)
+            if dirty:
+                for did in dirty:
+                    counts.pop(did, None)
+                ids = ",".join(str(d) for d in sorted(dirty))
+                # did: は子デッキを含まないが、念のため dirty 以外は捨てる
+                for did, vec in _count_panels(
+                    col, specs, strategy, f"did:{ids}", progress, trace
+                ).items():
+                    if did in dirty:
+                        counts[did] = vec
+
+    def estimate(cids: Sequence[int], pmasks: dict[int, int] | None, masks: dict[int, int]) -> None:
+        if on_estimate is None or len(cids) < max(1, estimate_min_cards):
+            return
+        steps = _estimate_steps(len(cids))
+        rng = random.Random()
+        for i, size in enumerate(steps):
+            _report(progress, "estimate", i / len(steps))
+            on_estimate(_estimate_panels(col, specs, cids, pmasks, masks, size, rng))
+        _rows(trace, "estimate", sum(steps))
+
+    if full:
+        counts = _count_panels(
+            col,
+            specs,
+            strategy,
+            progress=progress,
+            trace=trace,
+            estimate=estimate if on_estimate is not None else None,
+        )
+    if trace is not None:
+        trace.info["mode"] = mode
+    _rows(trace, "count", len(counts))
+
+    # デッキ名（と親子関係）は全パネル共通。先に1回だけ引いておく
+    _report(progress, "names", 0.0)
+    try:
+        names_by_did = deck_names(col)
+        if any(sp["deck_tree"] for sp in specs):
+            deck_tree(col)
+        _rows(trace, "names", len(names_by_did))
+    except Exception:
+        pass
+
+    _report(progress, "build", 0.0)
+    # state は直属カードの集計のまま持つ（積み上げは毎回やり直しても O(decks)）
+    results = _panel_results(col, specs, slices, counts)
+    _rows(trace, "build", sum(len(res["rows"]) for res in results))
+
+    new_state = {
+        "key": key,
+        "wm": wm,
+        "counts": {str(did): vec for did, vec in counts.items() if any(vec)},
     }
+    _report(progress, "build", 1.0)
+    return results, new_state
+
+
+def compute_tag_ratios_incremental(
+    col,
+    search_scope: str,
+    tags: list[str],
+    tag_mode: str = "OR",
+    min_cards: int = 0,
+    state: dict[str, Any] | None = None,
+    strategy: str = "auto",
+    tag_breakdown: bool = False,
+    deck_tree: bool = False,
+    tag_match: str = "exact",
+    count_mode: str = "cards",
+) -> tuple[dict[str, Any], dict[str, Any]]:
+    """
+    compute_tag_ratios の差分版。戻り値は (結果, 次回用 state)。
+
+    state には did ごとのカウント列と watermark（col.mod / cards.mod / notes.mod /
+    デッキごとのカード総数 / デッキ名の指紋）を持つ。
+      - col.mod が同じ → 何も変わっていないので state をそのまま使う
+      - それ以外 → dirty なデッキだけ find_cards し直して差し替える
+      - scope/タグ/スキーマが変わった・デッキの改名や移動・時間依存の scope・
+        dirty が多すぎる → フル再計算
+    """
+    spec = panel_spec(
+        search_scope, tags, tag_mode, min_cards, tag_breakdown, deck_tree, tag_match, count_mode
+    )
+    results, new_state = compute_panels_incremental(col, [spec], state, strategy)
+    res = results[0]
+    res.pop("panel", None)
+    return res, new_state
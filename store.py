@@ -1,39 +1,121 @@
 from __future__ import annotations
 
+import hashlib
 import json
 import os
-from typing import Any, Dict
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 from aqt import mw
 
+from .cache_format import decode_result, encode_result
+
+
+_USER_FILES_DIR: Optional[str] = None
+
 
 def _user_files_dir() -> str:
-    addon_dir = os.path.dirname(__file__)
-    d = os.path.join(addon_dir, "user_files")
+    global _USER_FILES_DIR
+    if _USER_FILES_DIR is None:
+        addon_dir = os.path.dirname(__file__)
+        d = os.path.join(addon_dir, "user_files")
+        os.makedirs(d, exist_ok=True)
+        _USER_FILES_DIR = d
+    return _USER_FILES_DIR
+
+
+def current_profile() -> str:
+    try:
+        return str(mw.pm.name or "")
+    except Exception:
+        return ""
+
+
+def _profile_hash(profile: str) -> str:
+    return hashlib.sha1(profile.encode("utf-8")).hexdigest()[:12]
+
+
+# 結果を変える条件（panel_spec と集計結果の両方にある）。ここが同じなら同じ cache を使う
+_KEY_FIELDS = (
+    "search_scope",
+    "tags",
+    "tag_mode",
+    "tag_match",
+    "count_mode",
+    "tag_breakdown",
+    "deck_tree",
+    "min_cards",
+)
+
+
+def cache_key(desc: Dict[str, Any], profile: Optional[str] = None) -> str:
+    """
+    desc: panel_spec か集計結果（どちらから作っても同じキーになる）。
+    プロファイル名 + 条件のハッシュ。パネル名は入れない（同じ条件のパネルは同じ結果）。
+    """
+    prof = current_profile() if profile is None else profile
+    ident = [prof] + [desc.get(k) for k in _KEY_FIELDS]
+    raw = json.dumps(ident, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+def _cache_dir() -> str:
+    d = os.path.join(_user_files_dir(), "cache")
     os.makedirs(d, exist_ok=True)
     return d
 
 
-def _cache_path() -> str:
-    return os.path.join(_user_files_dir(), "tag_ratio_cache.json")
+def _entry_path(key: str) -> str:
+    return os.path.join(_cache_dir(), key + ".bin")
+
+
+def _index_path() -> str:
+    # key -> {"used": 最後に使った時刻, "size": バイト数}（LRU の追い出し用）
+    return os.path.join(_cache_dir(), "index.json")
+
+
+def _state_path() -> str:
+    # 差分更新用（did ごとの分母・分子 + watermark）。プロファイルごと
+    name = f"tag_ratio_state.{_profile_hash(current_profile())}.json"
+    return os.path.join(_user_files_dir(), name)
+
 
+def history_path() -> str:
+    # 比率の時系列（SQLite、スナップショット間の差分だけを持つ）。プロファイルごと
+    name = f"tag_ratio_history.{_profile_hash(current_profile())}.sqlite3"
+    return os.path.join(_user_files_dir(), name)
 
-def load_cache() -> Dict[str, Any]:
-    path = _cache_path()
+
+def _diagnostics_path() -> str:
+    # 直近の更新の計測（新しい順、diagnostics_keep 件まで）
+    return os.path.join(_user_files_dir(), "tag_ratio_diagnostics.json")
+
+
+def _debug_log_path() -> str:
+    return os.path.join(_user_files_dir(), "tag_ratio_debug.log")
+
+
+# デバッグログがこれを超えたら .1 に回して新しく書く（1世代だけ残す）
+_DEBUG_LOG_MAX_BYTES = 1024 * 1024
+
+
+def _read_json(path: str) -> Dict[str, Any]:
     try:
         with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
     except Exception:
         return {}
 
 
-def save_cache(data: Dict[str, Any]) -> None:
-    path = _cache_path()
+def _write_json(path: str, data: Dict[str, Any], indent: int | None = 2) -> bool:
     tmp = path + ".tmp"
     try:
         with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+            json.dump(data, f, ensure_ascii=False, indent=indent)
         os.replace(tmp, path)
+        return True
     except Exception:
         # 最悪は無視（骨組みなので）
         try:
@@ -41,3 +123,198 @@ def save_cache(data: Dict[str, Any]) -> None:
                 os.remove(tmp)
         except Exception:
             pass
+        return False
+
+
+def _read_bin(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    return decode_result(data)
+
+
+def _write_bin(path: str, data: Dict[str, Any]) -> bool:
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(encode_result(data))
+        os.replace(tmp, path)
+        return True
+    except Exception:
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        except Exception:
+            pass
+        return False
+
+
+def _file_sig(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+# 既定の上限（save_cache の引数で変えられる）
+_MAX_ENTRIES = 32
+_MAX_BYTES = 50 * 1024 * 1024
+
+
+class _MemoryCache:
+    """
+    cache 本体。キー（cache_key: プロファイル + 条件）ごとに cache/<key>.bin を1つ持つ。
+    - 読み: ファイルの (mtime, size) が前回と同じならデコード済み dict をそのまま返す
+      （プロファイル切替・条件の切替で戻ってきたときも読み直さない）
+    - 書き: cache_format のバイナリ形式で tmp → replace（原子的に更新）
+    - 件数と合計サイズの上限を超えたら、最後に使ったのが古いものから消す（LRU）
+      使った時刻は読みのたびにメモリ上で更新し、index.json には書きのときにまとめて書く
+    version はどれかの中身が変わるたびに増える（描画側のメモ化キー用）。
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[Dict[str, Any], Optional[Tuple[int, int]]]] = {}
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+        self.version = 0
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        if self._index is None:
+            raw = _read_json(_index_path()).get("entries")
+            self._index = {
+                str(k): v for k, v in (raw or {}).items() if isinstance(v, dict)
+            } if isinstance(raw, dict) else {}
+        return self._index
+
+    def _touch(self, key: str, size: Optional[int] = None) -> None:
+        ent = self._load_index().setdefault(key, {"used": 0.0, "size": 0})
+        ent["used"] = time.time()
+        if size is not None:
+            ent["size"] = int(size)
+
+    def get(self, key: str) -> Dict[str, Any]:
+        path = _entry_path(key)
+        sig = _file_sig(path)
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is not None and sig == hit[1]:
+                self._touch(key)
+                return hit[0]
+
+        data = (_read_bin(path) if sig is not None else None) or {}
+
+        with self._lock:
+            self._entries[key] = (data, sig)
+            if sig is not None:
+                self._touch(key, sig[1])
+            self.version += 1
+            return data
+
+    def put(
+        self,
+        key: str,
+        data: Dict[str, Any],
+        max_entries: int = _MAX_ENTRIES,
+        max_bytes: int = _MAX_BYTES,
+    ) -> None:
+        path = _entry_path(key)
+        ok = _write_bin(path, data)
+        with self._lock:
+            prev = self._entries.get(key)
+            # 書けなかったときはメモリだけ持っておく（次回 stat が変われば読み直す）
+            sig = _file_sig(path) if ok else (prev[1] if prev else None)
+            self._entries[key] = (data, sig)
+            self._touch(key, sig[1] if sig else 0)
+            self.version += 1
+            evicted = self._evict(key, max_entries, max_bytes)
+            index = dict(self._load_index())
+
+        for k in evicted:
+            try:
+                os.remove(_entry_path(k))
+            except OSError:
+                pass
+        _write_json(_index_path(), {"entries": index}, indent=None)
+
+    def _evict(self, keep: str, max_entries: int, max_bytes: int) -> List[str]:
+        index = self._load_index()
+        # ファイルが消えているもの（手で消した等）は先に落とす
+        for k in [k for k in index if k != keep and not os.path.exists(_entry_path(k))]:
+            del index[k]
+            self._entries.pop(k, None)
+
+        total = sum(int(v.get("size", 0)) for v in index.values())
+        out: List[str] = []
+        for k in sorted(index, key=lambda k: float(index[k].get("used", 0.0))):
+            if len(index) <= max(1, max_entries) and total <= max_bytes:
+                break
+            if k == keep:
+                continue
+            total -= int(index[k].get("size", 0))
+            del index[k]
+            self._entries.pop(k, None)
+            out.append(k)
+        return out
+
+
+_CACHE = _MemoryCache()
+
+
+def load_cache(desc: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    desc: パネルの panel_spec（今のプロファイル + 条件で引く）。
+    まだ無ければ {}（最初の更新で埋まる）。
+    返り値は共有オブジェクトなので呼び出し側で書き換えないこと。
+    """
+    return _CACHE.get(cache_key(desc))
+
+
+def save_cache(
+    data: Dict[str, Any],
+    max_entries: int = _MAX_ENTRIES,
+    max_bytes: int = _MAX_BYTES,
+) -> None:
+    """data（集計結果）の条件から作ったキーで保存する。上限を超えた古い entry は消す。"""
+    # パネル名は入れない（同じ条件の別パネルと同じ entry を使うので、名前は表示側の config から）
+    data = {k: v for k, v in data.items() if k != "panel"}
+    _CACHE.put(cache_key(data), data, max_entries, max_bytes)
+
+
+def cache_version() -> int:
+    return _CACHE.version
+
+
+def load_state() -> Dict[str, Any]:
+    return _read_json(_state_path())
+
+
+def save_state(state: Dict[str, Any]) -> None:
+    # 人が読むものではないので indent なし
+    _write_json(_state_path(), state, indent=None)
+
+
+def load_diagnostics() -> List[Dict[str, Any]]:
+    entries = _read_json(_diagnostics_path()).get("updates")
+    return [e for e in entries if isinstance(e, dict)] if isinstance(entries, list) else []
+
+
+def append_diagnostics(entry: Dict[str, Any], keep: int = 20) -> None:
+    entries = [entry] + load_diagnostics()
+    _write_json(_diagnostics_path(), {"updates": entries[: max(1, keep)]}, indent=None)
+
+
+def append_debug_log(lines: List[str]) -> None:
+    path = _debug_log_path()
+    try:
+        if os.path.getsize(path) > _DEBUG_LOG_MAX_BYTES:
+            os.replace(path, path + ".1")
+    except OSError:
+        pass
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+    except Exception:
+        pass
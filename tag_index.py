@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import re
+import threading
+from bisect import bisect_left
+from typing import Iterable, Optional
+
+from .diagnostics import unwrap
+
+# 差分更新でなくフル再構築に切り替える目安
+_MAX_CHANGED_RATIO = 0.25
+_MAX_DISCARD_OPS = 5_000_000
+
+
+class TagIndex:
+    """
+    タグ -> note id の集合。notes を1回全件読んで作り、以降は notes.mod で差分更新する。
+    Anki と同じくタグは大文字小文字を区別しない（キーは casefold 済み）。
+
+    - 変更されたノートは全タグ集合から外してから入れ直す（旧タグを持っていないため）
+    - 削除されたノートの id は残るが、cards と突き合わせるだけなので害はない
+    - コレクション（id / scm）が変わったら作り直す
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._by_tag: dict[str, set[int]] = {}
+        # パターン解決用のソート済みタグ一覧（語彙が変わったら作り直す）
+        self._keys: Optional[list[str]] = None
+        self._col_id: Optional[int] = None
+        self._scm: Optional[int] = None
+        self._col_mod: Optional[int] = None
+        self._note_mod: Optional[int] = None
+        self._note_count = 0
+
+    def _add_note(self, nid: int, tags: str) -> None:
+        for t in (tags or "").split():
+            t = t.casefold()
+            s = self._by_tag.get(t)
+            if s is None:
+                s = self._by_tag[t] = set()
+                self._keys = None
+            s.add(nid)
+
+    def _rebuild(self, col) -> None:
+        self._by_tag = {}
+        self._keys = None
+        n = 0
+        for nid, tags in col.db.all("SELECT id, tags FROM notes"):
+            self._add_note(int(nid), tags)
+            n += 1
+        self._note_count = n
+
+    def refresh(self, col) -> None:
+        col_mod, scm = col.db.first("SELECT mod, scm FROM col") or (0, 0)
+        col_mod, scm = int(col_mod or 0), int(scm or 0)
+
+        with self._lock:
+            fresh = self._note_mod is not None and self._col_id == id(unwrap(col)) and self._scm == scm
+            if fresh and self._col_mod == col_mod:
+                # コレクションが何も変わっていない
+                return
+
+        # 読み始める前の値を watermark にする（同秒の変更は次回 >= で拾う）
+        note_mod = int(col.db.scalar("SELECT MAX(mod) FROM notes") or 0)
+
+        with self._lock:
+            if not fresh or self._note_mod is None:
+                self._rebuild(col)
+            else:
+                changed = col.db.all(
+                    "SELECT id, tags FROM notes WHERE mod >= ?", int(self._note_mod)
+                )
+                too_many = (
+                    len(changed) > max(1, self._note_count) * _MAX_CHANGED_RATIO
+                    or len(changed) * max(1, len(self._by_tag)) > _MAX_DISCARD_OPS
+                )
+                if too_many:
+                    self._rebuild(col)
+                else:
+                    for nid, _tags in changed:
+                        nid = int(nid)
+                        for s in self._by_tag.values():
+                            s.discard(nid)
+                    for nid, tags in changed:
+                        self._add_note(int(nid), tags)
+                    for t in [t for t, s in self._by_tag.items() if not s]:
+                        del self._by_tag[t]
+                        self._keys = None
+
+            self._col_id = id(unwrap(col))
+            self._scm = scm
+            self._col_mod = col_mod
+            self._note_mod = note_mod
+
+    def _sorted_keys(self) -> list[str]:
+        if self._keys is None:
+            self._keys = sorted(self._by_tag)
+        return self._keys
+
+    def _prefix_range(self, prefix: str) -> list[str]:
+        keys = self._sorted_keys()
+        i = bisect_left(keys, prefix)
+        out = []
+        while i < len(keys) and keys[i].startswith(prefix):
+            out.append(keys[i])
+            i += 1
+        return out
+
+    def resolve(self, pattern: str, hierarchical: bool = False) -> list[str]:
+        """
+        パターン → 該当する索引上のタグ（小文字化済み）。
+          - "*" はワイルドカード（"topic::*", "card*" など）
+          - hierarchical=True なら "topic" は "topic" と "topic::..." の全子孫に当たる
+        ソート済みタグ一覧の前方一致範囲だけを見るので、タグ総数に比例しない。
+        """
+        p = (pattern or "").strip().casefold()
+        if not p:
+            return []
+        with self._lock:
+            if "*" not in p:
+                out = [p] if p in self._by_tag else []
+                if hierarchical:
+                    out += self._prefix_range(p + "::")
+                return out
+
+            prefix = p.split("*", 1)[0]
+            rx = re.compile("".join(".*" if ch == "*" else re.escape(ch) for ch in p) + r"\Z")
+            return [t for t in self._prefix_range(prefix) if rx.match(t)]
+
+    def masks(self, patterns: Iterable[str], hierarchical: bool = False) -> dict[int, int]:
+        """
+        nid -> ビットマスク（patterns[i] に当たるタグを1つでも持てば bit i が立つ）。
+        どのパターンにも当たらないノートは含まない。
+        パターン解決はここで1回だけ。カードごとの判定はマスクを見るだけになる。
+        """
+        resolved = [self.resolve(p, hierarchical) for p in patterns]
+        out: dict[int, int] = {}
+        with self._lock:
+            for i, tags in enumerate(resolved):
+                bit = 1 << i
+                for t in tags:
+                    for nid in self._by_tag.get(t, ()):
+                        out[nid] = out.get(nid, 0) | bit
+        return out
+
+
+_INDEX = TagIndex()
+
+
+def tag_index(col) -> TagIndex:
+    """プロセス共通の索引を最新化して返す。"""
+    _INDEX.refresh(col)
+    return _INDEX
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import json
+from bisect import bisect_right
+from typing import Any, Dict, List, Optional, Tuple
+
+FALLBACK_COLOR = "#999"
+
+
+def default_pct_bands() -> List[Dict[str, Any]]:
+    return [
+        {"min": 0, "max": 40, "color": "#e53935"},
+        {"min": 40, "max": 70, "color": "#fb8c00"},
+        {"min": 70, "max": 90, "color": "#43a047"},
+        {"min": 90, "max": 101, "color": "#1e88e5"},
+    ]
+
+
+class CompiledBands:
+    """
+    pct_bands を min 昇順の境界配列にしたもの。
+    判定は min <= pct < max、bisect で O(log bands)。
+    """
+
+    __slots__ = ("starts", "ends", "colors")
+
+    def __init__(self, starts: List[float], ends: List[float], colors: List[str]) -> None:
+        self.starts = starts
+        self.ends = ends
+        self.colors = colors
+
+    def color_for(self, pct: float) -> str:
+        try:
+            p = float(pct)
+        except Exception:
+            p = 0.0
+        i = bisect_right(self.starts, p) - 1
+        if i >= 0 and p < self.ends[i]:
+            return self.colors[i]
+        return FALLBACK_COLOR
+
+
+def compile_bands(bands: Any, strict: bool = False) -> CompiledBands:
+    """
+    strict=True（設定ダイアログ用）:
+      不正な行・max <= min・帯の重なり・帯の隙間を ValueError にする。
+    strict=False（描画用）:
+      不正な行は捨て、重なりは前の帯を優先して後ろの帯を削る。隙間は FALLBACK_COLOR。
+    """
+    if not isinstance(bands, list) or not bands:
+        bands = default_pct_bands()
+
+    parsed: List[Tuple[float, float, str]] = []
+    for i, b in enumerate(bands):
+        try:
+            mn = float(b.get("min", 0))
+            mx = float(b.get("max", 101))
+            color = str(b.get("color", FALLBACK_COLOR))
+        except Exception:
+            if strict:
+                raise ValueError(f"Band {i+1}: min/max must be numbers.")
+            continue
+        if mx <= mn:
+            if strict:
+                raise ValueError(f"Band {i+1}: max must be > min.")
+            continue
+        parsed.append((mn, mx, color))
+
+    parsed.sort(key=lambda x: x[0])
+
+    starts: List[float] = []
+    ends: List[float] = []
+    colors: List[str] = []
+    for mn, mx, color in parsed:
+        if ends:
+            prev = ends[-1]
+            if mn < prev:
+                if strict:
+                    raise ValueError(
+                        f"Bands overlap: {_fmt(starts[-1])}-{_fmt(prev)} and {_fmt(mn)}-{_fmt(mx)}."
+                    )
+                if mx <= prev:
+                    continue
+                mn = prev
+            elif mn > prev and strict:
+                raise ValueError(f"Gap between bands: {_fmt(prev)}-{_fmt(mn)} has no color.")
+        starts.append(mn)
+        ends.append(mx)
+        colors.append(color)
+
+    return CompiledBands(starts, ends, colors)
+
+
+def _fmt(x: float) -> str:
+    return str(int(x)) if float(x).is_integer() else str(x)
+
+
+# pct_bands（JSON 文字列）→ CompiledBands。config が変わったときだけ作り直す
+# パネルごとに pct_bands を変えられるので、1つだけでなく何種類か持っておく
+_COMPILED: Dict[str, CompiledBands] = {}
+_MAX_COMPILED = 16
+
+
+def _bands_key(bands: Any) -> str:
+    try:
+        return json.dumps(bands, sort_keys=True, default=str)
+    except Exception:
+        return repr(bands)
+
+
+def _remember(key: str, compiled: CompiledBands) -> None:
+    _COMPILED.pop(key, None)
+    _COMPILED[key] = compiled
+    # 古い順（挿入順）に捨てる（config を何度も書き換えたときに増え続けないように）
+    while len(_COMPILED) > _MAX_COMPILED:
+        del _COMPILED[next(iter(_COMPILED))]
+
+
+def remember_bands(bands: Any, compiled: CompiledBands) -> None:
+    """設定ダイアログで検証済みのテーブルをそのまま描画側に渡す。"""
+    _remember(_bands_key(bands), compiled)
+
+
+def bands_for_cfg(cfg: Optional[Dict[str, Any]]) -> CompiledBands:
+    bands = (cfg or {}).get("pct_bands")
+    key = _bands_key(bands)
+    compiled = _COMPILED.get(key)
+    if compiled is None:
+        compiled = compile_bands(bands)
+        _remember(key, compiled)
+    return compiled
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
-from typing import Any, Dict, List
+from html import escape
+from typing import Any, Callable, Dict, List, Optional
 
 from aqt import mw
 from aqt.qt import (
     QAbstractItemView,
+    QCheckBox,
     QColor,
     QColorDialog,
     QComboBox,
@@ -20,10 +22,21 @@ from aqt.qt import (
     QSpinBox,
     QTableWidget,
     QTableWidgetItem,
+    QTimer,
     QVBoxLayout,
 )
+from aqt.operations import QueryOp
 from aqt.utils import tooltip
 
+from ..service import estimate_tag_ratios, select_rows
+from .bands import compile_bands, default_pct_bands, remember_bands
+
+# 入力が止まってからプレビューを作るまで（ms）
+_PREVIEW_DELAY_MS = 400
+
+# プレビューの標本の大きさ（これ以下の scope は全部数える）
+_PREVIEW_SAMPLE = 2000
+
 
 def _addon_name_from_module() -> str:
     # setConfigAction / getConfig / writeConfig 用のキー
@@ -40,8 +53,14 @@ def _save_cfg(cfg: Dict[str, Any]) -> None:
 
 
 class ConfigDialog(QDialog):
-    def __init__(self, parent=None) -> None:
+    """
+    normalize_scope: 複数行の scope を1つの検索にする関数（プレビュー用。更新と同じ正規化）。
+    """
+
+    def __init__(self, parent=None, normalize_scope: Optional[Callable[[str], str]] = None) -> None:
         super().__init__(parent)
+        self._normalize_scope = normalize_scope
+        self._preview_seq = 0
         self.setWindowTitle("Tag Ratio Settings")
         self.setMinimumWidth(720)
 
@@ -80,8 +99,78 @@ class ConfigDialog(QDialog):
         g.addWidget(QLabel("Max rows"), 3, 0)
         g.addWidget(self.max_rows, 3, 1)
 
+        self.count_mode = QComboBox()
+        self.count_mode.addItems(["cards", "notes", "both"])
+        self.count_mode.setCurrentText(str(cfg.get("count_mode", "cards")))
+        self.count_mode.setToolTip(
+            "cards = count cards\n"
+            "notes = count notes (sibling cards in the same deck count once)\n"
+            "both = cards, plus a notes column from the same pass"
+        )
+        g.addWidget(QLabel("Count"), 6, 0)
+        g.addWidget(self.count_mode, 6, 1)
+
+        self.sort_by = QComboBox()
+        self.sort_by.addItems(["name", "pct", "den", "gap"])
+        self.sort_by.setCurrentText(str(cfg.get("sort_by", "name")))
+        self.sort_by.setToolTip(
+            "Which decks the panel shows first (and keeps when limited by Max rows):\n"
+            "name = deck name, pct = lowest %, den = most cards, gap = most untagged cards"
+        )
+        g.addWidget(QLabel("Sort by"), 5, 0)
+        g.addWidget(self.sort_by, 5, 1)
+
+        self.deck_tree = QCheckBox("Show parent decks with subdeck totals (expandable)")
+        self.deck_tree.setChecked(bool(cfg.get("deck_tree", False)))
+        g.addWidget(self.deck_tree, 4, 1)
+
+        self.show_trend = QCheckBox("Show trend (sparkline and change) for the last")
+        self.show_trend.setChecked(bool(cfg.get("show_trend", False)))
+        self.trend_days = QSpinBox()
+        self.trend_days.setMinimum(2)
+        self.trend_days.setMaximum(365)
+        self.trend_days.setSuffix(" days")
+        self.trend_days.setValue(int(cfg.get("trend_days", 30)))
+        trend_row = QHBoxLayout()
+        trend_row.addWidget(self.show_trend)
+        trend_row.addWidget(self.trend_days)
+        trend_row.addStretch(1)
+        g.addLayout(trend_row, 7, 1)
+
         root.addWidget(general)
 
+        # --- Auto update ---
+        auto = QGroupBox("Auto update")
+        a = QGridLayout(auto)
+
+        self.auto_reviewer = QCheckBox("After closing the reviewer")
+        self.auto_reviewer.setChecked(bool(cfg.get("auto_update_on_reviewer_close", False)))
+        self.auto_profile = QCheckBox("When the profile opens")
+        self.auto_profile.setChecked(bool(cfg.get("auto_update_on_profile_open", False)))
+
+        self.auto_interval = QSpinBox()
+        self.auto_interval.setRange(0, 24 * 60)
+        self.auto_interval.setSuffix(" min")
+        self.auto_interval.setSpecialValueText("off")
+        self.auto_interval.setValue(int(cfg.get("auto_update_interval_minutes", 0)))
+
+        self.auto_min_interval = QSpinBox()
+        self.auto_min_interval.setRange(0, 24 * 60 * 60)
+        self.auto_min_interval.setSuffix(" s")
+        self.auto_min_interval.setValue(int(cfg.get("auto_update_min_interval_seconds", 120)))
+        self.auto_min_interval.setToolTip(
+            "Automatic updates wait until this long after the previous automatic update.\n"
+            "They also wait until the main screen is idle, and are skipped if nothing changed."
+        )
+
+        a.addWidget(self.auto_reviewer, 0, 1)
+        a.addWidget(self.auto_profile, 1, 1)
+        a.addWidget(QLabel("Every"), 2, 0)
+        a.addWidget(self.auto_interval, 2, 1)
+        a.addWidget(QLabel("At most once per"), 3, 0)
+        a.addWidget(self.auto_min_interval, 3, 1)
+        root.addWidget(auto)
+
         # --- Scope ---
         scope = QGroupBox("Scope")
         s = QGridLayout(scope)
@@ -126,15 +215,49 @@ class ConfigDialog(QDialog):
         tags_help = QLabel(
             'Enter <b>tag names</b> as a <b>comma-separated</b> list.<br/>'
             'Example: <code>anatomy,physiology,needs_coverage_key</code><br/>'
-            'Do not write <code>tag:</code> here.<br/>'
+            'Do not write <code>tag:</code> here. Matching is case-insensitive, and '
+            '<code>*</code> is a wildcard (e.g. <code>topic::*</code>).<br/>'
             '<b>Tag mode</b> controls how multiple tags are combined: OR (any) / AND (all).'
         )
         tags_help.setWordWrap(True)
 
+        self.tag_match = QComboBox()
+        self.tag_match.addItems(["exact", "hierarchical"])
+        self.tag_match.setCurrentText(str(cfg.get("tag_match", "exact")))
+        self.tag_match.setToolTip(
+            "exact: the tag itself only\n"
+            "hierarchical: the tag and all its child tags (topic also matches topic::cardio)"
+        )
+
+        self.tag_breakdown = QCheckBox("Show per-tag, OR and AND counts as extra columns")
+        self.tag_breakdown.setChecked(bool(cfg.get("tag_breakdown", False)))
+
         t.addWidget(QLabel("Tags"), 0, 0)
         t.addWidget(self.tags_line, 0, 1)
+        t.addWidget(QLabel("Tag match"), 1, 0)
+        t.addWidget(self.tag_match, 1, 1)
+        t.addWidget(self.tag_breakdown, 2, 1)
         root.addWidget(tags_box)
 
+        # --- Preview ---
+        # scope / tags を変えたら、保存・更新せずに標本からの推定を出す
+        preview_box = QGroupBox("Preview")
+        pv = QVBoxLayout(preview_box)
+        self.preview = QLabel("")
+        self.preview.setWordWrap(True)
+        self.preview.setStyleSheet("font-size: 12px;")
+        pv.addWidget(self.preview)
+        root.addWidget(preview_box)
+
+        self._preview_timer = QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.timeout.connect(self._run_preview)  # type: ignore[attr-defined]
+        self.search_scope.textChanged.connect(self._schedule_preview)  # type: ignore[attr-defined]
+        self.tags_line.textChanged.connect(self._schedule_preview)  # type: ignore[attr-defined]
+        self.tag_mode.currentTextChanged.connect(self._schedule_preview)  # type: ignore[attr-defined]
+        self.tag_match.currentTextChanged.connect(self._schedule_preview)  # type: ignore[attr-defined]
+        self.min_cards.valueChanged.connect(self._schedule_preview)  # type: ignore[attr-defined]
+
         # --- Percent bands ---
         bands_box = QGroupBox("Percent bands (left colored dot)")
         vb = QVBoxLayout(bands_box)
@@ -172,14 +295,91 @@ class ConfigDialog(QDialog):
         box.rejected.connect(self.reject)
         root.addWidget(box)
 
+        # 今の設定のプレビューも最初に1回出しておく
+        self._schedule_preview()
+
+    # --- Preview ---
+
+    def _schedule_preview(self, *_: Any) -> None:
+        self._preview_timer.start(_PREVIEW_DELAY_MS)
+
+    def _tags(self) -> List[str]:
+        raw = self.tags_line.text().strip()
+        return [t.strip() for t in raw.split(",") if t.strip()] if raw else []
+
+    def _run_preview(self) -> None:
+        if mw.col is None:
+            return
+        raw_scope = self.search_scope.toPlainText().strip() or "deck:*"
+        try:
+            scope = self._normalize_scope(raw_scope) if self._normalize_scope else raw_scope
+        except Exception:
+            scope = raw_scope
+        tags = self._tags()
+        tag_mode = self.tag_mode.currentText().upper()
+        tag_match = self.tag_match.currentText()
+        min_cards = int(self.min_cards.value())
+
+        # 古いプレビューの結果は捨てる（入力のほうが先に進んでいる）
+        self._preview_seq += 1
+        seq = self._preview_seq
+        self.preview.setText("Estimating…")
+
+        QueryOp(
+            parent=self,
+            op=lambda col: estimate_tag_ratios(
+                col,
+                scope,
+                tags,
+                tag_mode,
+                min_cards,
+                sample_size=_PREVIEW_SAMPLE,
+                tag_match=tag_match,
+            ),
+            success=lambda res: self._show_preview(seq, res),
+        ).failure(lambda err: self._show_preview_error(seq, err)).run_in_background()
+
+    def _show_preview(self, seq: int, res: Dict[str, Any]) -> None:
+        if seq != self._preview_seq:
+            return
+        try:
+            rows = res.get("rows") or []
+            totals = res.get("totals") or {}
+            est = res.get("estimate") or {}
+            pct = float(totals.get("pct", 0.0))
+            if est:
+                head = (
+                    f"Estimate from {int(est.get('sample', 0)):,} of {int(est.get('population', 0)):,} cards: "
+                    f"<b>{pct:.1f}%</b> (95% range {float(totals.get('ci_lo', 0.0)):.1f}–"
+                    f"{float(totals.get('ci_hi', 100.0)):.1f}%)"
+                )
+            else:
+                head = (
+                    f"{int(totals.get('num', 0)):,} of {int(totals.get('den', 0)):,} cards: "
+                    f"<b>{pct:.1f}%</b>"
+                )
+            lows = select_rows(rows, "pct", 3)
+            low_txt = ", ".join(
+                f"{escape(str(r.get('deck', '')))} {float(r.get('pct', 0.0)):.0f}%" for r in lows
+            )
+            text = f"{head}<br>{len(rows)} decks"
+            if low_txt:
+                text += f"; lowest: {low_txt}"
+            self.preview.setText(text)
+        except RuntimeError:
+            # ダイアログが閉じている
+            pass
+
+    def _show_preview_error(self, seq: int, err: Exception) -> None:
+        if seq != self._preview_seq:
+            return
+        try:
+            self.preview.setText(f"Preview unavailable ({escape(type(err).__name__)}). Check the search scope.")
+        except RuntimeError:
+            pass
+
     def _load_bands(self, pct_bands: Any) -> None:
-        default = [
-            {"min": 0, "max": 40, "color": "#e53935"},
-            {"min": 40, "max": 70, "color": "#fb8c00"},
-            {"min": 70, "max": 90, "color": "#43a047"},
-            {"min": 90, "max": 101, "color": "#1e88e5"},
-        ]
-        bands = pct_bands if isinstance(pct_bands, list) else default
+        bands = pct_bands if isinstance(pct_bands, list) else default_pct_bands()
 
         self.bands_table.setRowCount(0)
         for b in bands:
@@ -261,6 +461,9 @@ class ConfigDialog(QDialog):
 
         # min順にソート（見た目/安定性）
         out.sort(key=lambda x: int(x.get("min", 0)))
+
+        # 重なり・隙間はここで弾く。通ったテーブルは描画側でそのまま使う
+        remember_bands(out, compile_bands(out, strict=True))
         return out
 
     def _on_ok(self) -> None:
@@ -272,6 +475,15 @@ class ConfigDialog(QDialog):
             cfg["tag_mode"] = self.tag_mode.currentText().upper()
             cfg["min_cards"] = int(self.min_cards.value())
             cfg["max_rows"] = int(self.max_rows.value())
+            cfg["deck_tree"] = bool(self.deck_tree.isChecked())
+            cfg["sort_by"] = self.sort_by.currentText()
+            cfg["count_mode"] = self.count_mode.currentText()
+            cfg["show_trend"] = bool(self.show_trend.isChecked())
+            cfg["trend_days"] = int(self.trend_days.value())
+            cfg["auto_update_on_reviewer_close"] = bool(self.auto_reviewer.isChecked())
+            cfg["auto_update_on_profile_open"] = bool(self.auto_profile.isChecked())
+            cfg["auto_update_interval_minutes"] = int(self.auto_interval.value())
+            cfg["auto_update_min_interval_seconds"] = int(self.auto_min_interval.value())
 
             tags_raw = self.tags_line.text().strip()
             if tags_raw:
@@ -279,6 +491,8 @@ class ConfigDialog(QDialog):
             else:
                 tags = []
             cfg["tags"] = tags
+            cfg["tag_breakdown"] = bool(self.tag_breakdown.isChecked())
+            cfg["tag_match"] = self.tag_match.currentText()
 
             cfg["pct_bands"] = self._collect_bands()
 
@@ -1,87 +1,236 @@
 from __future__ import annotations
 
+from typing import Any, Callable, Dict, Optional
+
 from aqt import mw
 from aqt.qt import (
+    QComboBox,
     QDialog,
     QHBoxLayout,
+    QHeaderView,
     QLabel,
+    QLineEdit,
+    QPlainTextEdit,
+    QProgressBar,
     QPushButton,
-    QTableWidget,
-    QTableWidgetItem,
+    QTableView,
     QVBoxLayout,
 )
 from aqt.utils import tooltip
 
-from ..store import load_cache
-from ..service import compute_tag_ratios
-from ..store import save_cache
+from ..diagnostics import format_entry
+from ..store import load_diagnostics
+from ..service import SORT_MODES
+from .table_model import RatioTableModel
+
+
+# 段階名 → 進捗バーの表示
+_PHASE_LABELS = {
+    "check": "Checking changes",
+    "tags": "Reading tags",
+    "search": "Searching cards",
+    "estimate": "Estimating",
+    "count": "Counting",
+    "names": "Reading deck names",
+    "build": "Building rows",
+}
 
 
 class TagRatioDialog(QDialog):
-    def __init__(self, parent=None) -> None:
+    """
+    request_update: 共通の更新（UpdateEngine.request）を呼んで UpdateHandle を返す関数。
+    load_result: パネル名 → 今のプロファイル・条件の cache を返す関数。
+    ダイアログ自身は集計しない。結果の保存と再読込はメイン側の on_result が行う。
+    """
+
+    def __init__(
+        self,
+        parent=None,
+        request_update: Optional[Callable[[], Any]] = None,
+        load_result: Optional[Callable[[str], Dict[str, Any]]] = None,
+    ) -> None:
         super().__init__(parent)
+        self._request_update = request_update
+        self._load_result = load_result
+        self._handle: Any = None
         self.setWindowTitle("Tag Ratio (by deck)")
         self.setMinimumWidth(760)
         self.setMinimumHeight(420)
 
         self.info = QLabel("")
-        self.table = QTableWidget(0, 4)
-        self.table.setHorizontalHeaderLabels(["Deck", "Tagged", "Total", "%"])
+
+        # 行ウィジェットは作らない。見えている行だけモデルから描く（行数に比例しない）
+        self.model = RatioTableModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setSortingEnabled(True)
+        self.table.setAlternatingRowColors(True)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Interactive)
+        self.table.horizontalHeader().setSortIndicatorShown(False)
+
+        self.filter = QLineEdit()
+        self.filter.setPlaceholderText("Filter decks")
+        self.filter.setClearButtonEnabled(True)
 
         self.btn_update = QPushButton("Update")
         self.btn_close = QPushButton("Close")
 
+        self.progress = QProgressBar()
+        self.progress.setRange(0, 100)
+        self.progress.setTextVisible(True)
+        self.progress.setVisible(False)
+        self.btn_cancel = QPushButton("Cancel")
+        self.btn_cancel.setVisible(False)
+
+        # 直近の更新の段階ごとの時間（store の diagnostics、新しい順）
+        self.btn_diag = QPushButton("Diagnostics")
+        self.btn_diag.setCheckable(True)
+        self.diag = QPlainTextEdit()
+        self.diag.setReadOnly(True)
+        self.diag.setLineWrapMode(QPlainTextEdit.LineWrapMode.NoWrap)
+        self.diag.setStyleSheet("font-family: monospace;")
+        self.diag.setVisible(False)
+
+        # パネルは上位 max_rows 件だけ。ダイアログは全件をこの順で出す
+        self.sort_by = QComboBox()
+        self.sort_by.addItems(list(SORT_MODES))
+        cfg = mw.addonManager.getConfig(__name__.split(".")[0]) or {}
+        self.sort_by.setCurrentText(str(cfg.get("sort_by", "name")))
+
+        # config の panels（名前付きパネル）。無ければ既定パネルだけなので出さない
+        self.panel = QComboBox()
+        panels = cfg.get("panels") if isinstance(cfg.get("panels"), list) else []
+        for i, p in enumerate(panels):
+            if isinstance(p, dict):
+                name = str(p.get("name") or f"Panel {i + 1}").strip()
+                if self.panel.findText(name) < 0:
+                    self.panel.addItem(name)
+
         btns = QHBoxLayout()
+        if self.panel.count():
+            btns.addWidget(QLabel("Panel"))
+            btns.addWidget(self.panel)
+        btns.addWidget(QLabel("Sort"))
+        btns.addWidget(self.sort_by)
+        btns.addWidget(self.filter, 1)
         btns.addStretch(1)
+        btns.addWidget(self.btn_diag)
         btns.addWidget(self.btn_update)
         btns.addWidget(self.btn_close)
 
         lay = QVBoxLayout()
         lay.addWidget(self.info)
-        lay.addWidget(self.table)
+        lay.addWidget(self.table, 3)
+        lay.addWidget(self.diag, 1)
+        prog = QHBoxLayout()
+        prog.addWidget(self.progress, 1)
+        prog.addWidget(self.btn_cancel)
+        lay.addLayout(prog)
         lay.addLayout(btns)
         self.setLayout(lay)
 
         self.btn_close.clicked.connect(self.close)  # type: ignore[attr-defined]
         self.btn_update.clicked.connect(self.update_now)  # type: ignore[attr-defined]
+        self.btn_cancel.clicked.connect(self._on_cancel)  # type: ignore[attr-defined]
+        self.btn_diag.toggled.connect(self._on_diag_toggled)  # type: ignore[attr-defined]
+        self.table.clicked.connect(self._on_clicked)  # type: ignore[attr-defined]
+        self.sort_by.currentTextChanged.connect(self._on_sort_mode)  # type: ignore[attr-defined]
+        self.filter.textChanged.connect(self.model.set_filter)  # type: ignore[attr-defined]
+        self.panel.currentTextChanged.connect(lambda *_: self.reload_from_cache())  # type: ignore[attr-defined]
+        self.table.horizontalHeader().sortIndicatorChanged.connect(  # type: ignore[attr-defined]
+            lambda *_: self.table.horizontalHeader().setSortIndicatorShown(True)
+        )
 
+        # setSortingEnabled が列0で並べ替えるので、その後で combo の並びに戻す
+        self.model.set_sort_mode(self.sort_by.currentText())
         self.reload_from_cache()
 
     def reload_from_cache(self) -> None:
-        cache = load_cache()
-        rows = cache.get("rows") or []
-        self.info.setText(
-            f"scope={cache.get('search_scope','')} tags={cache.get('tags',[])} mode={cache.get('tag_mode','')} updated_at={cache.get('updated_at','')}"
-        )
-        self.table.setRowCount(0)
+        name = self.panel.currentText() if self.panel.count() else ""
+        cache = self._load_result(name) if self._load_result is not None else {}
+        info = f"scope={cache.get('search_scope','')} tags={cache.get('tags',[])} mode={cache.get('tag_mode','')} updated_at={cache.get('updated_at','')}"
+        est = cache.get("estimate")
+        if est:
+            # 更新中の推定（標本から）。正確な結果が出たら置き換わる
+            info += f"  (estimate from {int(est.get('sample', 0)):,} of {int(est.get('population', 0)):,} cards, counting all…)"
+        self.info.setText(info)
+        self.model.set_result(cache)
+        # 幅は読み込み済みの先頭分だけで決める（全行は測らない）
+        self.table.resizeColumnsToContents()
+        if self.diag.isVisible():
+            self._reload_diagnostics()
 
-        for r in rows:
-            row = self.table.rowCount()
-            self.table.insertRow(row)
+    def _reload_diagnostics(self) -> None:
+        lines = []
+        for entry in load_diagnostics():
+            lines += format_entry(entry) + [""]
+        self.diag.setPlainText("\n".join(lines) if lines else "No updates recorded yet.")
 
-            deck = str(r.get("deck", ""))
-            num = int(r.get("num", 0))
-            den = int(r.get("den", 0))
-            pct = float(r.get("pct", 0.0))
+    def _on_diag_toggled(self, on: bool) -> None:
+        self.diag.setVisible(on)
+        if on:
+            self._reload_diagnostics()
 
-            self.table.setItem(row, 0, QTableWidgetItem(deck))
-            self.table.setItem(row, 1, QTableWidgetItem(str(num)))
-            self.table.setItem(row, 2, QTableWidgetItem(str(den)))
-            self.table.setItem(row, 3, QTableWidgetItem(f"{pct:.1f}"))
+    def _on_sort_mode(self, mode: str) -> None:
+        self.table.horizontalHeader().setSortIndicatorShown(False)
+        self.model.set_sort_mode(mode)
 
-        self.table.resizeColumnsToContents()
+    def _on_clicked(self, index) -> None:
+        # deck_tree のとき、デッキ名の列で親の開閉
+        if index.isValid() and index.column() == 0:
+            self.model.toggle(index.row())
 
     def update_now(self) -> None:
-        cfg = mw.addonManager.getConfig(__name__.split(".")[0]) or {}  # module->addon name の雑対策
-
-        res = compute_tag_ratios(
-            col=mw.col,
-            search_scope=str(cfg.get("search_scope", "deck:*")),
-            tags=list(cfg.get("tags", [])),
-            tag_mode=str(cfg.get("tag_mode", "OR")).upper(),
-            min_cards=int(cfg.get("min_cards", 0)),
-            max_rows=int(cfg.get("max_rows", 30)),
-        )
-        save_cache(res)
-        tooltip("Updated")
-        self.reload_from_cache()
+        if self._request_update is None:
+            return
+        handle = self._request_update()
+        if handle is None:
+            return
+        self._handle = handle
+        self.btn_update.setEnabled(False)
+        self.btn_cancel.setEnabled(True)
+        self.btn_cancel.setVisible(True)
+        self.progress.setVisible(True)
+        self._on_progress(handle)
+        handle.add_progress_callback(self._on_progress)
+        handle.add_done_callback(self._on_done)
+
+    def _on_progress(self, handle) -> None:
+        if handle is not self._handle:
+            return
+        try:
+            if handle.state == "pending":
+                self.progress.setFormat("Waiting for the running update…")
+                self.progress.setValue(0)
+                return
+            label = _PHASE_LABELS.get(handle.phase, "Updating")
+            self.progress.setFormat(f"{label}… %p%")
+            self.progress.setValue(int(handle.fraction * 100))
+        except RuntimeError:
+            # ダイアログが閉じて C++ 側が消えている
+            pass
+
+    def _on_cancel(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self.btn_cancel.setEnabled(False)
+            self.progress.setFormat("Cancelling…")
+
+    def _on_done(self, handle) -> None:
+        if handle is not self._handle:
+            return
+        self._handle = None
+        try:
+            self.progress.setVisible(False)
+            self.btn_cancel.setVisible(False)
+            self.btn_update.setEnabled(True)
+            if handle.state == "cancelled":
+                tooltip("Tag Ratio: update cancelled")
+        except RuntimeError:
+            pass
+
+    def closeEvent(self, event) -> None:  # noqa: N802
+        # 閉じても更新自体は続ける（メイン画面のパネルは更新される）。通知だけ切る
+        self._handle = None
+        super().closeEvent(event)
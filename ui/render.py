@@ -1,8 +1,12 @@
 from __future__ import annotations
 
 import datetime
+import json
 from html import escape
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
+
+from ..service import select_rows
+from .bands import bands_for_cfg
 
 
 def _fmt_ts(ts: int | None) -> str:
@@ -15,39 +19,182 @@ def _fmt_ts(ts: int | None) -> str:
         return "unknown"
 
 
-def _default_pct_bands() -> List[Dict[str, Any]]:
-    return [
-        {"min": 0, "max": 40, "color": "#e53935"},
-        {"min": 40, "max": 70, "color": "#fb8c00"},
-        {"min": 70, "max": 90, "color": "#43a047"},
-        {"min": 90, "max": 101, "color": "#1e88e5"},
-    ]
+# 描画結果に効く config キー（これ以外が変わっても作り直さない）
+_RENDER_CFG_KEYS = (
+    "tags", "tag_mode", "search_scope", "pct_bands", "max_rows", "sort_by", "show_trend", "name",
+)
 
+# パネルごとに直近1件だけ覚える。cache / config のどちらかが変われば上書き（= 追い出し）
+_MEMO: Dict[str, Dict[str, Any]] = {}
 
-def _pick_color(pct: float, cfg: Dict[str, Any]) -> str:
-    bands = cfg.get("pct_bands")
-    if not isinstance(bands, list) or not bands:
-        bands = _default_pct_bands()
 
+def _cfg_key(cfg: Dict[str, Any]) -> str:
     try:
-        p = float(pct)
+        return json.dumps(
+            {k: cfg.get(k) for k in _RENDER_CFG_KEYS}, sort_keys=True, default=str
+        )
     except Exception:
-        p = 0.0
-
-    for b in bands:
-        try:
-            mn = float(b.get("min", 0))
-            mx = float(b.get("max", 101))
-            color = str(b.get("color", "#999"))
-        except Exception:
+        return repr([cfg.get(k) for k in _RENDER_CFG_KEYS])
+
+
+def build_panel_html(
+    cache: Dict[str, Any],
+    cfg: Dict[str, Any],
+    version: Optional[int] = None,
+    panel_id: str = "",
+) -> str:
+    """
+    version: store.cache_version()。cache の同一性 + updated_at + version +
+    関連 config が前回と同じなら、前回の HTML をそのまま返す。
+    panel_id: 複数パネルを並べるときの HTML id の接尾辞（"" は従来どおり）。
+    """
+    key = (version, cache.get("updated_at"), _cfg_key(cfg))
+    memo = _MEMO.get(panel_id)
+    # cache 本体も保持しておく（id の再利用で誤ヒットしないように）
+    if memo is not None and memo.get("cache") is cache and memo.get("key") == key:
+        return memo["html"]
+
+    html = _build_panel_html(cache, cfg, panel_id)
+    _MEMO[panel_id] = dict(cache=cache, key=key, html=html)
+    return html
+
+
+# 行は親 → 子の順に並んでいるので、上から順に「親が見えていて開いている」かを決めるだけ
+_TREE_SCRIPT = """
+<script>
+function tagRatioToggle(pid, did) {
+  var caret = document.getElementById("tag-ratio-caret" + pid + "-" + did);
+  if (!caret) { return; }
+  var open = caret.getAttribute("data-open") !== "1";
+  caret.setAttribute("data-open", open ? "1" : "0");
+  caret.innerHTML = open ? "&#9662;" : "&#9656;";
+  var visible = {};
+  var rows = document.querySelectorAll("#tag-ratio-panel" + pid + " tr[data-did]");
+  for (var i = 0; i < rows.length; i++) {
+    var row = rows[i];
+    var p = row.getAttribute("data-parent");
+    var show = true;
+    if (p) {
+      var pc = document.getElementById("tag-ratio-caret" + pid + "-" + p);
+      show = !!visible[p] && !!pc && pc.getAttribute("data-open") === "1";
+    }
+    row.style.display = show ? "" : "none";
+    visible[row.getAttribute("data-did")] = show;
+  }
+}
+</script>
+"""
+
+
+def _breakdown_cells(r: Dict[str, Any], den: int) -> str:
+    # タグごと + OR + AND（compute 側で tag_breakdown=True のときだけ入っている）
+    vals = [int(x) for x in (r.get("tag_nums") or [])]
+    vals += [int(r.get("or_num", 0)), int(r.get("and_num", 0))]
+    cells = []
+    for v in vals:
+        pct = (v / den * 100.0) if den else 0.0
+        cells.append(
+            f"""
+          <td style="padding: 8px 10px; white-space: nowrap; text-align:right; font-size: 12px; opacity: 0.85;">
+            {v} ({pct:.0f}%)
+          </td>"""
+        )
+    return "".join(cells)
+
+
+def _note_cell(r: Dict[str, Any]) -> str:
+    # count_mode="both" のときのノート単位の比率
+    nn = int(r.get("note_num", 0))
+    nd = int(r.get("note_den", 0))
+    npct = float(r.get("note_pct", 0.0))
+    return f"""
+          <td style="padding: 8px 16px 8px 0; white-space: nowrap; text-align:right; font-size: 12px; opacity: 0.85;">
+            notes {nn}/{nd} ({npct:.1f}%)
+          </td>"""
+
+
+def _note_total(totals: Dict[str, Any]) -> str:
+    return (
+        f' &nbsp; notes {int(totals.get("note_num", 0))}/{int(totals.get("note_den", 0))}'
+        f' ({float(totals.get("note_pct", 0.0)):.1f}%)'
+    )
+
+
+def _ratio_text(d: Dict[str, Any], estimate: bool) -> str:
+    num = int(d.get("num", 0))
+    den = int(d.get("den", 0))
+    pct = float(d.get("pct", 0.0))
+    if not estimate:
+        return f"{num}/{den} ({pct:.1f}%)"
+    # 標本からの推定。数は概数、% には 95% 区間を付ける
+    lo = float(d.get("ci_lo", 0.0))
+    hi = float(d.get("ci_hi", 100.0))
+    return f"≈{num}/{den} ({pct:.1f}%, {lo:.1f}–{hi:.1f})"
+
+
+_SPARK_W = 60
+_SPARK_H = 16
+
+
+def _sparkline(pts: List[Optional[float]], color: str) -> str:
+    # 0〜100% を固定スケールで描く（デッキ間で傾きを比べられるように）
+    n = len(pts)
+    if n < 2:
+        return ""
+    step = _SPARK_W / (n - 1)
+    segs: List[str] = []
+    cur: List[str] = []
+    for i, v in enumerate(pts):
+        if v is None:
+            if len(cur) > 1:
+                segs.append(" ".join(cur))
+            cur = []
             continue
-        if mn <= p < mx:
-            return color
+        y = _SPARK_H - 1 - (min(max(float(v), 0.0), 100.0) / 100.0) * (_SPARK_H - 2)
+        cur.append(f"{i * step:.1f},{y:.1f}")
+    if len(cur) > 1:
+        segs.append(" ".join(cur))
+    lines = "".join(
+        f'<polyline points="{p}" fill="none" stroke="{escape(color)}" stroke-width="1.5"/>'
+        for p in segs
+    )
+    return (
+        f'<svg width="{_SPARK_W}" height="{_SPARK_H}" viewBox="0 0 {_SPARK_W} {_SPARK_H}" '
+        f'style="vertical-align:middle;">{lines}</svg>'
+    )
+
+
+def _trend_cell(pts: Optional[List[Optional[float]]], color: str) -> str:
+    # update 時に作った系列（cache["trend"]）を描くだけ。履歴ファイルは読まない
+    vals = [v for v in (pts or []) if v is not None]
+    if len(vals) >= 2:
+        d = vals[-1] - vals[0]
+        dcolor = "#43a047" if d > 0.05 else "#e53935" if d < -0.05 else "inherit"
+        delta = f'<span style="color:{dcolor};">{d:+.1f}</span>'
+    else:
+        delta = ""
+    return f"""
+          <td style="padding: 8px 16px 8px 0; white-space: nowrap; text-align:right; font-size: 12px;">
+            {_sparkline(pts or [], color)} {delta}
+          </td>"""
+
 
-    return "#999"
+def _breakdown_header(tags: List[Any], both: bool = False, trend: bool = False) -> str:
+    labels = [str(t) for t in tags] + ["OR", "AND"]
+    ths = "".join(
+        f"""
+          <th style="padding: 4px 10px; white-space: nowrap; text-align:right; font-size: 11px; font-weight:600; opacity: 0.7;">{escape(x)}</th>"""
+        for x in labels
+    )
+    return f"""
+        <tr>
+          <th></th>
+          <th></th>{"<th></th>" if trend else ""}{"<th></th>" if both else ""}{ths}
+        </tr>
+"""
 
 
-def build_panel_html(cache: Dict[str, Any], cfg: Dict[str, Any]) -> str:
+def _build_panel_html(cache: Dict[str, Any], cfg: Dict[str, Any], panel_id: str = "") -> str:
     tags = cache.get("tags") or cfg.get("tags") or []
     tag_mode = cache.get("tag_mode") or cfg.get("tag_mode") or "OR"
     scope = cache.get("search_scope") or cfg.get("search_scope") or "deck:*"
@@ -57,12 +204,25 @@ def build_panel_html(cache: Dict[str, Any], cfg: Dict[str, Any]) -> str:
     totals = cache.get("totals") or {"num": 0, "den": 0, "pct": 0.0}
 
     tag_txt = ", ".join(str(t) for t in tags) if tags else "(no tags)"
+    est = cache.get("estimate") or {}
+    if est:
+        status = (
+            f"estimate from {int(est.get('sample', 0)):,} of {int(est.get('population', 0)):,} cards"
+            " (95% range), counting all…"
+        )
+    else:
+        status = f"updated: {_fmt_ts(updated_at)}"
+    pid = f"-{panel_id}" if panel_id else ""
+    title = "Tag Ratio"
+    # 名前は描いているパネルのもの（cache は条件が同じ別パネルと共有されうる）
+    if cfg.get("name"):
+        title += f" — {cfg.get('name')}"
 
     # 外枠：中央寄せ + inline-block でコンテンツ幅に追従
     # 画面を超えるときは max-width & overflow-x で横スクロール
     head = f"""
-<div id="tag-ratio-wrap" style="text-align:center; margin-top: 16px;">
-  <div id="tag-ratio-panel" style="
+<div id="tag-ratio-wrap{pid}" style="text-align:center; margin-top: 16px;">
+  <div id="tag-ratio-panel{pid}" style="
       display:inline-block;
       text-align:left;
       padding: 12px;
@@ -73,11 +233,11 @@ def build_panel_html(cache: Dict[str, Any], cfg: Dict[str, Any]) -> str:
   ">
     <div style="display:flex; align-items:flex-start; justify-content:space-between; gap:12px;">
       <div>
-        <div style="font-weight:600;">Tag Ratio</div>
+        <div style="font-weight:600;">{escape(title)}</div>
         <div style="font-size: 12px; opacity: 0.82; margin-top:2px;">
           scope: {escape(str(scope))}<br>
-          tags({escape(str(tag_mode))}): {escape(tag_txt)}<br>
-          updated: {escape(_fmt_ts(updated_at))}
+          tags({escape(str(tag_mode))}{", hierarchical" if cache.get("tag_match") == "hierarchical" else ""}): {escape(tag_txt)}<br>
+          {"counting: notes<br>" if cache.get("count_mode") == "notes" else ""}{escape(status)}
         </div>
       </div>
     </div>
@@ -105,29 +265,60 @@ def build_panel_html(cache: Dict[str, Any], cfg: Dict[str, Any]) -> str:
         <tbody>
 """
 
-    # Sort by deck name (case-insensitive, stable)
-    def _deck_key(r: Dict[str, Any]) -> str:
-        try:
-            return str(r.get("deck", "")).casefold()
-        except Exception:
-            return ""
-
-    rows = sorted(rows, key=_deck_key)
+    # パネルは上位 max_rows 件だけ（並びは sort_by）。全件はダイアログで見る
+    tree = bool(cache.get("deck_tree"))
+    try:
+        max_rows = int(cfg.get("max_rows", 30))
+    except Exception:
+        max_rows = 30
+    rows = select_rows(rows, str(cfg.get("sort_by", "name")), max_rows, tree=tree)
 
+    bands = bands_for_cfg(cfg)
+    breakdown = bool(cache.get("tag_breakdown")) and bool(tags)
+    both = cache.get("count_mode") == "both"
+    trend = (cache.get("trend") or {}).get("series") if cfg.get("show_trend") else None
+    level: Dict[Any, int] = {}
 
     items = []
+    if breakdown:
+        items.append(_breakdown_header(list(tags), both, trend is not None))
     for r in rows:
-        deck = escape(str(r.get("deck", "")))
-        num = int(r.get("num", 0))
+        deck_full = str(r.get("deck", ""))
         den = int(r.get("den", 0))
         pct = float(r.get("pct", 0.0))
-        color = _pick_color(pct, cfg)
+        color = bands.color_for(pct)
+
+        tr_attrs = ""
+        caret = ""
+        indent = 0
+        deck = escape(deck_full)
+        if tree:
+            did = r.get("did")
+            parent = r.get("parent")
+            lv = level[parent] + 1 if parent in level else 0
+            level[did] = lv
+            indent = lv * 16
+            if parent is not None:
+                # 親の行の下に出るので末尾の名前だけ
+                deck = escape(deck_full.split("::")[-1])
+            # 最初は最上位だけ表示。親の ▸ で子を開く
+            tr_attrs = f' data-did="{escape(str(did))}" data-parent="{escape(str(parent if parent is not None else ""))}"'
+            if parent is not None:
+                tr_attrs += ' data-hidden="1"'
+            if r.get("has_children"):
+                caret = (
+                    f'<span id="tag-ratio-caret{pid}-{escape(str(did))}" data-open="0" '
+                    f'onclick="tagRatioToggle(\'{pid}\', {escape(str(did))})" '
+                    'style="cursor:pointer; display:inline-block; width:12px;">&#9656;</span>'
+                )
+            else:
+                caret = '<span style="display:inline-block; width:12px;"></span>'
 
         items.append(
             f"""
-        <tr style="border-top: 1px solid rgba(0,0,0,0.06);">
-          <td style="padding: 8px 16px 8px 16px; white-space: nowrap;">
-            <span style="
+        <tr{tr_attrs} style="border-top: 1px solid rgba(0,0,0,0.06);{" display:none;" if "data-hidden" in tr_attrs else ""}">
+          <td style="padding: 8px 16px 8px {16 + indent}px; white-space: nowrap;">
+            {caret}<span style="
                 display:inline-block;
                 width: 10px;
                 height: 10px;
@@ -139,8 +330,8 @@ def build_panel_html(cache: Dict[str, Any], cfg: Dict[str, Any]) -> str:
             {deck}
           </td>
           <td style="padding: 8px 16px 8px 16px; white-space: nowrap; text-align:right;">
-            {num}/{den} ({pct:.1f}%)
-          </td>
+            {escape(_ratio_text(r, bool(est)))}
+          </td>{_trend_cell(trend.get(str(r.get("did"))), color) if trend is not None else ""}{_note_cell(r) if both else ""}{_breakdown_cells(r, den) if breakdown else ""}
         </tr>
 """
         )
@@ -152,9 +343,10 @@ def build_panel_html(cache: Dict[str, Any], cfg: Dict[str, Any]) -> str:
 """
     total_line = f"""
     <div style="margin-top:8px; font-size:12px; font-weight:600; white-space:nowrap;">
-      Total: {int(totals.get("num",0))}/{int(totals.get("den",0))} ({float(totals.get("pct",0.0)):.1f}%)
+      Total: {escape(_ratio_text(totals, bool(est)))}{_note_total(totals) if both else ""}
     </div>
   </div>
 </div>
 """
-    return head + table_head + "".join(items) + table_tail + total_line
+    script = _TREE_SCRIPT if tree else ""
+    return head + table_head + "".join(items) + table_tail + total_line + script
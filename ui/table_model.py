@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aqt.qt import QAbstractTableModel, QModelIndex, Qt
+
+from ..decks import deck_sort_key
+from ..service import select_rows
+
+# 一度に作る行数（スクロールで末尾に来たら次を読む）
+FETCH_BATCH = 200
+
+# (見出し, 表示文字列, 並べ替えキー)
+_Col = Tuple[str, Callable[[Dict[str, Any]], str], Callable[[Dict[str, Any]], Any]]
+
+
+def _int(r: Dict[str, Any], k: str) -> int:
+    try:
+        return int(r.get(k, 0) or 0)
+    except Exception:
+        return 0
+
+
+def _float(r: Dict[str, Any], k: str) -> float:
+    try:
+        return float(r.get(k, 0.0) or 0.0)
+    except Exception:
+        return 0.0
+
+
+def _count_col(label: str, key: str) -> _Col:
+    return (label, lambda r: str(_int(r, key)), lambda r: _int(r, key))
+
+
+def _pct_col(label: str, key: str) -> _Col:
+    return (label, lambda r: f"{_float(r, key):.1f}", lambda r: _float(r, key))
+
+
+def _tag_col(label: str, get: Callable[[Dict[str, Any]], int]) -> _Col:
+    def text(r: Dict[str, Any]) -> str:
+        den = _int(r, "den")
+        v = get(r)
+        return f"{v} ({(v / den * 100.0) if den else 0.0:.1f}%)"
+
+    return (label, text, get)
+
+
+def _tag_getter(i: int) -> Callable[[Dict[str, Any]], int]:
+    def get(r: Dict[str, Any]) -> int:
+        vals = r.get("tag_nums") or []
+        return int(vals[i]) if i < len(vals) else 0
+
+    return get
+
+
+def _columns_for(cache: Dict[str, Any]) -> List[_Col]:
+    tags = [str(t) for t in (cache.get("tags") or [])]
+    notes = cache.get("count_mode") == "notes"
+    cols: List[_Col] = [
+        ("Deck", lambda r: str(r.get("deck", "")), lambda r: deck_sort_key(r.get("deck", ""))),
+        _count_col("Tagged notes" if notes else "Tagged", "num"),
+        _count_col("Notes" if notes else "Total", "den"),
+        _pct_col("%", "pct"),
+    ]
+    if cache.get("count_mode") == "both":
+        cols += [
+            _count_col("Tagged notes", "note_num"),
+            _count_col("Notes", "note_den"),
+            _pct_col("Notes %", "note_pct"),
+        ]
+    if bool(cache.get("tag_breakdown")) and tags:
+        for i, t in enumerate(tags):
+            cols.append(_tag_col(t, _tag_getter(i)))
+        cols.append(_tag_col("OR", lambda r: _int(r, "or_num")))
+        cols.append(_tag_col("AND", lambda r: _int(r, "and_num")))
+    return cols
+
+
+class RatioTableModel(QAbstractTableModel):
+    """
+    キャッシュの rows（全デッキ）をそのまま持つ表モデル。
+    行ウィジェットは作らず、表示中の行だけ data() で文字列にする。
+    行は decode_result が作った dict をコピーせずに共有する（列配列には戻さない）。
+    同じ dict を select_rows とパネル描画も使うので、デコードは cache ファイルが
+    変わったときの1回だけで、モデルのために作り直すものはない。
+
+    - 並び: set_sort_mode（SORT_MODES）か、見出しクリック（sort）
+    - 絞り込み: set_filter（デッキ名の部分一致、大文字小文字無視）
+    - deck_tree の結果なら、閉じた親の子は並びから外す（toggle で開閉）
+    - rowCount は読み込み済みの行数だけ。残りは fetchMore で FETCH_BATCH 件ずつ
+    """
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self._cols: List[_Col] = _columns_for({})
+        self._rows: List[Dict[str, Any]] = []
+        self._tree = False
+        self._sort_mode = "name"
+        self._sort_col: Optional[int] = None
+        self._sort_desc = False
+        self._needle = ""
+        self._open: set = set()
+        self._kids: set = set()
+        self._level: Dict[Any, int] = {}
+        # 並べ替え・絞り込み・開閉を反映した行（この先頭 _loaded 件だけがビューに見える）
+        self._view: List[Dict[str, Any]] = []
+        self._loaded = 0
+
+    # --- 入力 ---
+
+    def set_result(self, cache: Dict[str, Any]) -> None:
+        self.beginResetModel()
+        self._cols = _columns_for(cache)
+        self._rows = list(cache.get("rows") or [])
+        self._tree = bool(cache.get("deck_tree"))
+        self._kids = {r.get("did") for r in self._rows if r.get("has_children")}
+        self._level = {}
+        if self._tree:
+            # 行は親 → 子の順（select_rows の tree と同じ前提）
+            for r in select_rows(self._rows, "name", 0, tree=True):
+                p = r.get("parent")
+                self._level[r.get("did")] = self._level[p] + 1 if p in self._level else 0
+        self._rebuild()
+        self.endResetModel()
+
+    def set_sort_mode(self, mode: str) -> None:
+        self._sort_mode = mode
+        self._sort_col = None
+        self._reset()
+
+    def set_filter(self, text: str) -> None:
+        self._needle = (text or "").strip().casefold()
+        self._reset()
+
+    def toggle(self, row: int) -> None:
+        if not self._tree or row < 0 or row >= self._loaded:
+            return
+        did = self._view[row].get("did")
+        if did not in self._kids:
+            return
+        if did in self._open:
+            self._open.discard(did)
+        else:
+            self._open.add(did)
+        self._reset()
+
+    # --- 並び / 絞り込み ---
+
+    def _reset(self) -> None:
+        self.beginResetModel()
+        self._rebuild()
+        self.endResetModel()
+
+    def _ordered(self) -> List[Dict[str, Any]]:
+        if self._sort_col is None:
+            return select_rows(self._rows, self._sort_mode, 0, tree=self._tree)
+
+        key = self._cols[self._sort_col][2]
+        desc = self._sort_desc
+        if not self._tree:
+            return sorted(self._rows, key=key, reverse=desc)
+
+        # ツリーは兄弟の中だけで並べ替える（親 → 子の順は崩さない）
+        by_parent: Dict[Any, List[Dict[str, Any]]] = {}
+        present = {r.get("did") for r in self._rows}
+        for r in self._rows:
+            p = r.get("parent")
+            by_parent.setdefault(p if p in present else None, []).append(r)
+        out: List[Dict[str, Any]] = []
+        stack = list(reversed(sorted(by_parent.get(None, []), key=key, reverse=desc)))
+        while stack:
+            r = stack.pop()
+            out.append(r)
+            ch = by_parent.get(r.get("did"))
+            if ch:
+                stack.extend(reversed(sorted(ch, key=key, reverse=desc)))
+        return out
+
+    def _rebuild(self) -> None:
+        rows = self._ordered()
+
+        if self._needle:
+            hits = [r for r in rows if self._needle in str(r.get("deck", "")).casefold()]
+            if self._tree:
+                # 当たった行の祖先も出す（どこのデッキか分かるように）。開閉は無視
+                parent = {r.get("did"): r.get("parent") for r in self._rows}
+                keep = set()
+                for r in hits:
+                    did = r.get("did")
+                    while did is not None and did not in keep:
+                        keep.add(did)
+                        did = parent.get(did)
+                rows = [r for r in rows if r.get("did") in keep]
+            else:
+                rows = hits
+        elif self._tree:
+            # 親が見えていて開いているときだけ子を出す
+            visible: Dict[Any, bool] = {}
+            shown = []
+            for r in rows:
+                p = r.get("parent")
+                show = p is None or (visible.get(p, False) and p in self._open)
+                visible[r.get("did")] = show
+                if show:
+                    shown.append(r)
+            rows = shown
+
+        self._view = rows
+        self._loaded = min(FETCH_BATCH, len(rows))
+
+    # --- QAbstractTableModel ---
+
+    def rowCount(self, parent=QModelIndex()) -> int:  # noqa: N802
+        return 0 if parent.isValid() else self._loaded
+
+    def columnCount(self, parent=QModelIndex()) -> int:  # noqa: N802
+        return 0 if parent.isValid() else len(self._cols)
+
+    def canFetchMore(self, parent=QModelIndex()) -> bool:  # noqa: N802
+        return not parent.isValid() and self._loaded < len(self._view)
+
+    def fetchMore(self, parent=QModelIndex()) -> None:  # noqa: N802
+        if parent.isValid():
+            return
+        n = min(FETCH_BATCH, len(self._view) - self._loaded)
+        if n <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self._loaded, self._loaded + n - 1)
+        self._loaded += n
+        self.endInsertRows()
+
+    def headerData(self, section: int, orientation, role=Qt.ItemDataRole.DisplayRole):  # noqa: N802
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        if orientation == Qt.Orientation.Horizontal and 0 <= section < len(self._cols):
+            return self._cols[section][0]
+        return None
+
+    def data(self, index: QModelIndex, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= self._loaded:
+            return None
+        r = self._view[index.row()]
+        c = index.column()
+
+        if role == Qt.ItemDataRole.DisplayRole:
+            if c == 0 and self._tree:
+                did = r.get("did")
+                name = str(r.get("deck", ""))
+                if r.get("parent") is not None:
+                    name = name.split("::")[-1]
+                if did in self._kids:
+                    mark = "▾ " if (did in self._open or self._needle) else "▸ "
+                else:
+                    mark = "   "
+                return "    " * self._level.get(did, 0) + mark + name
+            return self._cols[c][1](r)
+
+        if role == Qt.ItemDataRole.TextAlignmentRole and c > 0:
+            return int(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        return None
+
+    def sort(self, column: int, order=Qt.SortOrder.AscendingOrder) -> None:
+        if not 0 <= column < len(self._cols):
+            return
+        self._sort_col = column
+        self._sort_desc = order == Qt.SortOrder.DescendingOrder
+        self._reset()